@@ -39,6 +39,7 @@ class PartnerAdmin(admin.ModelAdmin):
     form = forms.PartnerForm
     list_display = ['name', 'as2_name', 'target_url', 'encryption', 'encryption_key', 'signature', 'signature_key',
                     'mdn', 'mdn_mode']
+    list_select_related = ['encryption_key', 'signature_key']
     list_filter = ('name', 'as2_name')
     fieldsets = (
         (None, {
@@ -49,6 +50,10 @@ class PartnerAdmin(admin.ModelAdmin):
             'classes': ('collapse', 'wide'),
             'fields': ('http_auth', 'http_auth_user', 'http_auth_pass', 'https_ca_cert')
         }),
+        ('Http Settings', {
+            'classes': ('collapse', 'wide'),
+            'fields': ('http_connect_timeout', 'http_read_timeout', 'http_expect_continue')
+        }),
         ('Security Settings', {
             'classes': ('collapse', 'wide'),
             'fields': ('compress', 'encryption', 'encryption_key', 'signature', 'signature_key')
@@ -72,6 +77,7 @@ class OrganizationAdmin(admin.ModelAdmin):
 class MessageAdmin(admin.ModelAdmin):
     readonly_fields = [f.name for f in models.Message._meta.fields]
     list_display = ['message_id', 'status_icon', 'direction', 'partner', 'timestamp']
+    list_select_related = ['partner']
     list_filter = ['direction', 'status', 'partner']
     search_fields = ['message_id']
 
@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
 
-import requests
+import os
+import ssl
+import time
+import socket
+import httplib
+import urlparse
+import threading
+import Queue
 import email
+import email.utils
 import hashlib
 import as2utils
 import base64
+from django import db
 from django.utils.translation import ugettext as _
 from email.mime.multipart import MIMEMultipart
-from email.parser import HeaderParser
 
-from . import models, pyas2init
+from . import logevents, models, pyas2init, rawarchive
 from . import __user_agent__, __reporting_ua__, __ediint_features__, __as2_version__
 
+# Seconds to wait for the answer to an Expect: 100-continue request before sending the body anyway
+EXPECT_CONTINUE_WAIT = 1.0
+
 
 def save_message(message, payload, raw_payload):
     """ Function decompresses, decrypts and verifies the received AS2 message
@@ -24,18 +35,15 @@ def save_message(message, payload, raw_payload):
         filename = payload.get_filename()
 
         # Search for the organization and partner, raise error if none exists.
-        models.Log.objects.create(message=message, status='S', text='%s: %s' % (_('Processing incoming AS2 message'), message))
+        models.Log.add(message, 'S', logevents.INBOUND_RECEIVED)
 
         if not message.organization:
             raise as2utils.As2PartnerNotFound('Unknown AS2 Organization with id <%s>' % message._headers().get('as2-to'))
         if not message.partner:
             raise as2utils.As2PartnerNotFound('Unknown AS2 Partner with id <%s>' % message._headers().get('as2-from'))
 
-        models.Log.objects.create(
-            message=message,
-            status='S',
-            text=_('Message is for Organization <%s> from Partner <%s>' % (message.organization, message.partner))
-         )
+        models.Log.add(message, 'S', logevents.INBOUND_PROFILES,
+                       organization=message.organization, partner=message.partner)
 
         # Check if message from this partner are expected to be encrypted
         if message.partner.encryption and payload.get_content_type() != 'application/pkcs7-mime':
@@ -46,8 +54,7 @@ def save_message(message, payload, raw_payload):
         # Check if payload is encrypted and if so decrypt it
         if payload.get_content_type() == 'application/pkcs7-mime' \
                 and payload.get_param('smime-type') == 'enveloped-data':
-            models.Log.objects.create(message=message, status='S', text=_(
-                'Decrypting the payload using private key {0:s}'.format(message.organization.encryption_key)))
+            models.Log.add(message, 'S', logevents.DECRYPTING, key=message.organization.encryption_key)
             message.encrypted = True
 
             # Check if encrypted data is base64 encoded, if not then encode
@@ -86,8 +93,7 @@ def save_message(message, payload, raw_payload):
         if payload.get_content_type() == 'multipart/signed':
             if not message.partner.signature_key:
                 raise as2utils.As2InsufficientSecurity('Partner has no signature verification key defined')
-            models.Log.objects.create(message=message, status='S', text=_(
-                'Message is signed, Verifying it using public key {0:s}'.format(message.partner.signature_key)))
+            models.Log.add(message, 'S', logevents.VERIFYING, key=message.partner.signature_key)
             pyas2init.logger.debug('Verifying the signed payload:\n{0:s}'.format(payload.as_string()))
             message.signed = True
             mic_alg = payload.get_param('micalg').lower() or 'sha1'
@@ -123,7 +129,7 @@ def save_message(message, payload, raw_payload):
         # Check if the message has been compressed and if so decompress it
         if payload.get_content_type() == 'application/pkcs7-mime' \
                 and payload.get_param('smime-type') == 'compressed-data':
-            models.Log.objects.create(message=message, status='S', text=_(u'Decompressing the payload'))
+            models.Log.add(message, 'S', logevents.DECOMPRESSING)
             message.compressed = True
 
             # Decode the data to binary if its base64 encoded
@@ -149,7 +155,7 @@ def save_message(message, payload, raw_payload):
 
         return payload
     finally:
-        message.save()
+        message.save(update_fields=['compressed', 'encrypted', 'signed', 'mic'])
 
 
 def build_mdn(message, status, **kwargs):
@@ -179,21 +185,19 @@ def build_mdn(message, status, **kwargs):
                                                 (kwargs['adv_status'], kwargs['status_message'])))
             confirmation_text = _('The AS2 message could not be processed. '
                                   'The disposition-notification report has additional details.')
-            models.Log.objects.create(message=message, status='E', text=kwargs['status_message'])
+            models.Log.add(message, 'E', logevents.ERROR, error=kwargs['status_message'])
             message.status = 'E'
         else:
             message.status = 'S'
 
         # In case no MDN is requested exit from process
-        header_parser = HeaderParser()
-        message_header = header_parser.parsestr(message.headers)
+        message_header = message._headers()
         if not message_header.get('disposition-notification-to'):
-            models.Log.objects.create(message=message, status='S',
-                                      text=_('MDN not requested by partner, closing request.'))
+            models.Log.add(message, 'S', logevents.MDN_NOT_REQUESTED)
             return mdn_body, mdn_message
 
         # Build the MDN report
-        models.Log.objects.create(message=message, status='S', text=_('Building the MDN response to the request'))
+        models.Log.add(message, 'S', logevents.MDN_BUILDING)
         mdn_report = MIMEMultipart('report', report_type="disposition-notification")
 
         # Build the text message with confirmation text and add to report
@@ -229,10 +233,7 @@ def build_mdn(message, status, **kwargs):
         mdn_signed = False
         if message_header.get('disposition-notification-options') and message.organization \
                 and message.organization.signature_key:
-            models.Log.objects.create(message=message,
-                                      status='S',
-                                      text=_('Signing the MDN using private key {0:s}'.format(
-                                          message.organization.signature_key)))
+            models.Log.add(message, 'S', logevents.MDN_SIGNING, key=message.organization.signature_key)
             mdn_signed = True
             # options = message_header.get('disposition-notification-options').split(";")
             # algorithm = options[1].split(",")[1].strip()
@@ -271,12 +272,8 @@ def build_mdn(message, status, **kwargs):
 
         # Save the MDN to the store
         filename = mdn_message.get('message-id').strip('<>') + '.mdn'
-        full_filename = as2utils.storefile(pyas2init.gsettings['mdn_send_store'], filename, mdn_body, True)
-
-        # Extract the MDN headers as string
-        mdn_headers = ''
-        for key, value in mdn_message.items():
-            mdn_headers += '%s: %s\n' % (key, value)
+        full_filename = as2utils.storefile(pyas2init.gsettings['mdn_send_store'], filename, mdn_body, True,
+                                           fsync=pyas2init.store_fsync('mdn_send_store'))
 
         # Is Async mdn is requested mark MDN as pending and return None
         if message_header.get('receipt-delivery-option'):
@@ -284,13 +281,11 @@ def build_mdn(message, status, **kwargs):
                                                     file=full_filename,
                                                     status='P',
                                                     signed=mdn_signed,
-                                                    headers=mdn_headers,
+                                                    headers=models.dump_headers(mdn_message.items()),
                                                     return_url=message_header['receipt-delivery-option'])
             message.mdn_mode = 'ASYNC'
             mdn_body, mdn_message = None, None
-            models.Log.objects.create(message=message,
-                                      status='S',
-                                      text=_('Asynchronous MDN requested, setting status to pending'))
+            models.Log.add(message, 'S', logevents.MDN_ASYNC_PENDING)
 
         # Else mark MDN as sent and return the MDN message
         else:
@@ -298,29 +293,27 @@ def build_mdn(message, status, **kwargs):
                                                     file=full_filename,
                                                     status='S',
                                                     signed=mdn_signed,
-                                                    headers=mdn_headers)
+                                                    headers=models.dump_headers(mdn_message.items()))
             message.mdn_mode = 'SYNC'
-            models.Log.objects.create(message=message,
-                                      status='S',
-                                      text=_('MDN created successfully and sent to partner'))
+            models.Log.add(message, 'S', logevents.MDN_SENT)
         return mdn_body, mdn_message
 
     finally:
-        message.save(full_filename=kwargs.get('full_filename'))
+        # The payload is set by the receiver once the message has been saved to the inbox
+        message.save(update_fields=['status', 'mdn', 'mdn_mode', 'payload'],
+                     full_filename=kwargs.get('full_filename'))
 
 
-def build_message(message):
+def build_message(message, cache=None):
     """ Build the AS2 mime message to be sent to partner. Encrypts, signs and compresses the message based on
-    the partner profile. Returns the message final message content."""
+    the partner profile. Returns the message final message content. With a BuildCache the steps are shared with
+    the other messages built from the same payload file with the same settings."""
 
     # Initialize the variables
     mic_content, mic_alg = None, None
-    payload = email.Message.Message()
 
     # Build the As2 message headers as per specifications
-    models.Log.objects.create(message=message,
-                              status='S',
-                              text=_(u'Build the AS2 message and header to send to the partner'))
+    models.Log.add(message, 'S', logevents.BUILDING)
     email_datetime = email.Utils.formatdate(localtime=True)
     as2_header = {
         'from': message.organization.email_address,
@@ -337,63 +330,79 @@ def build_message(message):
     }
 
     # Create the payload message and add the data to be transferred as its contents
-    with open(message.payload.file, 'rb') as fh:
-        as2_content = fh.read()
-    payload.set_payload(as2_content)
-    payload.set_type(message.partner.content_type)
-    payload.add_header('Content-Disposition', 'attachment', filename=message.payload.name)
-    del payload['MIME-Version']
+    def build_payload():
+        payload = email.Message.Message()
+        with open(message.payload.file, 'rb') as fh:
+            as2_content = fh.read()
+        payload.set_payload(as2_content)
+        payload.set_type(message.partner.content_type)
+        payload.add_header('Content-Disposition', 'attachment', filename=message.payload.name)
+        del payload['MIME-Version']
+        return as2_content, payload
+
+    # The key of each step holds everything its result depends on
+    step_key = (message.payload.file, message.payload.name, message.partner.content_type)
+    as2_content, payload = _build_step(cache, step_key, build_payload)
 
     # Compress the message if requested in the profile
     if message.partner.compress:
-        models.Log.objects.create(message=message, status='S', text=_(u'Compressing the payload.'))
+        models.Log.add(message, 'S', logevents.COMPRESSING)
         message.compressed = True
-        compressed_message = email.Message.Message()
-        compressed_message.set_type('application/pkcs7-mime')
-        compressed_message.set_param('name', 'smime.p7z')
-        compressed_message.set_param('smime-type', 'compressed-data')
-        compressed_message.add_header('Content-Transfer-Encoding', 'base64')
-        compressed_message.add_header('Content-Disposition', 'attachment', filename='smime.p7z')
-        compressed_message.set_payload(
-            as2utils.compress_payload(as2utils.canonicalize(as2utils.mimetostring(payload, 0))))
-        as2_content, payload = compressed_message.get_payload(), compressed_message
+
+        def compress(payload=payload):
+            compressed_message = email.Message.Message()
+            compressed_message.set_type('application/pkcs7-mime')
+            compressed_message.set_param('name', 'smime.p7z')
+            compressed_message.set_param('smime-type', 'compressed-data')
+            compressed_message.add_header('Content-Transfer-Encoding', 'base64')
+            compressed_message.add_header('Content-Disposition', 'attachment', filename='smime.p7z')
+            compressed_message.set_payload(
+                as2utils.compress_payload(as2utils.canonicalize(as2utils.mimetostring(payload, 0))))
+            return compressed_message.get_payload(), compressed_message
+
+        step_key += ('compressed',)
+        as2_content, payload = _build_step(cache, step_key, compress)
         pyas2init.logger.debug('Compressed message %s payload as:\n%s' % (message.message_id, payload.as_string()))
 
     # Sign the message if requested in the profile
     if message.partner.signature:
-        models.Log.objects.create(message=message,
-                                  status='S',
-                                  text=_(u'Signing the message using organization key {0:s}'.format(
-                                      message.organization.signature_key)))
+        models.Log.add(message, 'S', logevents.SIGNING, key=message.organization.signature_key)
         message.signed = True
-        signed_message = MIMEMultipart('signed', protocol="application/pkcs7-signature")
-        del signed_message['MIME-Version']
-        mic_content = as2utils.canonicalize(as2utils.mimetostring(payload, 0))
-        signed_message.attach(payload)
-        mic_alg, signature = as2utils.sign_payload(mic_content,
-                                                   str(message.organization.signature_key.certificate.path),
-                                                   str(message.organization.signature_key.certificate_passphrase))
-        # WIP Set cipher
-        # signed_message.set_param('micalg', message.partner.signature)
-        signed_message.set_param('micalg', mic_alg)
-        signed_message.attach(signature)
-        signed_message.as_string()
-        as2_content = as2utils.canonicalize(as2utils.extractpayload(signed_message))
-        payload = signed_message
+
+        def sign(payload=payload):
+            signed_message = MIMEMultipart('signed', protocol="application/pkcs7-signature")
+            del signed_message['MIME-Version']
+            mic_content = as2utils.canonicalize(as2utils.mimetostring(payload, 0))
+            signed_message.attach(payload)
+            mic_alg, signature = as2utils.sign_payload(mic_content,
+                                                       str(message.organization.signature_key.certificate.path),
+                                                       str(message.organization.signature_key.certificate_passphrase))
+            # WIP Set cipher
+            # signed_message.set_param('micalg', message.partner.signature)
+            signed_message.set_param('micalg', mic_alg)
+            signed_message.attach(signature)
+            signed_message.as_string()
+            as2_content = as2utils.canonicalize(as2utils.extractpayload(signed_message))
+            return as2_content, signed_message, mic_content, mic_alg
+
+        step_key += ('signed', message.organization.signature_key_id, message.partner.signature)
+        as2_content, payload, mic_content, mic_alg = _build_step(cache, step_key, sign)
         pyas2init.logger.debug('Signed message %s payload as:\n%s' % (message.message_id, payload.as_string()))
 
     # Encrypt the message if requested in the profile
     if message.partner.encryption:
-        models.Log.objects.create(message=message,
-                                  status='S',
-                                  text=_(u'Encrypting the message using partner key {0:s}'.format(
-                                      message.partner.encryption_key)))
+        models.Log.add(message, 'S', logevents.ENCRYPTING, key=message.partner.encryption_key)
         message.encrypted = True
-        payload = as2utils.encrypt_payload(as2utils.canonicalize(as2utils.mimetostring(payload, 0)),
-                                           message.partner.encryption_key.certificate.path,
-                                           message.partner.encryption)
-        payload.set_type('application/pkcs7-mime')
-        as2_content = payload.get_payload()
+
+        def encrypt(payload=payload):
+            encrypted_message = as2utils.encrypt_payload(as2utils.canonicalize(as2utils.mimetostring(payload, 0)),
+                                                         message.partner.encryption_key.certificate.path,
+                                                         message.partner.encryption)
+            encrypted_message.set_type('application/pkcs7-mime')
+            return encrypted_message.get_payload(), encrypted_message
+
+        step_key += ('encrypted', message.partner.encryption_key_id, message.partner.encryption)
+        as2_content, payload = _build_step(cache, step_key, encrypt)
         pyas2init.logger.debug('Encrypted message %s payload as:\n%s' % (message.message_id, payload.as_string()))
 
     # If MDN is to be requested from the partner, set the appropriate headers
@@ -415,28 +424,69 @@ def build_message(message):
         calculate_mic = getattr(hashlib, mic_alg.replace('-', ''), hashlib.sha1)
         message.mic = calculate_mic(mic_content).digest().encode('base64').strip()
 
-    # Extract the As2 headers as a string and save it to the message object
+    # Save the As2 headers to the message object
     as2_header.update(payload.items())
-    message.headers = ''
-    for key in as2_header:
-        message.headers += '%s: %s\n' % (key, as2_header[key])
-    message.save()
-
-    models.Log.objects.create(message=message,
-                              status='S',
-                              text=_('AS2 message has been built successfully, sending it to the partner'))
+    message.set_headers(as2_header.items())
+
+    # The path of the message as it goes on the wire is recorded once the raw archive has written it,
+    # retries can then send it again without building it
+    message.raw_file = None
+    message.build_hash = build_hash(message)
+    message.save(update_fields=['headers', 'as2_from', 'as2_to', 'subject', 'compressed', 'signed',
+                                'encrypted', 'mdn_mode', 'mic', 'raw_file', 'build_hash'])
+    rawarchive.submit(message, as2_content)
+
+    models.Log.add(message, 'S', logevents.BUILT)
     return as2_content
 
 
+def build_hash(message):
+    """ Returns a digest of the organization and partner settings that the built message depends on """
+    organization, partner = message.organization, message.partner
+    settings = (organization.email_address, organization.as2_name,
+                organization.signature_key and organization.signature_key.certificate.name,
+                partner.as2_name, partner.subject, partner.target_url, partner.content_type, partner.compress,
+                partner.encryption, partner.encryption_key and partner.encryption_key.certificate.name,
+                partner.signature, partner.mdn, partner.mdn_mode, partner.mdn_sign, pyas2init.gsettings['mdn_url'])
+    return hashlib.sha1(repr(settings)).hexdigest()
+
+
+def built_message(message):
+    """ Returns the file holding the message as built for the last send, None when the file is gone or the
+    profile of the organization or partner has changed since and the message has to be built again."""
+    if message.raw_file and message.build_hash == build_hash(message) and os.path.isfile(message.raw_file):
+        return message.raw_file
+    return None
+
+
+class BuildCache(object):
+    """ Shares the steps of build_message between messages built from the same payload, for example when a file
+     is sent to many partners. Each step is computed once, also when the messages are built by parallel threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = {}
+
+    def get(self, key, compute):
+        with self.lock:
+            step = self.steps.setdefault(key, {'lock': threading.Lock()})
+        with step['lock']:
+            if 'result' not in step:
+                step['result'] = compute()
+        return step['result']
+
+
+def _build_step(cache, key, compute):
+    if cache is None:
+        return compute()
+    return cache.get(key, compute)
+
+
 def send_message(message, payload):
     """ Sends the AS2 message to the partner. Takes the message and payload as arguments and posts the as2 message to
      the partner."""
 
     try:
-        # Parse the message header to a dictionary
-        header_parser = HeaderParser()
-        message_header = header_parser.parsestr(message.headers)
-
         # Set up the http auth if specified in the partner profile
         auth = None
         if message.partner.http_auth:
@@ -447,18 +497,19 @@ def send_message(message, payload):
 
         # ASYNC MDN
         if message.partner.mdn and message.partner.mdn_mode == 'ASYNC':
-            models.Log.objects.create(message=message, status='S',
-                                      text=_('ASYNC MDN requested.'))
+            models.Log.add(message, 'S', logevents.ASYNC_MDN_REQUESTED)
             message.status = 'P'
-            message.save()
+            message.save(update_fields=['status'])
 
         # Send the AS2 message to the partner
         try:
-            response = requests.post(message.partner.target_url,
-                                     auth=auth,
-                                     verify=verify,
-                                     headers=dict(message_header.items()),
-                                     data=payload)
+            response = post_message(message.partner.target_url,
+                                    message._headers(),
+                                    payload,
+                                    auth=auth,
+                                    verify=verify,
+                                    timeout=message.partner.http_timeout(),
+                                    expect_continue=message.partner.http_expect_continue)
             response.raise_for_status()
 
         except Exception as e:
@@ -467,11 +518,11 @@ def send_message(message, payload):
                                                 '"%s".\n\nTo retry transmission run the management '
                                                 'command "retryfailedas2comms".' % e))
             message.status = 'R'
-            message.save()
-            models.Log.objects.create(message=message, status='E', text=_('Message send failed with error %s' % e))
+            message.save(update_fields=['status'])
+            models.Log.add(message, 'E', logevents.SEND_ERROR, error=e)
             return
 
-        models.Log.objects.create(message=message, status='S', text=_('AS2 message successfully sent to partner'))
+        models.Log.add(message, 'S', logevents.SENT)
 
         # Process the MDN based on the partner profile settings
         if message.partner.mdn:
@@ -485,18 +536,117 @@ def send_message(message, payload):
             mdn_content = '%s: %s\n' % ('message-id', mdn_headers['message-id'])
             mdn_content += '%s: %s\n\n' % ('content-type', mdn_headers['content-type'])
             mdn_content += response.content
-            models.Log.objects.create(message=message, status='S', text=_('Synchronous mdn received from partner'))
+            models.Log.add(message, 'S', logevents.SYNC_MDN_RECEIVED)
             pyas2init.logger.debug('Synchronous MDN for message %s received:\n%s' % (message.message_id, mdn_content))
             # save_mdn() already save message at the end by calling message.save()
             save_mdn(message, mdn_content)
         else:
             message.status = 'S'
-            message.save()
-            models.Log.objects.create(message=message,
-                                      status=message.status,
-                                      text=_('No MDN needed, File Transferred successfully to the partner'))
+            message.save(update_fields=['status'])
+            models.Log.add(message, message.status, logevents.TRANSFERRED_NO_MDN)
     except Exception as e:
         pyas2init.logger.error('Unexpected error while sendin AS2 message:\n%s' % e)
+    finally:
+        as2utils.syncstoredfiles()
+
+
+def post_message(url, headers, body, auth=None, verify=True, timeout=None, expect_continue=False):
+    """ Posts the body, a string or a file which is streamed from its current position, to the url.
+     Timeout is a (connect, read) tuple. With expect_continue the body is only sent once the server
+     accepted the headers, a rejection like 401 or 413 is returned without sending the body. The proxies of
+     the environment are used in both cases, as requests does.
+     Returns a requests response."""
+    import requests
+
+    if not expect_continue:
+        return requests.post(url, auth=auth, verify=verify, headers=headers, data=body, timeout=timeout)
+
+    if hasattr(body, 'read'):
+        length = os.fstat(body.fileno()).st_size - body.tell()
+    else:
+        length = len(body)
+
+    parts = urlparse.urlsplit(url)
+    connect_timeout, read_timeout = timeout or (None, None)
+    host, port = parts.hostname, parts.port
+    target = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+    proxy = requests.utils.select_proxy(url, requests.utils.get_environ_proxies(url))
+    proxy_headers = {}
+    if proxy:
+        proxy_parts = urlparse.urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+        host, port = proxy_parts.hostname, proxy_parts.port or 80
+        if proxy_parts.username:
+            proxy_headers['Proxy-Authorization'] = 'Basic %s' % base64.b64encode(
+                '%s:%s' % requests.utils.get_auth_from_url(proxy))
+    if parts.scheme == 'https':
+        context = ssl.create_default_context(cafile=verify if isinstance(verify, basestring) else None)
+        if verify is False:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        connection = httplib.HTTPSConnection(host, port, timeout=connect_timeout, context=context)
+        if proxy:
+            # The proxy opens a tunnel to the partner, the TLS session is with the partner
+            connection.set_tunnel(parts.hostname, parts.port, proxy_headers)
+    else:
+        connection = httplib.HTTPConnection(host, port, timeout=connect_timeout)
+        if proxy:
+            # A plain http proxy forwards the request for the absolute url
+            target = urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path or '/', parts.query, ''))
+    try:
+        connection.putrequest('POST', target, skip_accept_encoding=True)
+        if proxy and parts.scheme != 'https':
+            for key, value in proxy_headers.items():
+                connection.putheader(key, value)
+        for key, value in headers.items():
+            connection.putheader(key, value)
+        if auth:
+            connection.putheader('Authorization', 'Basic %s' % base64.b64encode('%s:%s' % auth))
+        connection.putheader('Content-Length', str(length))
+        connection.putheader('Expect', '100-continue')
+        connection.endheaders()
+
+        # Servers that ignore the expectation get the body after a short wait
+        interim = connection.sock.makefile('rb', 0)
+        while True:
+            connection.sock.settimeout(EXPECT_CONTINUE_WAIT)
+            try:
+                status_line = interim.readline(65537)
+            except socket.timeout:
+                break
+            finally:
+                connection.sock.settimeout(read_timeout)
+            if not status_line:
+                raise requests.exceptions.ConnectionError(
+                    _(u'Connection closed by %s before it answered the Expect: 100-continue request') % parts.netloc)
+            version, status, reason = (status_line.split(None, 2) + ['', ''])[:3]
+            if not version.startswith('HTTP/') or not status.isdigit():
+                raise httplib.BadStatusLine(status_line)
+            response_headers = httplib.HTTPMessage(interim, 0)
+            if int(status) == httplib.CONTINUE:
+                break
+            if int(status) >= 200:
+                content_length = response_headers.getheader('content-length', '')
+                content = interim.read(int(content_length)) if content_length.isdigit() else ''
+                return _http_response(url, int(status), reason.strip(), response_headers, content)
+            # Other interim responses like 102 Processing or 103 Early Hints, the answer is still to come
+
+        connection.send(body)
+        response = connection.getresponse()
+        return _http_response(url, response.status, response.reason, response.msg, response.read())
+    finally:
+        connection.close()
+
+
+def _http_response(url, status, reason, headers, content):
+    """ Wraps a response received with httplib as a requests response """
+    import requests
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.reason = reason
+    response.headers = requests.structures.CaseInsensitiveDict(headers.items())
+    response._content = content
+    return response
 
 
 def save_mdn(message, mdn_content):
@@ -506,9 +656,7 @@ def save_mdn(message, mdn_content):
     try:
         # Parse the raw mdn to an email.Message
         mdn_message = email.message_from_string(mdn_content)
-        mdn_headers = ''
-        for key in mdn_message.keys():
-            mdn_headers += '%s: %s\n' % (key, mdn_message[key])
+        mdn_headers = models.dump_headers(mdn_message.items())
         message_id = mdn_message.get('message-id')
 
         # Raise error if message is not an MDN
@@ -517,17 +665,12 @@ def save_mdn(message, mdn_content):
 
         # Raise error if signed MDN requested and unsigned MDN returned
         if message.partner.mdn_sign and mdn_message.get_content_type() != 'multipart/signed':
-            models.Log.objects.create(message=message,
-                                      status='W',
-                                      text=_('Expected signed MDN but unsigned MDN returned'))
+            models.Log.add(message, 'W', logevents.MDN_UNSIGNED)
 
         mdn_signed = False
         if mdn_message.get_content_type() == 'multipart/signed':
             # Verify the signature in the MDN message
-            models.Log.objects.create(message=message,
-                                      status='S',
-                                      text=_(u'Verifying the signed MDN with partner key {0:s}'.format(
-                                          message.partner.signature_key)))
+            models.Log.add(message, 'S', logevents.MDN_VERIFYING, key=message.partner.signature_key)
             mdn_signed = True
 
             # Get the partners public and ca certificates
@@ -557,7 +700,8 @@ def save_mdn(message, mdn_content):
         full_filename = as2utils.storefile(pyas2init.gsettings['mdn_receive_store'],
                                            filename,
                                            as2utils.extractpayload(mdn_message),
-                                           True)
+                                           True,
+                                           fsync=pyas2init.store_fsync('mdn_receive_store'))
         message.mdn = models.MDN.objects.create(message_id=message_id.strip('<>'),
                                                 file=full_filename,
                                                 status='R',
@@ -570,36 +714,24 @@ def save_mdn(message, mdn_content):
                 if part.get_content_type() == 'message/disposition-notification':
                     pyas2init.logger.debug('Found MDN report for message %s:\n%s' % (message.message_id,
                                                                                      part.as_string()))
-                    models.Log.objects.create(message=message,
-                                              status='S',
-                                              text=_('Checking the MDN for status of the message'))
+                    models.Log.add(message, 'S', logevents.MDN_CHECKING)
                     mdn = part.get_payload().pop()
                     mdn_status = mdn.get('Disposition').split(';')
                     # Check the status of the AS2 message
                     if mdn_status[1].strip() == 'processed':
-                        models.Log.objects.create(message=message,
-                                                  status='S',
-                                                  text=_('Message has been successfully processed, '
-                                                         'verifying the MIC if present.'))
+                        models.Log.add(message, 'S', logevents.MDN_PROCESSED)
                         # Compare the MIC of the received message
                         if mdn.get('Received-Content-MIC') and message.mic:
                             mdn_mic = mdn.get('Received-Content-MIC').split(',')
                             if message.mic != mdn_mic[0]:
                                 message.status = 'W'
-                                models.Log.objects.create(message=message,
-                                                          status='W',
-                                                          text=_('Message Integrity check failed, please validate '
-                                                                 'message content with your partner'))
+                                models.Log.add(message, 'W', logevents.MIC_FAILED)
                             else:
                                 message.status = 'S'
-                                models.Log.objects.create(message=message,
-                                                          status='S',
-                                                          text=_('File Transferred successfully to the partner'))
+                                models.Log.add(message, 'S', logevents.TRANSFERRED)
                         else:
                             message.status = 'S'
-                            models.Log.objects.create(message=message,
-                                                      status='S',
-                                                      text=_('File Transferred successfully to the partner'))
+                            models.Log.add(message, 'S', logevents.TRANSFERRED)
 
                         # Run the post successful send command
                         # run_post_send(message)
@@ -610,4 +742,144 @@ def save_mdn(message, mdn_content):
         else:
             raise as2utils.As2Exception(_('MDN report not found in the response'))
     finally:
-        message.save()
+        message.save(update_fields=['status', 'mdn'])
+
+
+def send_file(organization, partner, path, delete=False, stored=False):
+    """ Stores the file in the payload send store, then builds and sends the AS2 message to the partner.
+     With stored the file has been written to the payload send store already and is used in place.
+     Returns the message, errors while building or sending the message are logged on the message."""
+
+    if not os.path.isfile(path):
+        raise as2utils.As2Exception(_(u'Payload at location "%(path)s" does not exist'), {'path': path})
+    if stored:
+        store = os.path.abspath(pyas2init.gsettings['payload_send_store'])
+        if not os.path.abspath(path).startswith(store + os.sep):
+            raise as2utils.As2Exception(_(u'Payload %(path)s is not in the payload send store'), {'path': path})
+        outfile = os.path.abspath(path)
+    else:
+        if delete and not os.access(path, os.W_OK):
+            raise as2utils.As2Exception(_(u'Insufficient file permission for payload %(path)s'), {'path': path})
+
+        # Move or copy the file to the store
+        outfile = as2utils.storepath(path, pyas2init.gsettings['payload_send_store'], os.path.basename(path), True,
+                                     delete=delete, fsync=pyas2init.store_fsync('payload_send_store'))
+
+    # Create the payload and message objects
+    payload = models.Payload.objects.create(name=os.path.basename(path),
+                                            file=outfile,
+                                            content_type=partner.content_type)
+    message = models.Message.objects.create(message_id=email.utils.make_msgid().strip('<>'),
+                                            partner=partner,
+                                            organization=organization,
+                                            direction='OUT',
+                                            status='IP',
+                                            payload=payload)
+
+    return _build_and_send(message)
+
+
+def _build_and_send(message, cache=None):
+    """ Builds and sends the AS2 message, errors are logged on the message """
+    try:
+        payload = build_message(message, cache=cache)
+        send_message(message, payload)
+    except Exception as e:
+        pyas2init.logger.error(_('Failed to send message, error:\n%(txt)s') % {'txt': as2utils.txtexc()})
+        message.status = 'E'
+        models.Log.add(message, 'E', logevents.SEND_FAILED, error=e)
+        message.save(update_fields=['status'])
+
+        # Send mail here
+        as2utils.senderrorreport(message, _('Failed to send message, error is %s' % e))
+    return message
+
+
+def send_files(organization, partner, paths, delete=False, workers=1):
+    """ Sends each file as a separate AS2 message to the partner, using a number of worker threads.
+     Returns a (path, message, error, seconds) tuple for each file in the order of the paths, message is None
+     when the file could not be picked up."""
+
+    def send(path):
+        try:
+            return send_file(organization, partner, path, delete=delete)
+        except Exception:
+            pyas2init.logger.error(_(u'Failed to send file "%(path)s", error:\n%(txt)s') %
+                                   {'path': path, 'txt': as2utils.txtexc()})
+            raise
+
+    return _run_parallel(send, paths, workers)
+
+
+def send_file_to_partners(organization, partners, path, delete=False, workers=1):
+    """ Sends the file as a separate AS2 message to each of the partners, using a number of worker threads.
+     The file is stored once, read and compressed once and signed once for all partners with the same settings,
+     only the encryption is done per partner. Returns a (partner, message, error, seconds) tuple for each
+     partner in the order of the partners."""
+
+    if not os.path.isfile(path):
+        raise as2utils.As2Exception(_(u'Payload at location "%(path)s" does not exist'), {'path': path})
+    if delete and not os.access(path, os.W_OK):
+        raise as2utils.As2Exception(_(u'Insufficient file permission for payload %(path)s'), {'path': path})
+
+    # Move or copy the file to the store
+    outfile = as2utils.storepath(path, pyas2init.gsettings['payload_send_store'], os.path.basename(path), True,
+                                 delete=delete, fsync=pyas2init.store_fsync('payload_send_store'))
+
+    # Create the payload and message objects, the messages share the stored file
+    messages = []
+    for partner in partners:
+        payload = models.Payload.objects.create(name=os.path.basename(path),
+                                                file=outfile,
+                                                content_type=partner.content_type)
+        messages.append(models.Message.objects.create(message_id=email.utils.make_msgid().strip('<>'),
+                                                      partner=partner,
+                                                      organization=organization,
+                                                      direction='OUT',
+                                                      status='IP',
+                                                      payload=payload))
+
+    cache = BuildCache()
+    results = _run_parallel(lambda message: _build_and_send(message, cache=cache), messages, workers)
+    return [(message.partner, result, error, seconds) for message, result, error, seconds in results]
+
+
+def _run_parallel(function, items, workers):
+    """ Calls the function for each item on a number of worker threads.
+     Returns an (item, result, error, seconds) tuple for each item in the order of the items."""
+
+    results = [None] * len(items)
+    jobs = Queue.Queue()
+    for job in enumerate(items):
+        jobs.put(job)
+
+    def work():
+        while True:
+            try:
+                index, item = jobs.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            result, error = None, None
+            try:
+                result = function(item)
+            except Exception as e:
+                error = as2utils.safe_unicode(e)
+            results[index] = (item, result, error, time.time() - start)
+
+    def work_thread():
+        try:
+            work()
+        finally:
+            # each thread has its own database connection
+            db.connection.close()
+
+    if workers <= 1:
+        work()
+    else:
+        threads = [threading.Thread(target=work_thread) for __ in range(min(workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results
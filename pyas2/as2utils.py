@@ -3,17 +3,21 @@ import os
 import email
 import codecs
 import collections
-import zlib
 import time
 import traceback
+import atexit
+import errno
+import tempfile
+import shutil
+import uuid
+import hashlib
+import thread
+import threading
 from django.utils.translation import ugettext as _
-from pyasn1.type import univ, namedtype, tag
-from pyasn1.codec.ber import encoder, decoder
-from M2Crypto import BIO, SMIME, X509
 from cStringIO import StringIO
 from email.generator import Generator
 
-key_pass = ''
+FSYNC_POLICIES = ('always', 'batch', 'never')
 
 # **********************************************************/**
 # *************************Logging, Error handling********************/**
@@ -180,18 +184,208 @@ def readdata(filename, charset=None, errors='strict'):
     return content
 
 
-def storefile(targetdir, filename, content, archive):
-    """ Save data to file system and optionally add date as sub directory for archiving"""
+def storefile(targetdir, filename, content, archive, fsync='always'):
+    """ Save data to file system and optionally add date as sub directory for archiving.
+        The data is written to a temporary file in the target directory which is then linked to its final name,
+        readers never see a partially written file and an existing file is never overwritten.
+        fsync is one of FSYNC_POLICIES: 'always' syncs before returning, 'batch' defers the sync
+        to the next call of syncstoredfiles() in the same thread and 'never' leaves it to the operating system."""
+    if fsync not in FSYNC_POLICIES:
+        raise AS2Error(u'Invalid fsync policy "%(fsync)s"', {'fsync': fsync})
     if archive:
         targetdir = join(targetdir, time.strftime('%Y%m%d'))
     dirshouldbethere(targetdir)
-    if os.path.isfile(join(targetdir, filename)):
-        filename = os.path.splitext(filename)[0] + time.strftime('_%H%M%S') + os.path.splitext(filename)[1]
+    tmp_fd, tmp_filename = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=targetdir)
+    try:
+        with os.fdopen(tmp_fd, 'wb') as sfile:
+            sfile.write(content)
+            if fsync == 'always':
+                sfile.flush()
+                os.fsync(sfile.fileno())
+        os.chmod(tmp_filename, 0o666 & ~_umask)
+        absfilename = _link_unique(tmp_filename, targetdir, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    if fsync == 'always':
+        _fsync_dir(targetdir)
+    elif fsync == 'batch':
+        _add_pending(absfilename)
+    return absfilename
+
+
+def storepath(source, targetdir, filename, archive, delete=False, fsync='always'):
+    """ Store an existing file like storefile, without reading it when possible.
+        With delete the file is hard linked into the store and then removed from its source location,
+        so only directory entries change. A copy is made when the store is on another file system,
+        when the file system has no hard links, or when the source is kept, as later changes to the
+        source would otherwise change the stored file as well."""
+    if fsync not in FSYNC_POLICIES:
+        raise AS2Error(u'Invalid fsync policy "%(fsync)s"', {'fsync': fsync})
+    if archive:
+        targetdir = join(targetdir, time.strftime('%Y%m%d'))
+    dirshouldbethere(targetdir)
+    absfilename = None
+    if delete and hasattr(os, 'link'):
+        try:
+            absfilename = _link_unique(source, targetdir, filename)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                raise
+    if absfilename is None:
+        tmp_fd, tmp_filename = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=targetdir)
+        try:
+            with os.fdopen(tmp_fd, 'wb') as sfile:
+                with open(source, 'rb') as sourcefile:
+                    shutil.copyfileobj(sourcefile, sfile, 1024 * 1024)
+                if fsync == 'always':
+                    sfile.flush()
+                    os.fsync(sfile.fileno())
+            shutil.copystat(source, tmp_filename)
+            absfilename = _link_unique(tmp_filename, targetdir, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+    elif fsync == 'always':
+        fd = os.open(absfilename, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    if delete:
+        os.remove(source)
+    if fsync == 'always':
+        _fsync_dir(targetdir)
+    elif fsync == 'batch':
+        _add_pending(absfilename)
+    return absfilename
+
+
+class StoreWriter(object):
+    """ Store a file that arrives in chunks like storefile, without holding it in memory. The SHA-256 digest
+        of the content is computed while it is written. Close returns the stored file, abort drops it."""
+
+    def __init__(self, targetdir, filename, archive, fsync='always'):
+        if fsync not in FSYNC_POLICIES:
+            raise AS2Error(u'Invalid fsync policy "%(fsync)s"', {'fsync': fsync})
+        if archive:
+            targetdir = join(targetdir, time.strftime('%Y%m%d'))
+        dirshouldbethere(targetdir)
+        self.targetdir = targetdir
+        self.filename = filename
+        self.fsync = fsync
+        self.size = 0
+        self.hash = hashlib.sha256()
+        tmp_fd, self.tmp_filename = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=targetdir)
+        self.file = os.fdopen(tmp_fd, 'wb')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        try:
+            if self.fsync == 'always':
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.file.close()
+            os.chmod(self.tmp_filename, 0o666 & ~_umask)
+            absfilename = _link_unique(self.tmp_filename, self.targetdir, self.filename)
+        finally:
+            self.abort()
+        if self.fsync == 'always':
+            _fsync_dir(self.targetdir)
+        elif self.fsync == 'batch':
+            _add_pending(absfilename)
+        return absfilename
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_filename):
+            os.remove(self.tmp_filename)
+
+
+def syncstoredfiles(all_threads=False):
+    """ fsync the files the calling thread stored with the 'batch' policy since its last call, along with their
+        directories. Each thread syncs only its own files, so that it acknowledges them once they are durable
+        without waiting for the files of other requests. At exit the files of all threads are synced."""
+    with _fsync_lock:
+        if all_threads:
+            filenames = set().union(*_fsync_pending.values())
+            _fsync_pending.clear()
+        else:
+            filenames = _fsync_pending.pop(thread.get_ident(), ())
+    directories = set()
+    for filename in filenames:
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            # File has already been moved or deleted, nothing left to sync
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        directories.add(os.path.dirname(filename))
+    for directory in directories:
+        _fsync_dir(directory)
+
+
+def _add_pending(filename):
+    with _fsync_lock:
+        _fsync_pending.setdefault(thread.get_ident(), set()).add(filename)
+
+
+def _link_unique(source, targetdir, filename):
+    """ Link source into targetdir as filename, or under a unique variant of it when that name is taken."""
     absfilename = join(targetdir, filename)
-    sfile = open(absfilename, 'wb')
-    sfile.write(content)
-    sfile.close()
+    while not _link_noclobber(source, absfilename):
+        # Time of day keeps the names readable, the random part makes them unique
+        absfilename = join(targetdir, '%s_%s_%s%s' % (os.path.splitext(filename)[0],
+                                                      time.strftime('%H%M%S'),
+                                                      uuid.uuid4().hex[:8],
+                                                      os.path.splitext(filename)[1]))
     return absfilename
+
+
+def _link_noclobber(source, target):
+    """ Atomically give source the name target, return False if target already exists."""
+    try:
+        if hasattr(os, 'link'):
+            os.link(source, target)
+        else:
+            # os.rename does not replace an existing file on windows
+            os.rename(source, target)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return False
+        raise
+    return True
+
+
+def _fsync_dir(path):
+    """ fsync a directory so that the names of the files created in it are durable, not possible on windows."""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Files written with the 'batch' fsync policy that still need to be synced, by the thread that stored them
+_fsync_pending = {}
+_fsync_lock = threading.Lock()
+atexit.register(syncstoredfiles, True)
+
+# mkstemp creates files readable by the owner only, stored files get the usual permissions
+_umask = os.umask(0)
+os.umask(_umask)
  
 # **********************************************************/**
 # ************************MIME Helper Functions***********************/**
@@ -255,69 +449,18 @@ def canonicalize(msg):
 # **********************************************************/**
 
 
-# Classes that define the ASN.1 structure for building  smime compressed message
-class CompressedDataAttr(univ.Sequence):
-    componentType = namedtype.NamedTypes(
-        namedtype.NamedType('compressionAlgorithm', univ.ObjectIdentifier()),
-    )
-
-
-class Content(univ.OctetString):
-    tagSet = univ.OctetString.tagSet.tagExplicitly(
-        tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0)
-    )
-
-
-class CompressedDataPayload(univ.Sequence):
-    componentType = namedtype.NamedTypes(
-        namedtype.NamedType('content-type', univ.ObjectIdentifier()),
-        namedtype.NamedType('content', Content()),
-    )
-
-
-class CompressedData(univ.Sequence):
-    tagSet = univ.Sequence.tagSet.tagExplicitly(
-        tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0)
-    )
-    componentType = namedtype.NamedTypes(
-        namedtype.NamedType('version', univ.Integer()),
-        namedtype.NamedType('attributes', CompressedDataAttr()),
-        namedtype.NamedType('payload', CompressedDataPayload()),
-    )
-
-
-class CompressedDataMain(univ.Sequence):
-    componentType = namedtype.NamedTypes(
-        namedtype.NamedType('id-ct-compressedData', univ.ObjectIdentifier()),
-        namedtype.NamedType('compressedData', CompressedData()),
-    )
-
-
 def compress_payload(payload):
-    cdata_attr = CompressedDataAttr()
-    cdata_attr.setComponentByName('compressionAlgorithm', (1, 2, 840, 113549, 1, 9, 16, 3, 8))
-    cdata_payload = CompressedDataPayload()
-    cdata_payload.setComponentByName('content-type', (1, 2, 840, 113549, 1, 7, 1))
-    cdata_payload.setComponentByName('content',
-                                     Content(univ.OctetString(hexValue=zlib.compress(payload).encode('hex'))))
-    cdata = CompressedData()
-    cdata.setComponentByName('version', 0)
-    cdata.setComponentByName('attributes', cdata_attr)
-    cdata.setComponentByName('payload', cdata_payload)
-    cdata_main = CompressedDataMain()
-    cdata_main.setComponentByName('id-ct-compressedData', (1, 2, 840, 113549, 1, 9, 16, 1, 9))
-    cdata_main.setComponentByName('compressedData', cdata)
-    return encoder.encode(cdata_main, defMode=False).encode('base64')
+    from . import compression
+    return compression.compress(payload)
 
 
 def decompress_payload(payload):
-    decoded_content, substrate = decoder.decode(payload, asn1Spec=CompressedDataMain())
-    compressed_content = decoded_content.getComponentByName('compressedData').getComponentByName('payload').\
-        getComponentByName('content')
-    return zlib.decompress(compressed_content.asOctets())
+    from . import compression
+    return compression.decompress(payload)
 
 
 def encrypt_payload(payload, key, cipher):
+    from M2Crypto import BIO, SMIME, X509
     encrypter = SMIME.SMIME()
     certificate = X509.X509_Stack()
     certificate.push(X509.load_cert(key))
@@ -330,23 +473,21 @@ def encrypt_payload(payload, key, cipher):
 
 
 def decrypt_payload(payload, key, passphrase):
-    global key_pass
-    key_pass = passphrase
+    from M2Crypto import BIO, SMIME
     privkey = SMIME.SMIME()
-    privkey.load_key(key, callback=get_key_passphrase)
+    privkey.load_key(key, callback=get_key_passphrase(passphrase))
     # Load the encrypted data.
     p7, data = SMIME.smime_load_pkcs7_bio(BIO.MemoryBuffer(payload))
     return privkey.decrypt(p7)
 
 
 def sign_payload(data, key, passphrase):
-    global key_pass
-    key_pass = passphrase
+    from M2Crypto import BIO, SMIME
     mic_alg, signature = None, None
 
     # Sign the message with the key provided
     signer = SMIME.SMIME()
-    signer.load_key(key, callback=get_key_passphrase)
+    signer.load_key(key, callback=get_key_passphrase(passphrase))
     sign = signer.sign(BIO.MemoryBuffer(data), SMIME.PKCS7_DETACHED)
     out = BIO.MemoryBuffer()
     buf = BIO.MemoryBuffer(data)
@@ -365,6 +506,7 @@ def sign_payload(data, key, passphrase):
 
 
 def verify_payload(msg, raw_sig, cert, ca_cert, verify_cert):
+    from M2Crypto import BIO, SMIME, X509
     # Load the public certificate of the signer
     signer = SMIME.SMIME()
     signer_key = X509.X509_Stack()
@@ -391,8 +533,9 @@ def verify_payload(msg, raw_sig, cert, ca_cert, verify_cert):
         signer.verify(p7, data_bio, SMIME.PKCS7_NOVERIFY)
 
 
-def get_key_passphrase(self):
-    return key_pass
+def get_key_passphrase(passphrase):
+    """ Return the callback that hands the passphrase to M2Crypto, without shared state so threads can sign at once """
+    return lambda *args: passphrase
 
 
 def check_binary_sig(signature, boundary, content):
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import subprocess
+import threading
+import time
+import Queue
+from django import db
+from django.utils.translation import ugettext as _
+
+from . import as2utils
+from . import logevents
+from . import pyas2init
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+class CommandRunner(object):
+    """ Runs the post send and post receive commands of the partners on a bounded pool of worker threads.
+        Commands are queued while all workers are busy, killed when they run longer than the timeout
+        and their exit code and duration are logged on the message.
+        Without workers the commands are run in the calling thread."""
+
+    def __init__(self, workers, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, message_id, command):
+        """ Queue the command for the message, start the worker threads on first use """
+        if not self.workers:
+            self.run(message_id, command)
+            return
+        with self.lock:
+            if not self.threads:
+                for __ in range(self.workers):
+                    thread = threading.Thread(target=self._work)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+        self.queue.put((message_id, command))
+
+    def wait(self):
+        """ Block until all queued commands have finished """
+        if self.threads:
+            self.queue.join()
+
+    def run(self, message_id, command):
+        """ Run the command, wait for it to finish and log the result """
+        from . import models
+        start = time.time()
+        try:
+            process = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            pyas2init.logger.error('%s "%s": %s' % (_('Failed to start command'), command, e))
+            models.Log.add(message_id, 'E', logevents.COMMAND_START_FAILED, command=command, error=e)
+            return
+
+        killed = []
+        timer = None
+        if self.timeout:
+            def kill():
+                killed.append(True)
+                process.kill()
+            timer = threading.Timer(self.timeout, kill)
+            timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            if timer:
+                timer.cancel()
+        duration = time.time() - start
+
+        if output:
+            pyas2init.logger.debug('Output of command "%s":\n%s' % (command, output))
+        if killed:
+            status, event = 'E', logevents.COMMAND_KILLED
+            params = {'command': command, 'timeout': self.timeout}
+        elif process.returncode:
+            status, event = 'E', logevents.COMMAND_FAILED
+            params = {'command': command, 'code': process.returncode, 'duration': round(duration, 1)}
+        else:
+            status, event = 'S', logevents.COMMAND_FINISHED
+            params = {'command': command, 'code': process.returncode, 'duration': round(duration, 1)}
+        info = _(logevents.TEMPLATES[event]) % params
+        if status == 'E':
+            pyas2init.logger.error(info)
+        else:
+            pyas2init.logger.info(info)
+        models.Log.add(message_id, status, event, **params)
+
+    def _work(self):
+        while True:
+            message_id, command = self.queue.get()
+            try:
+                # The worker threads log on connections of their own, drop those that are broken or too old
+                db.close_old_connections()
+                self.run(message_id, command)
+            except Exception:
+                pyas2init.logger.error(_(u'Error while running command "%(command)s":\n%(txt)s') %
+                                       {'command': command, 'txt': as2utils.txtexc()})
+            finally:
+                db.close_old_connections()
+                self.queue.task_done()
+
+
+def submit(message_id, command):
+    """ Run the command for the message on the process wide command runner """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = CommandRunner(pyas2init.gsettings['post_cmd_workers'], pyas2init.gsettings['post_cmd_timeout'])
+    _runner.submit(message_id, command)
+
+
+def wait():
+    """ Wait for the commands submitted by this process, short lived processes call this before exiting """
+    if _runner is not None:
+        _runner.wait()
+
+
+atexit.register(wait)
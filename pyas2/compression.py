@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+from pyasn1.type import univ, namedtype, tag
+from pyasn1.codec.ber import encoder, decoder
+
+# The compressed data content type of RFC 3274, as2utils imports this module when a payload is compressed
+# or decompressed, processes that handle no compressed messages do not load pyasn1.
+
+
+# Classes that define the ASN.1 structure for building  smime compressed message
+class CompressedDataAttr(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('compressionAlgorithm', univ.ObjectIdentifier()),
+    )
+
+
+class Content(univ.OctetString):
+    tagSet = univ.OctetString.tagSet.tagExplicitly(
+        tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0)
+    )
+
+
+class CompressedDataPayload(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('content-type', univ.ObjectIdentifier()),
+        namedtype.NamedType('content', Content()),
+    )
+
+
+class CompressedData(univ.Sequence):
+    tagSet = univ.Sequence.tagSet.tagExplicitly(
+        tag.Tag(tag.tagClassContext, tag.tagFormatSimple, 0)
+    )
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('version', univ.Integer()),
+        namedtype.NamedType('attributes', CompressedDataAttr()),
+        namedtype.NamedType('payload', CompressedDataPayload()),
+    )
+
+
+class CompressedDataMain(univ.Sequence):
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('id-ct-compressedData', univ.ObjectIdentifier()),
+        namedtype.NamedType('compressedData', CompressedData()),
+    )
+
+
+def compress(payload):
+    cdata_attr = CompressedDataAttr()
+    cdata_attr.setComponentByName('compressionAlgorithm', (1, 2, 840, 113549, 1, 9, 16, 3, 8))
+    cdata_payload = CompressedDataPayload()
+    cdata_payload.setComponentByName('content-type', (1, 2, 840, 113549, 1, 7, 1))
+    cdata_payload.setComponentByName('content',
+                                     Content(univ.OctetString(hexValue=zlib.compress(payload).encode('hex'))))
+    cdata = CompressedData()
+    cdata.setComponentByName('version', 0)
+    cdata.setComponentByName('attributes', cdata_attr)
+    cdata.setComponentByName('payload', cdata_payload)
+    cdata_main = CompressedDataMain()
+    cdata_main.setComponentByName('id-ct-compressedData', (1, 2, 840, 113549, 1, 9, 16, 1, 9))
+    cdata_main.setComponentByName('compressedData', cdata)
+    return encoder.encode(cdata_main, defMode=False).encode('base64')
+
+
+def decompress(payload):
+    decoded_content, substrate = decoder.decode(payload, asn1Spec=CompressedDataMain())
+    compressed_content = decoded_content.getComponentByName('compressedData').getComponentByName('payload').\
+        getComponentByName('content')
+    return zlib.decompress(compressed_content.asOctets())
@@ -52,7 +52,7 @@ PYAS2 = {
     'MAXRETRIES': 5,
     'MAXARCHDAYS': 30,
     # DAEMON ###
-    'DAEMONPORT': 16388,
+    'DAEMONLEASE': 300,
     # Webserver ###
     'HOST': 'localhost',
     'PORT': 8890,
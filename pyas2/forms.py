@@ -3,6 +3,7 @@
 from django import forms
 
 from . import models, viewlib
+from .search import MATCH_CHOICES
 
 HIDDEN_INPUT = forms.widgets.HiddenInput
 
@@ -58,6 +59,9 @@ class MessageSearchForm(Select):
     status = forms.ChoiceField([], required=False)
     message_id = forms.CharField(required=False, label='Message ID', max_length=255)
     filename = forms.CharField(required=False, label='Payload Name', max_length=100)
+    search = forms.CharField(required=False, label='Search Text', max_length=100,
+                             help_text='Message ID, payload name, partner, organization or header value')
+    match = forms.ChoiceField(MATCH_CHOICES, required=False, initial='contains')
 
     def __init__(self, *args, **kwargs):
         super(MessageSearchForm, self).__init__(*args, **kwargs)
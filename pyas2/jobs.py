@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import json
+import os
+import socket
+import threading
+from datetime import timedelta
+from multiprocessing import Process
+from django import db
+from django.core import management
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from . import as2utils
+from . import logevents
+from . import models
+from . import pyas2init
+from . import search
+
+# Commands that can be submitted as jobs
+COMMANDS = ('sendas2message', 'sendasyncmdn', 'retryfailedas2comms')
+# Queued jobs a worker tries to claim at once, others may take the first ones
+CLAIM_BATCH = 10
+
+
+def node_name():
+    return '%s:%s' % (socket.gethostname(), os.getpid())
+
+
+def process_alive(pid):
+    if os.name == 'nt':
+        # Signal 0 would terminate the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def submit(command, *args, **kwargs):
+    """ Queue the command for the job server and return the job. Without the job server the job is started
+        at once in a new process, as the commands were run before. The lease_node keyword passes the claim of
+        a send daemon on the outbox file of a sendas2message job to the job, see end_lease. """
+    if command not in COMMANDS:
+        raise ValueError('Command %s can not be run as a job' % command)
+    job = models.Job.objects.create(command=command, args=json.dumps(args), lease_node=kwargs.get('lease_node'))
+    if not pyas2init.gsettings['job_server']:
+        # do not share the database connections with the new process
+        db.connections.close_all()
+        process = Process(target=run_claimed, args=(job.pk,))
+        process.start()
+    return job
+
+
+def end_lease(organization, partner, filename, node, sent):
+    """ End the claim of the send daemon node on the outbox file. A sent file is marked as handed over, the lease
+        on a file that was not sent expires at once and its outbox is listed again, so the file is sent again. """
+    outbox_file = models.OutboxFile.objects.filter(organization=organization, partner=partner,
+                                                   filename=os.path.basename(filename), node=node)
+    if sent:
+        outbox_file.update(lease_expires=None)
+    elif outbox_file.update(lease_expires=timezone.now()):
+        models.Outbox.objects.filter(organization=organization, partner=partner).update(mtime=None)
+
+
+def renew_lease(organization, partner, filename, node):
+    """ Extend the claim of the send daemon node on the outbox file, unless the claim has expired already """
+    now = timezone.now()
+    return models.OutboxFile.objects.filter(
+        organization=organization, partner=partner, filename=os.path.basename(filename), node=node,
+        lease_expires__gte=now).update(lease_expires=now + timedelta(seconds=pyas2init.gsettings['daemon_lease']))
+
+
+class LeaseHeartbeat(object):
+    """ Renews the claim on the outbox file of the job while it runs, so that a send that takes longer than the
+        lease is not taken over by another daemon. """
+
+    def __init__(self, job):
+        self.job = job
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if self.job.lease_node:
+            self.thread = threading.Thread(target=self._beat)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def _beat(self):
+        organization, partner, filename = self.job.arguments()[-3:]
+        try:
+            while not self.stopping.wait(pyas2init.gsettings['daemon_lease'] / 3.0):
+                try:
+                    renew_lease(organization, partner, filename, self.job.lease_node)
+                except Exception:
+                    pyas2init.logger.error(_(u'Error in renewing the lease of job %(job)s:\n%(txt)s'),
+                                           {'job': self.job.pk, 'txt': as2utils.txtexc()})
+        finally:
+            db.connection.close()
+
+
+def end_job_lease(job):
+    """ End the claim on the outbox file the job was submitted for, the file is the last argument """
+    if job.lease_node:
+        organization, partner, filename = job.arguments()[-3:]
+        end_lease(organization, partner, filename, job.lease_node, job.status == 'S')
+
+
+def claim(node):
+    """ Take the oldest queued job for the node, returns None when none is left """
+    queued = models.Job.objects.filter(status='Q').order_by('created').values_list('pk', flat=True)
+    for pk in queued[:CLAIM_BATCH]:
+        # The single update decides between workers racing for the same job
+        if models.Job.objects.filter(pk=pk, status='Q').update(status='R', node=node, started=timezone.now()):
+            return models.Job.objects.get(pk=pk)
+    return None
+
+
+def run(job):
+    """ Run the claimed job and record its result """
+    pyas2init.logger.info(_(u'Running job %(job)s: %(command)s'), {'job': job.pk, 'command': job})
+    try:
+        with LeaseHeartbeat(job):
+            management.call_command(job.command, *job.arguments())
+        job.status = 'S'
+    except Exception as e:
+        job.status = 'E'
+        job.error = logevents.param(e)
+        pyas2init.logger.error(_(u'Job %(job)s failed: %(txt)s'), {'job': job.pk, 'txt': as2utils.txtexc()})
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished'])
+    end_job_lease(job)
+
+
+def run_claimed(pk):
+    """ Claim and run the job in a process of its own """
+    models.Job.objects.filter(pk=pk, status='Q').update(status='R', node=node_name(), started=timezone.now())
+    run(models.Job.objects.get(pk=pk))
+
+
+class JobServer(object):
+    """ Runs the queued jobs in resident worker threads, the commands run in a process that has Django,
+        the settings and the database connections loaded already. Several job servers can share the queue. """
+
+    def __init__(self, workers, poll_interval, node=None):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.node = node or node_name()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def recover(self):
+        """ Mark the jobs left running by processes of this host that are gone as failed """
+        host = socket.gethostname()
+        count = 0
+        for job in models.Job.objects.filter(status='R', node__startswith=host + ':'):
+            if not process_alive(int(job.node.rsplit(':', 1)[1])):
+                if models.Job.objects.filter(pk=job.pk, status='R').update(
+                        status='E', error=_(u'Interrupted, the process running the job has stopped'),
+                        finished=timezone.now()):
+                    job.status = 'E'
+                    end_job_lease(job)
+                    count += 1
+        return count
+
+    def run_pending(self):
+        """ Run queued jobs until the queue is empty, returns the number of jobs run """
+        count = 0
+        while not self.stopping.is_set():
+            job = claim(self.node)
+            if job is None:
+                break
+            run(job)
+            count += 1
+        return count
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        try:
+            while not self.stopping.is_set():
+                try:
+                    # Idle workers write the search terms of the messages saved meanwhile
+                    if not self.run_pending() and not search.index_pending():
+                        self.stopping.wait(self.poll_interval)
+                except Exception:
+                    pyas2init.logger.error(_(u'Error in the job server:\n%(txt)s'), {'txt': as2utils.txtexc()})
+                    self.stopping.wait(self.poll_interval)
+        finally:
+            db.connection.close()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+import json
+import re
+from django.utils.translation import ugettext as _, ugettext_noop
+
+# Message log events, the log stores the code of the event with its parameters and the text
+# is rendered when the log is displayed. Codes are stored in the database, never reuse or renumber them.
+ERROR = 1
+INBOUND_RECEIVED = 2
+INBOUND_PROFILES = 3
+DECRYPTING = 4
+VERIFYING = 5
+DECOMPRESSING = 6
+MDN_NOT_REQUESTED = 7
+MDN_BUILDING = 8
+MDN_SIGNING = 9
+MDN_ASYNC_PENDING = 10
+MDN_SENT = 11
+BUILDING = 12
+COMPRESSING = 13
+SIGNING = 14
+ENCRYPTING = 15
+BUILT = 16
+ASYNC_MDN_REQUESTED = 17
+SEND_ERROR = 18
+SENT = 19
+SYNC_MDN_RECEIVED = 20
+TRANSFERRED_NO_MDN = 21
+MDN_UNSIGNED = 22
+MDN_VERIFYING = 23
+MDN_CHECKING = 24
+MDN_PROCESSED = 25
+MIC_FAILED = 26
+TRANSFERRED = 27
+SEND_FAILED = 28
+RETRIES_CANCELLED = 29
+ASYNC_MDN_PROCESSING = 30
+ASYNC_MDN_FAILED = 31
+SAVED = 32
+RETRIES_EXCEEDED = 33
+RESENDING_BUILT = 34
+ASYNC_MDN_SENT = 35
+ASYNC_MDN_SEND_FAILED = 36
+MDN_RETRIES_EXCEEDED = 37
+MDN_TIMEOUT = 38
+POST_SEND_COMMAND = 39
+POST_RECEIVE_COMMAND = 40
+COMMAND_START_FAILED = 41
+COMMAND_KILLED = 42
+COMMAND_FAILED = 43
+COMMAND_FINISHED = 44
+
+TEMPLATES = {
+    ERROR: ugettext_noop(u'%(error)s'),
+    INBOUND_RECEIVED: ugettext_noop(u'Processing incoming AS2 message'),
+    INBOUND_PROFILES: ugettext_noop(u'Message is for Organization <%(organization)s> from Partner <%(partner)s>'),
+    DECRYPTING: ugettext_noop(u'Decrypting the payload using private key %(key)s'),
+    VERIFYING: ugettext_noop(u'Message is signed, Verifying it using public key %(key)s'),
+    DECOMPRESSING: ugettext_noop(u'Decompressing the payload'),
+    MDN_NOT_REQUESTED: ugettext_noop(u'MDN not requested by partner, closing request.'),
+    MDN_BUILDING: ugettext_noop(u'Building the MDN response to the request'),
+    MDN_SIGNING: ugettext_noop(u'Signing the MDN using private key %(key)s'),
+    MDN_ASYNC_PENDING: ugettext_noop(u'Asynchronous MDN requested, setting status to pending'),
+    MDN_SENT: ugettext_noop(u'MDN created successfully and sent to partner'),
+    BUILDING: ugettext_noop(u'Build the AS2 message and header to send to the partner'),
+    COMPRESSING: ugettext_noop(u'Compressing the payload.'),
+    SIGNING: ugettext_noop(u'Signing the message using organization key %(key)s'),
+    ENCRYPTING: ugettext_noop(u'Encrypting the message using partner key %(key)s'),
+    BUILT: ugettext_noop(u'AS2 message has been built successfully, sending it to the partner'),
+    ASYNC_MDN_REQUESTED: ugettext_noop(u'ASYNC MDN requested.'),
+    SEND_ERROR: ugettext_noop(u'Message send failed with error %(error)s'),
+    SENT: ugettext_noop(u'AS2 message successfully sent to partner'),
+    SYNC_MDN_RECEIVED: ugettext_noop(u'Synchronous mdn received from partner'),
+    TRANSFERRED_NO_MDN: ugettext_noop(u'No MDN needed, File Transferred successfully to the partner'),
+    MDN_UNSIGNED: ugettext_noop(u'Expected signed MDN but unsigned MDN returned'),
+    MDN_VERIFYING: ugettext_noop(u'Verifying the signed MDN with partner key %(key)s'),
+    MDN_CHECKING: ugettext_noop(u'Checking the MDN for status of the message'),
+    MDN_PROCESSED: ugettext_noop(u'Message has been successfully processed, verifying the MIC if present.'),
+    MIC_FAILED: ugettext_noop(u'Message Integrity check failed, please validate message content with your partner'),
+    TRANSFERRED: ugettext_noop(u'File Transferred successfully to the partner'),
+    SEND_FAILED: ugettext_noop(u'Failed to send message, error is %(error)s'),
+    RETRIES_CANCELLED: ugettext_noop(u'User cancelled further retires for this message'),
+    ASYNC_MDN_PROCESSING: ugettext_noop(u'Processing incoming asynchronous mdn'),
+    ASYNC_MDN_FAILED: ugettext_noop(u'Failed to proceed AS2 ASYNC MDN: %(error)s'),
+    SAVED: ugettext_noop(u'Message saved successfully to %(filename)s'),
+    RETRIES_EXCEEDED: ugettext_noop(u'Message exceeded maximum retries, marked as error'),
+    RESENDING_BUILT: ugettext_noop(u'Resending the AS2 message built for the last send'),
+    ASYNC_MDN_SENT: ugettext_noop(u'Successfully sent asynchronous mdn to partner'),
+    ASYNC_MDN_SEND_FAILED: ugettext_noop(u'Failed to send asynchronous mdn to partner, error is %(error)s'),
+    MDN_RETRIES_EXCEEDED: ugettext_noop(u'MDN exceeded maximum retries, marked as error'),
+    MDN_TIMEOUT: ugettext_noop(u'Failed to receive asynchronous MDN within the threshold limit'),
+    POST_SEND_COMMAND: ugettext_noop(u'Executing post send command: "%(command)s"'),
+    POST_RECEIVE_COMMAND: ugettext_noop(u'Executing post receive command: "%(command)s"'),
+    COMMAND_START_FAILED: ugettext_noop(u'Failed to start command "%(command)s": %(error)s'),
+    COMMAND_KILLED: ugettext_noop(u'Command "%(command)s" killed after timeout of %(timeout)s seconds'),
+    COMMAND_FAILED: ugettext_noop(
+        u'Command "%(command)s" failed with exit code %(code)s after %(duration).1f seconds'),
+    COMMAND_FINISHED: ugettext_noop(
+        u'Command "%(command)s" finished with exit code %(code)s after %(duration).1f seconds'),
+}
+
+# Longest text parameter that is stored, like the former text column
+MAX_PARAM_LENGTH = 255
+# Texts of the logs written before the events that do not follow the template of their event, by their start
+LEGACY_PREFIXES = {
+    INBOUND_RECEIVED: u'Processing incoming AS2 message: ',
+}
+PLACEHOLDER = re.compile(r'%\((\w+)\)(\.1f|s)')
+
+
+def param(value):
+    """ Return the value as it is stored in the parameters of a log """
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, unicode):
+        try:
+            value = unicode(value)
+        except UnicodeError:
+            value = str(value).decode('utf-8', 'replace')
+    return value[:MAX_PARAM_LENGTH]
+
+
+def dump_params(params):
+    if not params:
+        return None
+    return json.dumps(dict((key, param(value)) for key, value in params.items()), separators=(',', ':'))
+
+
+def render(event, params):
+    """ Return the translated text of the event with its stored parameters """
+    template = TEMPLATES.get(event)
+    if template is None:
+        return _(u'Unknown log event %s') % event
+    params = json.loads(params) if params else {}
+    try:
+        return _(template) % params
+    except (KeyError, TypeError, ValueError):
+        return u'%s %s' % (template, params)
+
+
+def pattern(event):
+    """ Return the regular expression matching the untranslated text of the event """
+    template = TEMPLATES[event]
+    result, end = u'', 0
+    for match in PLACEHOLDER.finditer(template):
+        result += re.escape(template[end:match.start()])
+        result += u'(?P<%s>%s)' % (match.group(1), r'-?\d+\.\d' if match.group(2) == '.1f' else '.*')
+        end = match.end()
+    result += re.escape(template[end:])
+    return re.compile(u'^%s$' % result, re.DOTALL)
+
+
+def parse(event, text):
+    """ Return the parameters of the event in a log text written before the events, None if it does not match """
+    match = pattern(event).match(text)
+    if not match:
+        return None
+    params = match.groupdict()
+    for key in ('code', 'timeout'):
+        if key in params and params[key].lstrip('-').isdigit():
+            params[key] = int(params[key])
+    if 'duration' in params:
+        params['duration'] = float(params['duration'])
+    return params
+
+
+def compact(log_model, batch_size=1000):
+    """ Replace the texts of the existing logs of the log model by their events, returns the number of logs
+    converted. Free texts of errors and texts that match no event are kept as they are. """
+    count = 0
+    logs = log_model.objects.filter(event__isnull=True)
+    for event in sorted(TEMPLATES):
+        template = TEMPLATES[event]
+        if event == ERROR:
+            continue
+        if event in LEGACY_PREFIXES:
+            count += logs.filter(text__startswith=LEGACY_PREFIXES[event]).update(event=event, text=None)
+            continue
+        first = PLACEHOLDER.search(template)
+        if not first:
+            # Texts without parameters are converted by a single update
+            count += logs.filter(text=template).update(event=event, text=None)
+            continue
+        last_pk = 0
+        while True:
+            batch = list(logs.filter(text__startswith=template[:first.start()], pk__gt=last_pk)
+                         .order_by('pk').values_list('pk', 'text')[:batch_size])
+            if not batch:
+                break
+            for pk, text in batch:
+                params = parse(event, text)
+                if params is not None:
+                    count += logs.filter(pk=pk).update(event=event, params=dump_params(params), text=None)
+            last_pk = batch[-1][0]
+    return count
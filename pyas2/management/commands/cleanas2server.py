@@ -3,9 +3,11 @@ from django.utils.translation import ugettext as _
 from datetime import timedelta
 from django.utils import timezone
 from pyas2 import models
+from pyas2 import partitions
 from pyas2 import pyas2init
 import os
 import glob
+import time
 
 
 class Command(BaseCommand):
@@ -18,6 +20,11 @@ class Command(BaseCommand):
             pyas2init.gsettings['max_arch_days'])
         max_archive_ts = int(max_archive_dt.strftime("%s"))
 
+        # Partitioned tables drop the months that are past the max archive days at once
+        for partition in partitions.drop_partitions(max_archive_dt):
+            pyas2init.logger.info(_(u'Dropped partition {}'.format(partition)))
+        partitions.create_partitions(partitions.FUTURE_MONTHS)
+
         pyas2init.logger.info(
             _(u'Delete all DB Objects older than max archive days'))
         old_message = models.Message.objects.filter(
@@ -32,6 +39,23 @@ class Command(BaseCommand):
                 message.mdn.delete()
             message.delete()
 
+        pyas2init.logger.info(
+            _(u'Delete all outbox file records older than max archive days'))
+        models.OutboxFile.objects.filter(timestamp__lt=max_archive_dt).delete()
+
+        pyas2init.logger.info(
+            _(u'Delete all finished jobs older than max archive days'))
+        models.Job.objects.filter(status__in=['S', 'E'], created__lt=max_archive_dt).delete()
+
+        pyas2init.logger.info(
+            _(u'Delete the uploads left behind by interrupted requests'))
+        staging_dir = pyas2init.gsettings['upload_staging_dir']
+        if os.path.isdir(staging_dir):
+            for staged in os.listdir(staging_dir):
+                filename = os.path.join(staging_dir, staged)
+                if os.path.getmtime(filename) < time.time() - 24 * 3600:
+                    os.remove(filename)
+
         pyas2init.logger.info(
             _(u'Delete all logs older than max archive days'))
         log_folder = os.path.join(pyas2init.gsettings['log_dir'], 'pyas2*')
@@ -49,7 +73,8 @@ class Command(BaseCommand):
             pyas2init.gsettings['payload_send_store'],
             pyas2init.gsettings['payload_receive_store'],
             pyas2init.gsettings['mdn_send_store'],
-            pyas2init.gsettings['mdn_receive_store']
+            pyas2init.gsettings['mdn_receive_store'],
+            pyas2init.gsettings['raw_send_store']
         ]
         for archive_folder in archive_folders:
             for (dir_path, dir_names, arch_files) in os.walk(archive_folder):
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from pyas2 import partitions, pyas2init
+
+
+class Command(BaseCommand):
+    help = _(u'Creates the monthly partitions of the message and log tables for the months to come, '
+             u'on PostgreSQL only')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--convert',
+            action='store_true',
+            dest='convert',
+            default=False,
+            help=_(u'Convert the message and log tables to partitioned tables first')
+        )
+        parser.add_argument(
+            '--months',
+            type=int,
+            dest='months',
+            default=partitions.FUTURE_MONTHS,
+            help=_(u'Number of months after the current month to create partitions for')
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help=_(u'Print the statements of --convert instead of running them')
+        )
+
+    def handle(self, *args, **options):
+        connection = partitions.get_connection()
+        if not partitions.supported(connection):
+            raise CommandError(_(u'Partitioning needs PostgreSQL 11 or later, the pyas2 database is %s') %
+                               connection.vendor)
+        if options['convert'] and options['dry_run']:
+            for statement in partitions.convert(options['months'], dry_run=True):
+                self.stdout.write('%s;' % statement)
+            return
+        if options['convert']:
+            partitions.convert(options['months'])
+        names = partitions.create_partitions(options['months'])
+        if not names:
+            raise CommandError(_(u'The message and log tables are not partitioned, run with --convert'))
+        pyas2init.logger.info(_(u'Partitions %s are in place') % ', '.join(names))
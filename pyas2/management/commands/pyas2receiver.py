@@ -16,6 +16,7 @@ class Command(BaseCommand):
             from cherrypy import wsgiserver
         except Exception:
             raise ImportError(_('Dependency failure: cherrypy library is needed to start pyas2 %s' % pyas2init.gsettings['server']))
+        pyas2init.startinfo()
 
         cherrypy.config.update({
             'global': {
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext as _
+
+from pyas2 import models, pyas2init, search
+
+
+class Command(BaseCommand):
+    help = _(u'Rebuilds the search index of the messages, not needed on PostgreSQL')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pending',
+            action='store_true',
+            dest='pending',
+            default=False,
+            help=_(u'Only index the messages saved since they were last indexed')
+        )
+
+    def handle(self, *args, **options):
+        if search.uses_trigram():
+            pyas2init.logger.info(_(u'The messages are searched with trigram indexes, nothing to rebuild'))
+            return
+        if options['pending']:
+            count = 0
+            while True:
+                indexed = search.index_pending()
+                if not indexed:
+                    break
+                count += indexed
+            pyas2init.logger.info(_(u'Search index updated for %d messages') % count)
+            return
+        pyas2init.logger.info(_(u'Rebuilding the search index of the messages'))
+        count = 0
+        for message in models.Message.objects.select_related('payload').iterator():
+            models.Message.objects.filter(pk=message.pk, search_pending=True).update(search_pending=False)
+            search.index_message(message)
+            count += 1
+        pyas2init.logger.info(_(u'Search index rebuilt for %d messages') % count)
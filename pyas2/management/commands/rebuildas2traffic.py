@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.db.models import Min
+from django.utils.translation import ugettext as _
+
+from pyas2 import models, pyas2init
+
+
+class Command(BaseCommand):
+    help = _(u'Rebuilds the partner traffic statistics of the dashboard from the messages in the database, '
+             u'from the oldest message left by cleanas2server')
+
+    def handle(self, *args, **options):
+        # The statistics of the hours whose messages cleanas2server has deleted are kept
+        oldest = models.Message.objects.aggregate(oldest=Min('timestamp'))['oldest']
+        if oldest is None:
+            pyas2init.logger.info(_(u'No messages, the partner traffic statistics are kept as they are'))
+            return
+        start = models.PartnerTraffic.hour_of(oldest)
+        if start < oldest and models.PartnerTraffic.objects.filter(hour__lte=start).exists():
+            # The earlier messages of the hour of the oldest message may have been deleted
+            start += timedelta(hours=1)
+        pyas2init.logger.info(_(u'Rebuilding the partner traffic statistics from %s') % start)
+        totals = {}
+        messages = models.Message.objects.filter(
+            status__in=models.PartnerTraffic.FINAL_STATUS, timestamp__gte=start).select_related('payload').iterator()
+        for message in messages:
+            key = (message.partner_id, message.direction, message.status,
+                   models.PartnerTraffic.hour_of(message.timestamp))
+            total = totals.setdefault(key, [0, 0])
+            total[0] += 1
+            total[1] += message.payload_size()
+
+        with transaction.atomic(using=router.db_for_write(models.PartnerTraffic)):
+            models.PartnerTraffic.objects.filter(hour__gte=start).delete()
+            models.PartnerTraffic.objects.bulk_create(
+                (models.PartnerTraffic(partner=partner, direction=direction, status=status, hour=hour,
+                                       messages=count, bytes=size)
+                 for (partner, direction, status, hour), (count, size) in totals.items()),
+                batch_size=500)
+        pyas2init.logger.info(_(u'Partner traffic statistics rebuilt from %d hourly totals') % len(totals))
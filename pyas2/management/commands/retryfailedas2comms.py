@@ -3,7 +3,7 @@
 from django.core.management.base import BaseCommand
 from django.utils.translation import ugettext as _
 
-from pyas2 import models, pyas2init, as2lib, as2utils
+from pyas2 import models, pyas2init, as2lib, as2utils, cmdrunner, logevents, rawarchive
 
 
 class Command(BaseCommand):
@@ -22,24 +22,31 @@ class Command(BaseCommand):
             # if max retries has exceeded then mark message status as error
             if failed_msg.retries > pyas2init.gsettings['max_retries']:
                 failed_msg.status = 'E'
-                models.Log.objects.create(message=failed_msg,
-                                          status='E',
-                                          text=_(u'Message exceeded maximum retries, marked as error'))
-                failed_msg.save()
+                models.Log.add(failed_msg, 'E', logevents.RETRIES_EXCEEDED)
+                failed_msg.save(update_fields=['status', 'retries'])
                 continue
+            failed_msg.save(update_fields=['retries'])
 
             pyas2init.logger.info(_(u'Retrying send of message with ID %s' % failed_msg))
             try:
-                # Build and resend the AS2 message
-                payload = as2lib.build_message(failed_msg)
-                as2lib.send_message(failed_msg, payload)
+                raw_file = as2lib.built_message(failed_msg)
+                if raw_file:
+                    # Resend the AS2 message as it was built for the last send
+                    models.Log.add(failed_msg, 'S', logevents.RESENDING_BUILT)
+                    with open(raw_file, 'rb') as payload:
+                        as2lib.send_message(failed_msg, payload)
+                else:
+                    # Build and resend the AS2 message
+                    payload = as2lib.build_message(failed_msg)
+                    as2lib.send_message(failed_msg, payload)
             except Exception, e:
                 # In case of any errors mark message as failed and send email if enabled
                 failed_msg.status = 'E'
-                models.Log.objects.create(message=failed_msg,
-                                          status='E',
-                                          text=_(u'Failed to send message, error is %s' % e))
-                failed_msg.save()
+                models.Log.add(failed_msg, 'E', logevents.SEND_FAILED, error=e)
+                failed_msg.save(update_fields=['status'])
                 # Send mail here
                 as2utils.senderrorreport(failed_msg, _(u'Failed to send message, error is %s' % e))
+        # Let the post send commands and the raw archive finish before the process exits
+        cmdrunner.wait()
+        rawarchive.wait()
         pyas2init.logger.info(_(u'Successfully processed all failed outbound messages'))
@@ -1,15 +1,19 @@
-from django.core import management
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.utils import timezone
 from django.utils.translation import ugettext as _
+from pyas2 import jobs
 from pyas2 import models
 from pyas2 import pyas2init
 from pyas2 import as2utils
 import time
-import atexit
 import socket
 import os
 import sys
 import threading
+import collections
+from datetime import timedelta
 
 if os.name == 'nt':
     try:
@@ -43,7 +47,7 @@ if os.name == 'nt':
         # want to detect: new file,  move, drop, rename, write/append to file
         # only FILE_NOTIFY_CHANGE_LAST_WRITE: copy yes, no move
         # for rec=True: event that subdirectory itself is updated (for file deletes in dir)
-        while True:
+        while dir_watch['active']:
             results = win32file.ReadDirectoryChangesW(hDir,
                                                       8192,  # buffer size was 1024, do not want to miss anything
                                                       False,  # recursive
@@ -64,17 +68,23 @@ if os.name == 'nt':
                     pyas2init.logger.debug(u'Event: %(action)s %(filename)s',
                                            {'action': ACTIONS.get(action, "Unknown"), 'filename': filename})
                 for action, filename in results:
+                    if not dir_watch['active']:
+                        # the watch was removed while waiting for changes
+                        break
                     if action in [1, 3, 5]:  # and fnmatch.fnmatch(filename, dir_watch['filemask']):
                         # ~ if dir_watch['rec'] and os.sep in filename:
                         # ~ continue
                         full_filename = os.path.join(dir_watch['path'], filename)
                         if os.path.isfile(full_filename):
                             cond.acquire()
+                            if not tasks:
+                                # the main thread drains the tasks on each wakeup, only wake it for the first one
+                                cond.notify()
                             tasks.add((dir_watch['organization'], dir_watch['partner'], full_filename))
-                            cond.notify()
                             cond.release()
                             # break       #the route is triggered, do not need to trigger more often
                             # end of windows-specific ##############################################
+        win32file.CloseHandle(hDir)
 else:
     # linux specific ###########################################################################################
     try:
@@ -96,8 +106,8 @@ else:
             wd=<int>     #the watch
         """
 
-        def my_init(self, logger, dir_watch_data, cond, tasks):
-            self.dir_watch_data = dir_watch_data
+        def my_init(self, logger, watches, cond, tasks):
+            self.watches = watches
             self.cond = cond
             self.tasks = tasks
             self.logger = logger
@@ -113,118 +123,320 @@ else:
             # ~ logger.info(u'new directory!!"%s %s".',event.)
             # ~ print 'event detected',event.name,event.maskname, event.wd
             if not event.dir:
-                for dir_watch in self.dir_watch_data:
-                    if event.pathname.startswith(dir_watch['path']):
-                        # if fnmatch.fnmatch(event.name, dir_watch['filemask']):
-                        self.cond.acquire()
-                        self.tasks.add((dir_watch['organization'], dir_watch['partner'], event.pathname))
+                # route the event on its watch descriptor, the path check guards against reused descriptors
+                dir_watch = self.watches.get(event.wd)
+                if dir_watch and dir_watch['path'] == event.path:
+                    # if fnmatch.fnmatch(event.name, dir_watch['filemask']):
+                    self.cond.acquire()
+                    if not self.tasks:
+                        # the main thread drains the tasks on each wakeup, only wake it for the first one
                         self.cond.notify()
-                        self.cond.release()
-
-
-    def linux_event_handler(logger, dir_watch_data, cond, tasks):
-        watch_manager = pyinotify.WatchManager()
-        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY | pyinotify.IN_CREATE
-        for dir_watch in dir_watch_data:
-            logger.info(_(u'Watching directory %s' % dir_watch['path']))
-            watch_manager.add_watch(path=dir_watch['path'], mask=mask, rec=False, auto_add=True, do_glob=True)
-        handler = LinuxEventHandler(logger=logger, dir_watch_data=dir_watch_data, cond=cond, tasks=tasks)
-        notifier = pyinotify.Notifier(watch_manager, handler)
-        notifier.loop()
+                    self.tasks.add((dir_watch['organization'], dir_watch['partner'], event.pathname))
+                    self.cond.release()
         # end of linux-specific ##################################################################################
 
 
+def outboxes():
+    """ Return the outbox directories of all organization and partner combinations """
+    orgs = list(models.Organization.objects.values_list('as2_name', flat=True))
+    partners = list(models.Partner.objects.values_list('as2_name', flat=True))
+    dirs = {}
+    for partner in partners:
+        for org in orgs:
+            dirs[as2utils.join(pyas2init.gsettings['root_dir'], 'messages', partner, 'outbox', org)] = (org, partner)
+    return dirs
+
+
+def scan_outbox(dir_watch, tasks, force=False):
+    """ Add the files of the outbox to the tasks, unless the outbox did not change since it was last listed.
+        With force the outbox is listed anyway, for the files whose claim has expired. """
+    try:
+        mtime = os.stat(dir_watch['path']).st_mtime
+    except OSError:
+        return
+    outbox, created = models.Outbox.objects.get_or_create(organization=dir_watch['organization'],
+                                                          partner=dir_watch['partner'])
+    if outbox.mtime == mtime and not force:
+        return
+    filenames = set(f for f in os.listdir(dir_watch['path']) if os.path.isfile(as2utils.join(dir_watch['path'], f)))
+    for filename in filenames:
+        tasks.add((dir_watch['organization'], dir_watch['partner'], as2utils.join(dir_watch['path'], filename)))
+
+    # Forget the files that have left the outbox
+    seen = {}
+    gone = []
+    now = timezone.now()
+    for filename, pk, lease_expires in models.OutboxFile.objects.filter(
+            organization=dir_watch['organization'],
+            partner=dir_watch['partner']).values_list('filename', 'pk', 'lease_expires'):
+        seen[filename] = pk
+        # a file claimed by a running daemon may just have been moved to the send store
+        if filename not in filenames and (lease_expires is None or lease_expires < now):
+            gone.append(pk)
+    for i in range(0, len(gone), 500):
+        models.OutboxFile.objects.filter(pk__in=gone[i:i + 500]).delete()
+
+    # Only skip the next listing when every file in the outbox has been handed over
+    if not filenames - set(seen):
+        outbox.mtime = mtime
+        outbox.save(update_fields=['mtime'])
+
+
+def claim(task, node):
+    """ Claim the file for this daemon, return False when it is claimed by another daemon or has already been
+        handed over unchanged. A claim whose lease has expired is taken over. """
+    organization, partner, filename = task
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        pyas2init.logger.debug(u'File "%(filename)s" is gone.', {'filename': filename})
+        return False
+    now = timezone.now()
+    lease_expires = now + timedelta(seconds=pyas2init.gsettings['daemon_lease'])
+    try:
+        with transaction.atomic():
+            models.OutboxFile.objects.create(organization=organization,
+                                             partner=partner,
+                                             filename=os.path.basename(filename),
+                                             size=stat.st_size,
+                                             mtime=stat.st_mtime,
+                                             node=node,
+                                             lease_expires=lease_expires)
+        return True
+    except IntegrityError:
+        pass
+    # The single update decides between daemons racing for the same file
+    claimed = models.OutboxFile.objects.filter(
+        Q(lease_expires__lt=now) | ~Q(size=stat.st_size) | ~Q(mtime=stat.st_mtime),
+        organization=organization,
+        partner=partner,
+        filename=os.path.basename(filename)
+    ).update(size=stat.st_size, mtime=stat.st_mtime, node=node, lease_expires=lease_expires)
+    if not claimed:
+        pyas2init.logger.debug(u'File "%(filename)s" has already been claimed.', {'filename': filename})
+    return bool(claimed)
+
+
+def dispatch(tasks, node):
+    """ Submit sendas2message jobs for the files this daemon manages to claim, the jobs end the claims """
+    for task in tasks:
+        try:
+            if claim(task, node):
+                lijst = ['sendas2message', '--delete'] + list(task)
+                pyas2init.logger.info(u'Send as2 message with params "%(task)s".', {'task': lijst})
+                try:
+                    jobs.submit(*lijst, lease_node=node)
+                except Exception:
+                    jobs.end_lease(task[0], task[1], task[2], node, False)
+                    raise
+        except Exception as msg:
+            pyas2init.logger.info(u'Error in running task: "%(msg)s".', {'msg': msg})
+
+
+def file_state(filename):
+    """ Return the size and modification time of the file """
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime
+
+
+class BatchScheduler(object):
+    """ Holds the files of the outbox events until they are complete and hands them out in batches.
+        A file is ready when its size and modification time did not change for settle_time seconds.
+        Ready files are released when batch_size of them are waiting or when the oldest one has
+        waited max_wait seconds, so a steady flow of new files can not hold back the earlier ones."""
+
+    def __init__(self, settle_time, max_wait, batch_size):
+        self.settle_time = settle_time
+        self.max_wait = max_wait
+        self.batch_size = batch_size
+        self.pending = {}
+        self.ready = collections.OrderedDict()
+
+    def add(self, task, now):
+        if task in self.pending or task in self.ready:
+            return
+        try:
+            self.pending[task] = (file_state(task[2]), now + self.settle_time)
+        except OSError:
+            pyas2init.logger.debug(u'File "%(filename)s" is gone.', {'filename': task[2]})
+
+    def poll(self, now):
+        """ Check the files that are due and return the batches to dispatch """
+        for task, (state, due) in self.pending.items():
+            if due > now:
+                continue
+            try:
+                current = file_state(task[2])
+            except OSError:
+                del self.pending[task]
+                continue
+            if current == state:
+                del self.pending[task]
+                self.ready[task] = now
+            else:
+                self.pending[task] = (current, now + self.settle_time)
+        batches = []
+        while len(self.ready) >= self.batch_size or \
+                (self.ready and now - next(self.ready.itervalues()) >= self.max_wait):
+            batch = []
+            while self.ready and len(batch) < self.batch_size:
+                batch.append(self.ready.popitem(last=False)[0])
+            batches.append(batch)
+        return batches
+
+    def timeout(self, now):
+        """ Seconds until the next file is due, None when no file is waiting """
+        due = [due for state, due in self.pending.values()]
+        if self.ready:
+            due.append(next(self.ready.itervalues()) + self.max_wait)
+        if not due:
+            return None
+        return max(min(due) - now, 0)
+
+
+def renew_claims(node):
+    """ Extend the unexpired claims of this daemon, the files of its queued jobs are not taken over """
+    now = timezone.now()
+    return models.OutboxFile.objects.filter(node=node, lease_expires__gte=now).update(
+        lease_expires=now + timedelta(seconds=pyas2init.gsettings['daemon_lease']))
+
+
+def renew_claims_loop(node, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            renew_claims(node)
+        except Exception as msg:
+            pyas2init.logger.error(u'Error in renewing the claims: "%(msg)s".', {'msg': msg})
+
+
+def refresh_outboxes(watcher, interval):
+    """ Pick up organizations and partners added or removed while the daemon runs """
+    while True:
+        time.sleep(interval)
+        watcher.cond.acquire()
+        try:
+            had_tasks = bool(watcher.tasks)
+            watcher.refresh()
+            if watcher.tasks and not had_tasks:
+                watcher.cond.notify()
+        except Exception as msg:
+            pyas2init.logger.error(u'Error in refreshing the outboxes: "%(msg)s".', {'msg': msg})
+        finally:
+            watcher.cond.release()
+
+
+class OutboxWatcher(object):
+    """ Keeps the directory watches in line with the organizations and partners in the database """
+
+    def __init__(self, cond, tasks):
+        self.cond = cond
+        self.tasks = tasks
+        self.dir_watch_data = {}
+        self.watches = {}
+        if os.name != 'nt':
+            # for linux: one watch-thread, but multiple watches.
+            self.watch_manager = pyinotify.WatchManager()
+            handler = LinuxEventHandler(logger=pyas2init.logger, watches=self.watches, cond=cond, tasks=tasks)
+            notifier = pyinotify.Notifier(self.watch_manager, handler)
+            dir_watch_thread = threading.Thread(target=notifier.loop)
+            dir_watch_thread.daemon = True  # do not wait for thread when exiting
+            dir_watch_thread.start()
+
+    def refresh(self):
+        """ Add watches for new outboxes, remove the watches of deleted organizations and partners and list the
+            outboxes again that hold files to take over """
+        current = outboxes()
+        for path in set(self.dir_watch_data) - set(current):
+            self.remove(path)
+        watched = set(self.dir_watch_data)
+        for path in sorted(set(current) - watched):
+            self.add(path, *current[path])
+        if not self.dir_watch_data:
+            pyas2init.logger.warning(_(u'No partners have been configured!'))
+        self.rescan(watched)
+
+    def rescan(self, paths):
+        """ List the outboxes of the paths that hold files whose claim has expired, like the files of a daemon
+            that crashed, and the outboxes that are to be listed again, like those of a file whose job failed.
+            No event comes for these files. """
+        expired = set(models.OutboxFile.objects.filter(lease_expires__lt=timezone.now()).values_list(
+            'organization', 'partner').distinct())
+        unlisted = set(models.Outbox.objects.filter(mtime=None).values_list('organization', 'partner'))
+        for path in sorted(paths):
+            dir_watch = self.dir_watch_data[path]
+            outbox = (dir_watch['organization'], dir_watch['partner'])
+            if outbox in expired or outbox in unlisted:
+                scan_outbox(dir_watch, self.tasks, force=True)
+
+    def add(self, path, organization, partner):
+        as2utils.dirshouldbethere(path)
+        dir_watch = {'path': path, 'organization': organization, 'partner': partner, 'active': True}
+        pyas2init.logger.info(_(u'Watching directory %s' % path))
+        if os.name == 'nt':
+            # for windows: start a thread per directory watcher
+            dir_watch_thread = threading.Thread(target=windows_event_handler,
+                                                args=(pyas2init.logger, dir_watch, self.cond, self.tasks))
+            dir_watch_thread.daemon = True  # do not wait for thread when exiting
+            dir_watch_thread.start()
+        else:
+            mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY | pyinotify.IN_CREATE
+            dir_watch['wd'] = self.watch_manager.add_watch(path=path, mask=mask, rec=False, auto_add=True).get(path)
+            if dir_watch['wd'] >= 0:
+                self.watches[dir_watch['wd']] = dir_watch
+        self.dir_watch_data[path] = dir_watch
+        # Files may have been written before the watch was added
+        scan_outbox(dir_watch, self.tasks)
+
+    def remove(self, path):
+        dir_watch = self.dir_watch_data.pop(path)
+        pyas2init.logger.info(_(u'Stop watching directory %s' % path))
+        dir_watch['active'] = False
+        if os.name != 'nt' and dir_watch['wd'] >= 0:
+            self.watches.pop(dir_watch['wd'], None)
+            self.watch_manager.rm_watch(dir_watch['wd'], quiet=True)
+
+
 class Command(BaseCommand):
     help = _(u'Daemon process that watches the outbox of all as2 partners and '
              u'triggers sendmessage when files become available')
 
     def handle(self, *args, **options):
+        pyas2init.startinfo()
         pyas2init.logger.info(_(u'Starting PYAS2 send daemon.'))
-        try:
-            engine_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            engine_socket.bind(('127.0.0.1', pyas2init.gsettings['daemon_port']))
-        except socket.error:
-            engine_socket.close()
-            raise CommandError(_(u'An instance of the send daemon is already running'))
-        else:
-            atexit.register(engine_socket.close)
+        # several daemons may watch the same outboxes, the claims on the files keep them apart
+        node = '%s:%s' % (socket.gethostname(), os.getpid())
         cond = threading.Condition()
         tasks = set()
-        dir_watch_data = []
-        orgs = models.Organization.objects.all()
-        partners = models.Partner.objects.all()
-        for partner in partners:
-            for org in orgs:
-                dir_watch_data.append({})
-                dir_watch_data[-1]['path'] = as2utils.join(pyas2init.gsettings['root_dir'], 'messages',
-                                                           partner.as2_name, 'outbox', org.as2_name)
-                dir_watch_data[-1]['organization'] = org.as2_name
-                dir_watch_data[-1]['partner'] = partner.as2_name
-        if not dir_watch_data:
-            pyas2init.logger.error(_(u'No partners have been configured!'))
-            sys.exit(0)
+        cond.acquire()
         pyas2init.logger.info(_(u'Process existing files in the directory.'))
-        for dir_watch in dir_watch_data:
-            files = [f for f in os.listdir(dir_watch['path']) if os.path.isfile(as2utils.join(dir_watch['path'], f))]
-            for file in files:
-                lijst = ['sendas2message',
-                        '--delete',
-                        dir_watch['organization'],
-                        dir_watch['partner'],
-                        as2utils.join(dir_watch['path'], file)]
-                pyas2init.logger.info(u'Send as2 message with params "%(task)s".', {'task': lijst})
-                p = Process(target=management.call_command, args=lijst)
-                p.start()
-        if os.name == 'nt':
-            # for windows: start a thread per directory watcher
-            for dir_watch in dir_watch_data:
-                dir_watch_thread = threading.Thread(target=windows_event_handler,
-                                                    args=(pyas2init.logger, dir_watch, cond, tasks))
-                dir_watch_thread.daemon = True  # do not wait for thread when exiting
-                dir_watch_thread.start()
-        else:
-            # for linux: one watch-thread, but multiple watches.
-            dir_watch_thread = threading.Thread(target=linux_event_handler,
-                                                args=(pyas2init.logger, dir_watch_data, cond, tasks))
-            dir_watch_thread.daemon = True  # do not wait for thread when exiting
-            dir_watch_thread.start()
+        watcher = OutboxWatcher(cond, tasks)
+        watcher.refresh()
+        refresh_thread = threading.Thread(target=refresh_outboxes,
+                                          args=(watcher, pyas2init.gsettings['daemon_refresh']))
+        refresh_thread.daemon = True  # do not wait for thread when exiting
+        refresh_thread.start()
+        renew_thread = threading.Thread(target=renew_claims_loop,
+                                        args=(node, pyas2init.gsettings['daemon_lease'] / 3.0))
+        renew_thread.daemon = True
+        renew_thread.start()
+        scheduler = BatchScheduler(pyas2init.gsettings['daemon_settle_time'],
+                                   pyas2init.gsettings['daemon_max_wait'],
+                                   pyas2init.gsettings['daemon_batch_size'])
         # this main thread get the results from the watch-thread(s).
         pyas2init.logger.info(_(u'PYAS2 send daemon started started.'))
-        active_receiving = False
-        timeout = 2.0
-        cond.acquire()
         while True:
-            # this functions as a buffer: all events go into set tasks.
-            # the tasks are fired to jobqueue after TIMOUT sec.
-            # this is to avoid firing to many tasks to jobqueue; events typically come in bursts.
-            # is value of timeout is larger, reaction times are slower...but less tasks are fired to jobqueue.
-            # in itself this is not a problem, as jobqueue will alos discard duplicate jobs.
-            # 2 sec seems to e a good value: reasonable quick, not to nervous.
-            cond.wait(timeout=timeout)  # get back when results, or after timeout sec
-            if tasks:
-                if not active_receiving:  # first request (after tasks have been  fired, or startup of dirmonitor)
-                    active_receiving = True
-                    last_time = time.time()
-                else:  # active receiving events
-                    current_time = time.time()
-                    if current_time - last_time >= timeout:
-                        try:
-                            for task in tasks:
-                                lijst = ['sendas2message',
-                                         '--delete',
-                                         task[0],
-                                         task[1],
-                                         task[2]]
-                                pyas2init.logger.info(u'Send as2 message with params "%(task)s".', {'task': lijst})
-                                p = Process(target=management.call_command, args=lijst)
-                                p.start()
-                        except Exception as msg:
-                            pyas2init.logger.info(u'Error in running task: "%(msg)s".', {'msg': msg})
-                        tasks.clear()
-                        active_receiving = False
-                    else:
-                        pyas2init.logger.debug(u'time difference to small.')
-                        last_time = current_time
+            # all events go into set tasks, the scheduler holds the files until they are complete.
+            # the watch-threads only notify when the first task arrives, without waiting files the
+            # main thread sleeps until then.
+            if not tasks:
+                cond.wait(scheduler.timeout(time.time()))
+            now = time.time()
+            for task in tasks:
+                scheduler.add(task, now)
+            tasks.clear()
+            for batch in scheduler.poll(now):
+                dispatch(batch, node)
         cond.release()
         sys.exit(0)
 
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import time
+from django.core.management.base import BaseCommand
+from django.utils.translation import ugettext as _
+
+from pyas2 import jobs, pyas2init
+
+
+class Command(BaseCommand):
+    help = _(u'Job server that runs the commands submitted by the web UI and the send daemon '
+             u'in resident worker threads')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            default=None,
+            help=_(u'Number of worker threads, overrides the JOBWORKERS setting')
+        )
+
+    def handle(self, *args, **options):
+        pyas2init.startinfo()
+        workers = options['workers'] or pyas2init.gsettings['job_workers']
+        server = jobs.JobServer(workers, pyas2init.gsettings['job_poll_interval'])
+        recovered = server.recover()
+        if recovered:
+            pyas2init.logger.warning(_(u'%s jobs of stopped job servers have been marked as failed') % recovered)
+        server.start()
+        pyas2init.logger.info(_(u'PyAS2 job server started with %(workers)s workers.'), {'workers': workers})
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pyas2init.logger.info(_(u'Stopping the job server, waiting for the running jobs.'))
+            server.stop()
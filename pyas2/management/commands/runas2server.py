@@ -15,6 +15,7 @@ class Command(BaseCommand):
             from cherrypy import wsgiserver
         except Exception:
             raise ImportError(_(u'Dependency failure: cherrypy library is needed to start the as2 server'))
+        pyas2init.startinfo()
 
         cherrypy.config.update({
             'global': {
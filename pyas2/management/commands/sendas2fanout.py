@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext as _
+
+from pyas2 import models, as2lib, as2utils, cmdrunner, rawarchive
+
+
+class Command(BaseCommand):
+    help = _('Send the same file as an as2 message to several trading partners')
+    args = '<organization_as2name path_to_payload partner_as2name [partner_as2name ...]>'
+
+    def add_arguments(self, parser):
+        parser.add_argument('organization_as2name', type=str)
+        parser.add_argument('path_to_payload', type=str)
+        parser.add_argument('partner_as2name', type=str, nargs='+')
+
+        parser.add_argument(
+            '--delete',
+            action='store_true',
+            dest='delete',
+            default=False,
+            help=_(u'Delete source file after processing')
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            default=4,
+            help=_(u'Number of partners the file is sent to at the same time')
+        )
+
+    def handle(self, *args, **options):
+        # Check if organization and partners exist
+        org = models.get_organization(options['organization_as2name'])
+        if not org:
+            raise CommandError(_(u'Organization "%s" does not exist' % options['organization_as2name']))
+        partners = []
+        for as2_name in options['partner_as2name']:
+            partner = models.get_partner(as2_name)
+            if not partner:
+                raise CommandError(_(u'Partner "%s" does not exist' % as2_name))
+            partners.append(partner)
+
+        start = time.time()
+        try:
+            results = as2lib.send_file_to_partners(org, partners, options['path_to_payload'],
+                                                   delete=options['delete'], workers=options['workers'])
+        except as2utils.AS2Error as e:
+            raise CommandError(e)
+        failed = 0
+        for partner, message, error, seconds in results:
+            if message and message.status != 'E':
+                self.stdout.write(u'%-12s %8.2fs  %s  %s' % (message.get_status_display(), seconds,
+                                                             partner.as2_name, message.message_id))
+            else:
+                failed += 1
+                self.stdout.write(u'%-12s %8.2fs  %s  %s' % (_(u'Error'), seconds, partner.as2_name,
+                                                             message.message_id if message else error))
+        self.stdout.write(_(u'Processed %(total)d partners in %(seconds).2f seconds, %(failed)d failed') % {
+            'total': len(results), 'seconds': time.time() - start, 'failed': failed})
+
+        # Let the post send commands and the raw archive finish before the process exits
+        cmdrunner.wait()
+        rawarchive.wait()
+
+        if failed:
+            raise CommandError(_(u'%(failed)d of %(total)d messages could not be sent') %
+                               {'failed': failed, 'total': len(results)})
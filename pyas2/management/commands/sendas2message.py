@@ -1,13 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import os
+import glob
 import time
-import shutil
-import email.utils
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import ugettext as _
 
-from pyas2 import models, as2lib, as2utils, pyas2init
+from pyas2 import models, as2lib, as2utils, cmdrunner, rawarchive
 
 
 class Command(BaseCommand):
@@ -17,7 +16,8 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('organization_as2name', type=str)
         parser.add_argument('partner_as2name', type=str)
-        parser.add_argument('path_to_payload', type=str)
+        parser.add_argument('path_to_payload', type=str,
+                            help=_(u'File to send, or a directory to send all its files'))
 
         parser.add_argument(
             '--delete',
@@ -26,54 +26,91 @@ class Command(BaseCommand):
             default=False,
             help=_(u'Delete source file after processing')
         )
+        parser.add_argument(
+            '--stored',
+            action='store_true',
+            dest='stored',
+            default=False,
+            help=_(u'The file has been written to the payload send store already, send it without copying it')
+        )
+        parser.add_argument(
+            '--manifest',
+            action='store_true',
+            dest='manifest',
+            default=False,
+            help=_(u'The payload is a manifest file listing the files to send, one path per line')
+        )
+        parser.add_argument(
+            '--glob',
+            action='store_true',
+            dest='glob',
+            default=False,
+            help=_(u'The payload is a glob pattern, send all the files it matches')
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            dest='workers',
+            default=1,
+            help=_(u'Number of files sent at the same time')
+        )
 
     def handle(self, *args, **options):
         # Check if organization and partner exists
-        try:
-            org = models.Organization.objects.get(as2_name=options['organization_as2name'])
-        except models.Organization.DoesNotExist:
+        org = models.get_organization(options['organization_as2name'])
+        if not org:
             raise CommandError(_(u'Organization "%s" does not exist' % options['organization_as2name']))
-        try:
-            partner = models.Partner.objects.get(as2_name=options['partner_as2name'])
-        except models.Partner.DoesNotExist:
+        partner = models.get_partner(options['partner_as2name'])
+        if not partner:
             raise CommandError(_(u'Partner "%s" does not exist' % options['partner_as2name']))
 
-        # Check if file exists and we have the right permissions
-        if not os.path.isfile(options['path_to_payload']):
-            raise CommandError(_(u'Payload at location "%s" does not exist' % options['path_to_payload']))
-        if options['delete'] and not os.access(options['path_to_payload'], os.W_OK):
-            raise CommandError('Insufficient file permission for payload %s' % options['path_to_payload'])
-
-        # Copy the file to the store
-        output_dir = as2utils.join(pyas2init.gsettings['payload_send_store'], time.strftime('%Y%m%d'))
-        as2utils.dirshouldbethere(output_dir)
-        outfile = as2utils.join(output_dir, os.path.basename(options['path_to_payload']))
-        shutil.copy2(options['path_to_payload'], outfile)
-
-        # Delete original file if option is set
-        if options['delete']:
-            os.remove(options['path_to_payload'])
+        paths = self.batch_paths(options['path_to_payload'], options['manifest'], options['glob'])
+        failed = 0
+        if paths is None:
+            # Send a single file, a missing file or insufficient permissions fail the command
+            try:
+                as2lib.send_file(org, partner, options['path_to_payload'], delete=options['delete'],
+                                 stored=options['stored'])
+            except as2utils.AS2Error as e:
+                raise CommandError(e)
+        else:
+            start = time.time()
+            results = as2lib.send_files(org, partner, paths, delete=options['delete'], workers=options['workers'])
+            for path, message, error, seconds in results:
+                if message:
+                    status = message.get_status_display()
+                    detail = message.message_id
+                    failed += message.status == 'E'
+                else:
+                    status = _(u'Error')
+                    detail = error
+                    failed += 1
+                self.stdout.write(u'%-12s %8.2fs  %s  %s' % (status, seconds, path, detail))
+            self.stdout.write(_(u'Processed %(total)d files in %(seconds).2f seconds, %(failed)d failed') % {
+                'total': len(results), 'seconds': time.time() - start, 'failed': failed})
 
-        # Create the payload and message objects
-        payload = models.Payload.objects.create(name=os.path.basename(options['path_to_payload']),
-                                                file=outfile,
-                                                content_type=partner.content_type)
-        message = models.Message.objects.create(message_id=email.utils.make_msgid().strip('<>'),
-                                                partner=partner,
-                                                organization=org,
-                                                direction='OUT',
-                                                status='IP',
-                                                payload=payload)
+        # Let the post send commands and the raw archive finish before the process exits
+        cmdrunner.wait()
+        rawarchive.wait()
 
-        # Build and send the AS2 message
-        try:
-            payload = as2lib.build_message(message)
-            as2lib.send_message(message, payload)
-        except Exception as e:
-            pyas2init.logger.error(_('Failed to send message, error:\n%(txt)s') % {'txt': as2utils.txtexc()})
-            message.status = 'E'
-            models.Log.objects.create(message=message, status='E', text=_(u'Failed to send message, error is %s' % e))
-            message.save()
+        if failed:
+            raise CommandError(_(u'%(failed)d of %(total)d files could not be sent') %
+                               {'failed': failed, 'total': len(paths)})
 
-            # Send mail here
-            as2utils.senderrorreport(message, _('Failed to send message, error is %s' % e))
+    @staticmethod
+    def batch_paths(path, manifest, pattern=False):
+        """ Return the files to send for a directory, glob pattern or manifest, None for a single file.
+            A path is only a glob pattern with pattern set, a file name like order[1].edi is sent as it is. """
+        if manifest:
+            try:
+                with open(path) as manifest_file:
+                    lines = [line.strip() for line in manifest_file]
+            except IOError as e:
+                raise CommandError(_(u'Manifest "%(path)s" can not be read: %(error)s') % {'path': path, 'error': e})
+            base_dir = os.path.dirname(os.path.abspath(path))
+            return [os.path.join(base_dir, line) for line in lines if line and not line.startswith('#')]
+        if os.path.isdir(path):
+            return sorted(as2utils.join(path, f) for f in os.listdir(path) if os.path.isfile(as2utils.join(path, f)))
+        if pattern:
+            return sorted(f for f in glob.glob(path) if os.path.isfile(f))
+        return None
@@ -4,10 +4,8 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from django.utils.translation import ugettext as _
 from datetime import timedelta
-from email.parser import HeaderParser
-import requests
 
-from pyas2 import models, pyas2init
+from pyas2 import logevents, models, pyas2init
 
 
 class Command(BaseCommand):
@@ -25,7 +23,9 @@ class Command(BaseCommand):
                 # Set http basic auth if enabled in the partner profile
                 auth = None
                 verify = True
+                timeout = (pyas2init.gsettings['http_connect_timeout'], pyas2init.gsettings['http_read_timeout'])
                 if pending_mdn.omessage.partner:
+                    timeout = pending_mdn.omessage.partner.http_timeout()
                     if pending_mdn.omessage.partner.http_auth:
                         auth = (pending_mdn.omessage.partner.http_auth_user, pending_mdn.omessage.partner.http_auth_pass)
 
@@ -33,17 +33,18 @@ class Command(BaseCommand):
                     if pending_mdn.omessage.partner.https_ca_cert:
                         verify = pending_mdn.omessage.partner.https_ca_cert.path
 
-                # Post the MDN message to the url provided on the original as2 message
+                # Post the MDN message to the url provided on the original as2 message, requests is only loaded
+                # by the runs that have MDNs to send
+                import requests
                 with open(pending_mdn.file, 'rb') as payload:
                     requests.post(pending_mdn.return_url,
                                   auth=auth,
                                   verify=verify,
                                   headers=pending_mdn._headers(),
-                                  data=payload)
+                                  data=payload,
+                                  timeout=timeout)
                 pending_mdn.status = 'S'
-                models.Log.objects.create(message=pending_mdn.omessage,
-                                          status='S',
-                                          text=_('Successfully sent asynchronous mdn to partner'))
+                models.Log.add(pending_mdn.omessage, 'S', logevents.ASYNC_MDN_SENT)
             except Exception as e:
                 pyas2init.logger.error('%s %s\n%s' % (
                                        _('Error while sending asynchronous MDNs'),
@@ -51,14 +52,9 @@ class Command(BaseCommand):
                 if pending_mdn.retries > pyas2init.gsettings['max_retries']:
                     pending_mdn.status = 'E'
                 if hasattr(pending_mdn, 'omessage'):
-                    models.Log.objects.create(message=pending_mdn.omessage,
-                                              status='E',
-                                              text=_('Failed to send asynchronous mdn to partner, '
-                                                     'error is {0:s}'.format(e)))
+                    models.Log.add(pending_mdn.omessage, 'E', logevents.ASYNC_MDN_SEND_FAILED, error=e)
                     if pending_mdn.status == 'E':
-	                models.Log.objects.create(message=pending_mdn.omessage,
-                                          status='E',
-                                          text=_('MDN exceeded maximum retries, marked as error'))
+                        models.Log.add(pending_mdn.omessage, 'E', logevents.MDN_RETRIES_EXCEEDED)
 
             finally:
                 pending_mdn.save()
@@ -76,7 +72,7 @@ class Command(BaseCommand):
             status_txt = _('Failed to receive asynchronous MDN within the threshold limit')
             pending_msg.status = 'E'
             pending_msg.adv_status = status_txt
-            models.Log.objects.create(message=pending_msg, status='E', text=status_txt)
+            models.Log.add(pending_msg, 'E', logevents.MDN_TIMEOUT)
             pending_msg.save()
 
         pyas2init.logger.info(_('Successfully processed all pending mdns'))
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:25
+from __future__ import unicode_literals
+
+import json
+from email.parser import HeaderParser
+from django.db import migrations, models
+
+from pyas2 import as2utils
+
+
+def to_text(value):
+    """ Header bytes of an unknown charset are decoded as utf-8, with replacement characters for invalid bytes """
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def text_to_json(apps, schema_editor):
+    """ Convert the raw header text to a json list of (name, value) pairs and fill the header columns """
+    for model_name, columns in [('Message', (('as2_from', 'as2-from'), ('as2_to', 'as2-to'), ('subject', 'subject'))),
+                                ('MDN', (('as2_from', 'as2-from'), ('as2_to', 'as2-to')))]:
+        model = apps.get_model('pyas2', model_name)
+        for pk, headers in model.objects.exclude(headers=None).values_list('pk', 'headers').iterator():
+            if headers.startswith('['):
+                continue
+            # The header parser reads bytes, the values are decoded again before they are dumped
+            if isinstance(headers, unicode):
+                headers = headers.encode('utf-8')
+            items = HeaderParser().parsestr(headers).items()
+            items = [(to_text(key), to_text(value)) for key, value in items]
+            values = dict((key.lower(), value) for key, value in items)
+            update = {'headers': json.dumps(items)}
+            for field, header in columns:
+                if values.get(header) is not None:
+                    value = as2utils.unescape_as2name(values[header])
+                    update[field] = value[:model._meta.get_field(field).max_length]
+            model.objects.filter(pk=pk).update(**update)
+
+
+def json_to_text(apps, schema_editor):
+    """ Convert the json list of (name, value) pairs back to the raw header text """
+    for model_name in ['Message', 'MDN']:
+        model = apps.get_model('pyas2', model_name)
+        for pk, headers in model.objects.exclude(headers=None).values_list('pk', 'headers').iterator():
+            if headers.startswith('['):
+                text = ''.join('%s: %s\n' % (key, value) for key, value in json.loads(headers))
+                model.objects.filter(pk=pk).update(headers=text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0020_auto_20180410_1101'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mdn',
+            name='as2_from',
+            field=models.CharField(db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='mdn',
+            name='as2_to',
+            field=models.CharField(db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='as2_from',
+            field=models.CharField(db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='as2_to',
+            field=models.CharField(db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='subject',
+            field=models.CharField(db_index=True, max_length=255, null=True),
+        ),
+        migrations.RunPython(text_to_json, json_to_text),
+    ]
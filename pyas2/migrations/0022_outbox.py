@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0021_structured_headers'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Outbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('organization', models.CharField(max_length=100)),
+                ('partner', models.CharField(max_length=100)),
+                ('mtime', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='OutboxFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('organization', models.CharField(max_length=100)),
+                ('partner', models.CharField(max_length=100)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='outboxfile',
+            unique_together=set([('organization', 'partner', 'filename')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='outbox',
+            unique_together=set([('organization', 'partner')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:33
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0022_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxfile',
+            name='lease_expires',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='outboxfile',
+            name='node',
+            field=models.CharField(max_length=100, null=True),
+        ),
+    ]
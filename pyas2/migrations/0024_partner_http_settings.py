@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0023_outbox_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='partner',
+            name='http_connect_timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds to wait for the connection to the partner, the HTTPCONNECTTIMEOUT setting when empty', null=True, verbose_name='Connect Timeout'),
+        ),
+        migrations.AddField(
+            model_name='partner',
+            name='http_expect_continue',
+            field=models.BooleanField(default=False, help_text='Send the message content only after the partner accepted the request, so that rejections arrive before a large message has been sent', verbose_name='Expect 100-continue'),
+        ),
+        migrations.AddField(
+            model_name='partner',
+            name='http_read_timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Seconds to wait for data from the partner, the HTTPREADTIMEOUT setting when empty', null=True, verbose_name='Read Timeout'),
+        ),
+    ]
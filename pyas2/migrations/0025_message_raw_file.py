@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0024_partner_http_settings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='build_hash',
+            field=models.CharField(max_length=40, null=True),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='raw_file',
+            field=models.CharField(max_length=500, null=True),
+        ),
+    ]
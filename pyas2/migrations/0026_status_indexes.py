@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0025_message_raw_file'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='mdn',
+            index_together=set([('status', 'timestamp')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='message',
+            index_together=set([('status', 'direction', 'timestamp'), ('partner', 'timestamp'), ('organization', 'timestamp')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0026_status_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PartnerTraffic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('partner', models.CharField(max_length=100, null=True)),
+                ('direction', models.CharField(choices=[(b'IN', 'Inbound'), (b'OUT', 'Outbound')], max_length=5)),
+                ('status', models.CharField(choices=[(b'S', 'Success'), (b'E', 'Error'), (b'W', 'Warning'), (b'P', 'Pending'), (b'R', 'Retry'), (b'IP', 'In Process')], max_length=2)),
+                ('hour', models.DateTimeField()),
+                ('messages', models.IntegerField(default=0)),
+                ('bytes', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='partnertraffic',
+            unique_together=set([('partner', 'direction', 'status', 'hour')]),
+        ),
+    ]
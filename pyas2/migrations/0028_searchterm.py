@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from pyas2 import pyas2init
+
+# Columns searched with trigram indexes on PostgreSQL, search.TrigramContains compares the plain columns with ILIKE
+TRIGRAM_COLUMNS = [('pyas2_message', 'message_id'), ('pyas2_message', 'subject'), ('pyas2_message', 'as2_from'),
+                   ('pyas2_message', 'as2_to'), ('pyas2_message', 'headers'), ('pyas2_payload', 'name')]
+
+
+def create_trigram_indexes(apps, schema_editor):
+    """ Index the searched columns with pg_trgm on PostgreSQL, the other databases use the search terms """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+        if not cursor.fetchone():
+            # Without the extension the search still works, by scanning the columns
+            pyas2init.logger.warning('The pg_trgm extension is not available, the message search scans the message '
+                                     'table. Install it and run "migrate pyas2 0027" and "migrate" to index it.')
+            return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for table, column in TRIGRAM_COLUMNS:
+        schema_editor.execute('CREATE INDEX %s_%s_trgm ON %s USING gin (%s gin_trgm_ops)' % (
+            table, column, table, column))
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for table, column in TRIGRAM_COLUMNS:
+            cursor.execute('DROP INDEX IF EXISTS %s_%s_trgm' % (table, column))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0027_partnertraffic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=100)),
+                ('term', models.CharField(max_length=100)),
+                ('prefix', models.BooleanField(default=False)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='pyas2.Message')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='searchterm',
+            index_together=set([('term', 'field')]),
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 12:59
+from __future__ import unicode_literals
+
+import json
+from django.db import migrations, models
+
+from pyas2 import logevents, pyas2init
+
+
+def compact_logs(apps, schema_editor):
+    """ Store the existing log texts as their events """
+    count = logevents.compact(apps.get_model('pyas2', 'Log'))
+    if count:
+        pyas2init.logger.info('%s message logs converted to events', count)
+
+
+def expand_logs(apps, schema_editor):
+    """ Write the untranslated texts of the events back to the logs """
+    log_model = apps.get_model('pyas2', 'Log')
+    for log in log_model.objects.filter(event__isnull=False).iterator():
+        params = json.loads(log.params) if log.params else {}
+        log.text = (logevents.TEMPLATES[log.event] % params)[:255]
+        log.save(update_fields=['text'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0028_searchterm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='event',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='params',
+            field=models.TextField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='log',
+            name='text',
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.RunPython(compact_logs, expand_logs),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 13:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0029_log_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('command', models.CharField(max_length=50)),
+                ('args', models.TextField(null=True)),
+                ('status', models.CharField(choices=[(b'Q', 'Queued'), (b'R', 'Running'), (b'S', 'Success'), (b'E', 'Error')], default=b'Q', max_length=2)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(null=True)),
+                ('finished', models.DateTimeField(null=True)),
+                ('node', models.CharField(max_length=100, null=True)),
+                ('error', models.CharField(max_length=255, null=True)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='job',
+            index_together=set([('status', 'created')]),
+        ),
+    ]
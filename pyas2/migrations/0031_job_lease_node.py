@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 13:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0030_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='lease_node',
+            field=models.CharField(max_length=100, null=True),
+        ),
+    ]
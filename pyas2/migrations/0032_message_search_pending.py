@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-19 13:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyas2', '0031_job_lease_node'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='search_pending',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import os
-import subprocess
-from django.db import models
-from django.db.models.signals import post_save, post_delete
+import json
+import time
+import threading
+import collections
+from django.db import models, router, transaction, IntegrityError
+from django.db.models import F, Sum
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_init, post_save, post_delete
 from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext as _
 from email.parser import HeaderParser
 from string import Template
 
-from . import pyas2init, as2utils
+from . import pyas2init, as2utils, cmdrunner, logevents
 
 
 # Initialize the pyas2 settings and loggers
@@ -31,6 +36,43 @@ def get_certificate_path(instance, filename):
     return '/'.join((pyas2init.gsettings['media_uri'], 'certificates', filename))
 
 
+def load_headers(value):
+    """ Return the list of (name, value) pairs stored in a headers field, older rows hold the raw header text """
+    if not value:
+        return []
+    if value.startswith('['):
+        return [(key.encode('utf-8'), val.encode('utf-8')) for key, val in json.loads(value)]
+    return HeaderParser().parsestr(value).items()
+
+
+def dump_headers(items):
+    """ Return the (name, value) pairs as the json list stored in a headers field """
+    return json.dumps([[as2utils.safe_unicode(key), as2utils.safe_unicode(value)] for key, value in items])
+
+
+class HeadersMixin(object):
+    """ Access to the headers field of messages and MDNs, the stored json is parsed at most once """
+
+    def _headers(self):
+        cached = self.__dict__.get('_headers_cache')
+        if not cached or cached[0] is not self.headers:
+            cached = self._headers_cache = (self.headers, dict(load_headers(self.headers)))
+        return cached[1]
+
+    def set_headers(self, items):
+        """ Store the (name, value) pairs in the headers field and the indexed header columns """
+        self.headers = dump_headers(items)
+        self._set_header_columns()
+
+    def _set_header_columns(self):
+        headers = dict((key.lower(), value) for key, value in self._headers().items())
+        for field, header in self.HEADER_COLUMNS:
+            value = headers.get(header)
+            if value is not None:
+                value = as2utils.unescape_as2name(value)[:self._meta.get_field(field).max_length]
+            setattr(self, field, value)
+
+
 @python_2_unicode_compatible
 class PrivateCertificate(models.Model):
     certificate = models.FileField(
@@ -125,6 +167,24 @@ class Partner(models.Model):
         max_length=500, upload_to=get_certificate_path,
         verbose_name=_('HTTPS Local CA Store'), null=True, blank=True)
     target_url = models.URLField()
+    http_connect_timeout = models.PositiveIntegerField(
+        verbose_name=_('Connect Timeout'),
+        null=True,
+        blank=True,
+        help_text=_('Seconds to wait for the connection to the partner, the HTTPCONNECTTIMEOUT setting when empty')
+    )
+    http_read_timeout = models.PositiveIntegerField(
+        verbose_name=_('Read Timeout'),
+        null=True,
+        blank=True,
+        help_text=_('Seconds to wait for data from the partner, the HTTPREADTIMEOUT setting when empty')
+    )
+    http_expect_continue = models.BooleanField(
+        verbose_name=_('Expect 100-continue'),
+        default=False,
+        help_text=_('Send the message content only after the partner accepted the request, '
+                    'so that rejections arrive before a large message has been sent')
+    )
     subject = models.CharField(max_length=255, default=_('EDI Message sent using pyas2'))
     content_type = models.CharField(max_length=100, choices=CONTENT_TYPE_CHOICES, default='application/edi-consent')
     compress = models.BooleanField(verbose_name=_('Compress Message'), default=True)
@@ -168,9 +228,14 @@ class Partner(models.Model):
     def __str__(self):
         return self.name
 
+    def http_timeout(self):
+        """ Return the (connect, read) timeout for requests to the partner """
+        return (self.http_connect_timeout or pyas2init.gsettings['http_connect_timeout'],
+                self.http_read_timeout or pyas2init.gsettings['http_read_timeout'])
+
 
 @python_2_unicode_compatible
-class Message(models.Model):
+class Message(HeadersMixin, models.Model):
     DIRECTION_CHOICES = (
         ('IN', _('Inbound')),
         ('OUT', _('Outbound')),
@@ -195,10 +260,18 @@ class Message(models.Model):
         ('SYNC', _('Synchronous')),
         ('ASYNC', _('Asynchronous')),
     )
+    HEADER_COLUMNS = (
+        ('as2_from', 'as2-from'),
+        ('as2_to', 'as2-to'),
+        ('subject', 'subject'),
+    )
     message_id = models.CharField(max_length=100, primary_key=True)
     headers = models.TextField(null=True)
+    as2_from = models.CharField(max_length=100, null=True, db_index=True)
+    as2_to = models.CharField(max_length=100, null=True, db_index=True)
+    subject = models.CharField(max_length=255, null=True, db_index=True)
     direction = models.CharField(max_length=5, choices=DIRECTION_CHOICES)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     status = models.CharField(max_length=2, choices=STATUS_CHOICES)
     adv_status = models.CharField(max_length=255, null=True)
     organization = models.ForeignKey(Organization, null=True)
@@ -212,9 +285,20 @@ class Message(models.Model):
     mic = models.CharField(max_length=100, null=True)
     mdn_mode = models.CharField(max_length=5, choices=MODE_CHOICES, null=True)
     retries = models.IntegerField(default=0)
+    raw_file = models.CharField(max_length=500, null=True)
+    build_hash = models.CharField(max_length=40, null=True)
+    # The searchable values changed since the message was last indexed, see search.index_pending
+    search_pending = models.BooleanField(default=False, db_index=True)
+
+    # Status of the message when it was loaded from or last saved to the database
+    _db_status = None
 
     class Meta:
         ordering = ['-timestamp']
+        # Retries and pending MDNs by status and direction, message lists by partner or organization
+        index_together = (('status', 'direction', 'timestamp'),
+                          ('partner', 'timestamp'),
+                          ('organization', 'timestamp'))
 
     def __str__(self):
         return self.message_id
@@ -222,9 +306,6 @@ class Message(models.Model):
     def msg_id(self):
         return self.message_id.split(MSG_ID_SEP)[0]
 
-    def _headers(self):
-        return dict(HeaderParser().parsestr(self.headers or '').items())
-
     def _parse_cmd(self, cmd):
         """Create command from template, replace variables in the command"""
         variables = {
@@ -241,27 +322,27 @@ class Message(models.Model):
         """Execute command after successful send, can be used to notify successful sends"""
         if self.partner.cmd_send:
             command = self._parse_cmd(self.partner.cmd_send)
-            info = '%s "%s"' % (_('Executing post send command:'), command)
-            pyas2init.logger.info(info)
-            Log.objects.create(message=self, status='S', text=info)
-            subprocess.Popen(command.split(' '))
+            pyas2init.logger.info('%s "%s"' % (_('Executing post send command:'), command))
+            Log.add(self, 'S', logevents.POST_SEND_COMMAND, command=command)
+            cmdrunner.submit(self.pk, command)
 
     def run_post_receive(self, *args, **kwargs):
         """Execute command after successful receive, can be used to call the edi program for further processing"""
         if self.partner.cmd_receive:
             command = self._parse_cmd(self.partner.cmd_receive)
-            info = '%s "%s"' % (_('Executing post receive command:'), command)
-            pyas2init.logger.info(info)
-            Log.objects.create(message=self, status='S', text=info)
-            subprocess.Popen(command.split(' '))
+            pyas2init.logger.info('%s "%s"' % (_('Executing post receive command:'), command))
+            Log.add(self, 'S', logevents.POST_RECEIVE_COMMAND, command=command)
+            cmdrunner.submit(self.pk, command)
 
     def save(self, *args, **kwargs):
         full_filename = kwargs.pop('full_filename', '')
+        if not self.timestamp:
+            self._set_header_columns()
         if not self.timestamp and self.direction == 'IN':
             if not self.organization:
-                self.organization = Organization.objects.filter(as2_name=self._headers().get('as2-to')).first()
+                self.organization = get_organization(self._headers().get('as2-to'))
             if not self.partner:
-                self.partner = Partner.objects.filter(as2_name=self._headers().get('as2-from')).first()
+                self.partner = get_partner(self._headers().get('as2-from'))
             if not self.organization or not self.partner:
                 self.status = 'E'
                 self.message_id += MSG_ID_SEP + self._headers().get('as2-to', 'NONE')
@@ -273,14 +354,13 @@ class Message(models.Model):
                     self.message_id += MSG_ID_SEP + self.partner.as2_name
 
         if self.timestamp and self.status == 'S':
-            this = Message.objects.get(pk=self.pk)
             ######################################
             # Run post receive/send command
             # message need to be saved like this:
             # message.save(full_filename='/path/to/file')
             # path to message to file $fullfilename
             ######################################
-            if this.status != self.status:
+            if self._db_status != self.status:
                 pyas2init.logger.debug('full_filename passed to save: %s' % full_filename)
                 self.full_filename = full_filename
                 # Run post receive
@@ -289,7 +369,25 @@ class Message(models.Model):
                 # Run post send
                 elif self.direction == 'OUT' and self.partner.cmd_send:
                     self.run_post_send()
+        from . import search
+        update_fields = kwargs.get('update_fields')
+        if (update_fields is None or not search.INDEXED_FIELDS.isdisjoint(update_fields)) and \
+                not search.uses_trigram():
+            # The terms are written outside the save, by the job server or rebuildas2search --pending
+            self.search_pending = True
+            if update_fields is not None:
+                kwargs['update_fields'] = list(update_fields) + ['search_pending']
         super(Message, self).save(*args, **kwargs)
+        if self.status in PartnerTraffic.FINAL_STATUS and self._db_status not in PartnerTraffic.FINAL_STATUS:
+            PartnerTraffic.add(self)
+        self._db_status = self.status
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Message, cls).from_db(db, field_names, values)
+        # Remember the status in the database to detect status changes on save
+        instance._db_status = instance.__dict__.get('status')
+        return instance
 
     def status_icon(self):
         return '<img alt="%(title)s" src="%(static)s%(icon)s" title="%(title)s" style="width: 1em;" />' % {'title': self.get_status_display(), 'static': STATIC_URL, 'icon': self.STATUS_ICONS.get(self.status)}
@@ -297,6 +395,12 @@ class Message(models.Model):
     status_icon.allow_tags = True
     status_icon.short_description = 'Status'
 
+    def payload_size(self):
+        """ Size of the payload file in bytes, 0 when there is none """
+        if self.payload_id and os.path.isfile(self.payload.file):
+            return os.path.getsize(self.payload.file)
+        return 0
+
 
 @python_2_unicode_compatible
 class Payload(models.Model):
@@ -318,11 +422,26 @@ class Log(models.Model):
     timestamp = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=2, choices=STATUS_CHOICES)
     message = models.ForeignKey(Message, related_name='logs')
-    text = models.CharField(max_length=255)
+    event = models.PositiveSmallIntegerField(null=True)
+    params = models.TextField(null=True)
+    # Text of the logs written before the events that matches no event
+    text = models.CharField(max_length=255, null=True)
 
     class Meta:
         ordering = ['-timestamp']
 
+    @classmethod
+    def add(cls, message, status, event, **params):
+        """ Log the event with its parameters for the message, the message can be given by its primary key """
+        return cls.objects.create(message_id=getattr(message, 'pk', message), status=status,
+                                  event=event, params=logevents.dump_params(params))
+
+    def render(self):
+        """ Return the text of the log in the active language """
+        if self.event is None:
+            return self.text
+        return logevents.render(self.event, self.params)
+
     def __str__(self):
         return '%s_%s_%s' % (self.message.direction, self.message, self.status)
 
@@ -334,30 +453,200 @@ class Log(models.Model):
 
 
 @python_2_unicode_compatible
-class MDN(models.Model):
+class MDN(HeadersMixin, models.Model):
     STATUS_CHOICES = (
         ('S', _('Sent')),
         ('R', _('Received')),
         ('P', _('Pending')),
         ('E', _('Error')),  # Pending go to Error after max retry
     )
+    HEADER_COLUMNS = (
+        ('as2_from', 'as2-from'),
+        ('as2_to', 'as2-to'),
+    )
     message_id = models.CharField(max_length=100, primary_key=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=2, choices=STATUS_CHOICES)
     file = models.CharField(max_length=500)
     headers = models.TextField(null=True)
+    as2_from = models.CharField(max_length=100, null=True, db_index=True)
+    as2_to = models.CharField(max_length=100, null=True, db_index=True)
     return_url = models.URLField(null=True)
     signed = models.BooleanField(default=False)
     retries = models.IntegerField(default=0)
 
     class Meta:
         ordering = ['-timestamp']
+        index_together = (('status', 'timestamp'),)
 
     def __str__(self):
         return self.message_id
 
-    def _headers(self):
-        return dict(HeaderParser().parsestr(self.headers or '').items())
+    def save(self, *args, **kwargs):
+        if not self.timestamp:
+            self._set_header_columns()
+        super(MDN, self).save(*args, **kwargs)
+
+
+@python_2_unicode_compatible
+class Outbox(models.Model):
+    """ Modification time of a partner outbox when the send daemon last listed it """
+    organization = models.CharField(max_length=100)
+    partner = models.CharField(max_length=100)
+    mtime = models.FloatField(null=True)
+
+    class Meta:
+        unique_together = (('organization', 'partner'),)
+
+    def __str__(self):
+        return '%s/outbox/%s' % (self.partner, self.organization)
+
+
+@python_2_unicode_compatible
+class OutboxFile(models.Model):
+    """ File in a partner outbox that has been handed to sendas2message by a send daemon.
+        The daemon that claims the file holds a lease on it until sendas2message has finished,
+        the lease of a crashed daemon expires and the file is taken over by another one. """
+    organization = models.CharField(max_length=100)
+    partner = models.CharField(max_length=100)
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+    node = models.CharField(max_length=100, null=True)
+    lease_expires = models.DateTimeField(null=True)
+
+    class Meta:
+        unique_together = (('organization', 'partner', 'filename'),)
+
+    def __str__(self):
+        return '%s/outbox/%s/%s' % (self.partner, self.organization, self.filename)
+
+
+@python_2_unicode_compatible
+class PartnerTraffic(models.Model):
+    """ Number and payload bytes of the messages that finished with a status, by partner, direction and hour.
+        The messages are counted when they reach a final status, the dashboard reads only these rollups. """
+    # Success, success with warnings like a failed MIC check and error
+    FINAL_STATUS = ('S', 'W', 'E')
+    partner = models.CharField(max_length=100, null=True)
+    direction = models.CharField(max_length=5, choices=Message.DIRECTION_CHOICES)
+    status = models.CharField(max_length=2, choices=Message.STATUS_CHOICES)
+    hour = models.DateTimeField()
+    messages = models.IntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (('partner', 'direction', 'status', 'hour'),)
+
+    def __str__(self):
+        return '%s_%s_%s_%s' % (self.partner, self.direction, self.status, self.hour)
+
+    @staticmethod
+    def hour_of(timestamp):
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    @classmethod
+    def add(cls, message, messages=1):
+        """ Count the message in the rollup of its partner, direction, status and hour """
+        key = {'partner': message.partner_id, 'direction': message.direction, 'status': message.status,
+               'hour': cls.hour_of(message.timestamp)}
+        size = message.payload_size()
+        if cls.objects.filter(**key).update(messages=F('messages') + messages, bytes=F('bytes') + size):
+            return
+        try:
+            with transaction.atomic(using=router.db_for_write(cls)):
+                cls.objects.create(messages=messages, bytes=size, **key)
+        except IntegrityError:
+            # Created by another process in the meantime
+            cls.objects.filter(**key).update(messages=F('messages') + messages, bytes=F('bytes') + size)
+
+    @classmethod
+    def summary(cls, since):
+        """ Return the totals by partner since the time, as a list of dicts sorted by partner """
+        partners = {}
+        totals = cls.objects.filter(hour__gte=cls.hour_of(since)).values('partner', 'direction', 'status').annotate(
+            total_messages=Sum('messages'), total_bytes=Sum('bytes'))
+        for total in totals:
+            row = partners.setdefault(total['partner'], {'partner': total['partner'], 'sent': 0, 'send_warnings': 0,
+                                                         'send_errors': 0, 'received': 0, 'receive_warnings': 0,
+                                                         'receive_errors': 0, 'bytes_sent': 0, 'bytes_received': 0})
+            # Messages with warnings have been transferred, they count as sent or received as well
+            if total['direction'] == 'OUT':
+                row['send_errors' if total['status'] == 'E' else 'sent'] += total['total_messages']
+                if total['status'] == 'W':
+                    row['send_warnings'] += total['total_messages']
+                row['bytes_sent'] += total['total_bytes']
+            else:
+                row['receive_errors' if total['status'] == 'E' else 'received'] += total['total_messages']
+                if total['status'] == 'W':
+                    row['receive_warnings'] += total['total_messages']
+                row['bytes_received'] += total['total_bytes']
+        return sorted(partners.values(), key=lambda row: row['partner'] or '')
+
+
+@python_2_unicode_compatible
+class SearchTerm(models.Model):
+    """ Inverted index of the searchable values of the messages, used by databases without trigram indexes.
+        Each distinct trigram of a value is a term, prefix marks the trigram at the start of the value. """
+    message = models.ForeignKey(Message, related_name='search_terms')
+    field = models.CharField(max_length=100)
+    term = models.CharField(max_length=100)
+    prefix = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = (('term', 'field'),)
+
+    def __str__(self):
+        return '%s_%s_%s' % (self.message_id, self.field, self.term)
+
+
+@python_2_unicode_compatible
+class Job(models.Model):
+    """ Management command submitted by the web UI or the send daemon. The resident job server runs the queued
+        jobs in its warm worker threads, without the job server each job is run by a new process. """
+    STATUS_CHOICES = (
+        ('Q', _('Queued')),
+        ('R', _('Running')),
+        ('S', _('Success')),
+        ('E', _('Error')),
+    )
+    STATUS_ICONS = {
+        'Q': 'admin/img/icon_clock.gif',
+        'R': 'images/icon-pass.gif',
+        'S': 'admin/img/icon_success.gif',
+        'E': 'admin/img/icon_error.gif',
+    }
+    command = models.CharField(max_length=50)
+    args = models.TextField(null=True)
+    status = models.CharField(max_length=2, choices=STATUS_CHOICES, default='Q')
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True)
+    finished = models.DateTimeField(null=True)
+    node = models.CharField(max_length=100, null=True)
+    error = models.CharField(max_length=255, null=True)
+    # Send daemon whose claim on the outbox file of a sendas2message job lasts until the job has finished
+    lease_node = models.CharField(max_length=100, null=True)
+
+    class Meta:
+        ordering = ['-created']
+        index_together = (('status', 'created'),)
+
+    def __str__(self):
+        return '%s %s' % (self.command, ' '.join(self.arguments()))
+
+    def arguments(self):
+        return json.loads(self.args) if self.args else []
+
+    def duration(self):
+        if self.started and self.finished:
+            return (self.finished - self.started).total_seconds()
+
+    def status_icon(self):
+        return '<img alt="%(title)s" src="%(static)s%(icon)s" title="%(title)s" style="width: 1em;" />' % {'title': self.get_status_display(), 'static': STATIC_URL, 'icon': self.STATUS_ICONS.get(self.status)}
+
+    status_icon.allow_tags = True
+    status_icon.short_description = 'Status'
 
 
 def getorganizations():
@@ -369,6 +658,76 @@ def getpartners():
     return [DEFAULT_ENTRY] + [(l, '%s (%s)' % (l, n)) for (l, n) in Partner.objects.values_list('as2_name', 'name')]
 
 
+def get_organization(as2_name):
+    """ Return the organization along with its keys from the profile cache, None if it does not exist """
+    return _get_profile(Organization, as2_name)
+
+
+def get_partner(as2_name):
+    """ Return the partner along with its certificates from the profile cache, None if it does not exist """
+    return _get_profile(Partner, as2_name)
+
+
+def _get_profile(model, as2_name):
+    key = (model.__name__, as2_name)
+    with _profile_cache_lock:
+        cached = _profile_cache.pop(key, None)
+        if cached and time.time() - cached[0] < pyas2init.gsettings['profile_cache_timeout']:
+            # Put the entry back as the most recently used
+            _profile_cache[key] = cached
+            return cached[1]
+    profile = model.objects.select_related('encryption_key', 'signature_key').filter(as2_name=as2_name).first()
+    # Unknown as2 names come from the headers of any client, they are not cached
+    if profile is not None:
+        with _profile_cache_lock:
+            _profile_cache[key] = (time.time(), profile)
+            while len(_profile_cache) > PROFILE_CACHE_SIZE:
+                _profile_cache.popitem(last=False)
+    return profile
+
+
+# Organizations and partners by (model name, as2_name), least recently used first
+_profile_cache = collections.OrderedDict()
+_profile_cache_lock = threading.Lock()
+PROFILE_CACHE_SIZE = 1000
+
+
+@receiver(post_init, sender=Organization)
+@receiver(post_init, sender=Partner)
+def remember_profile_name(sender, instance, **kwargs):
+    """ Keep the as2 name the profile was loaded with, a rename has to invalidate the previous name as well """
+    instance._loaded_as2_name = instance.as2_name
+
+
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(post_save, sender=Partner)
+@receiver(post_delete, sender=Partner)
+def invalidate_profile(sender, instance, **kwargs):
+    """ Drop the changed organization or partner from the profile cache """
+    with _profile_cache_lock:
+        _profile_cache.pop((sender.__name__, instance.as2_name), None)
+        _profile_cache.pop((sender.__name__, getattr(instance, '_loaded_as2_name', None)), None)
+    instance._loaded_as2_name = instance.as2_name
+
+
+@receiver(post_save, sender=PrivateCertificate)
+@receiver(post_delete, sender=PrivateCertificate)
+@receiver(post_save, sender=PublicCertificate)
+@receiver(post_delete, sender=PublicCertificate)
+def invalidate_profiles(sender, instance, **kwargs):
+    """ Certificates can be shared by many profiles, drop all of them from the profile cache """
+    with _profile_cache_lock:
+        _profile_cache.clear()
+
+
+@receiver(connection_created)
+def tune_connection(sender, connection, **kwargs):
+    """ Apply the SQLite settings to new connections of the receiver, daemon and webserver """
+    if connection.vendor == 'sqlite':
+        pyas2init.tune_sqlite(connection)
+
+
 @receiver(post_delete, sender=Message)
 def post_delete_message(sender, instance, *args, **kwargs):
     """ Delete related mdn, payload """
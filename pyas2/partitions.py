@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from django.db import connections, router, transaction
+from django.utils import timezone
+from django.utils.translation import ugettext as _
+
+from . import models
+from . import pyas2init
+
+# Tables partitioned by month on their timestamp column on PostgreSQL
+PARTITIONED_MODELS = (models.Message, models.Log)
+# Months after the current month that have their partitions created in advance
+FUTURE_MONTHS = 3
+# Partitions are bound by months in UTC
+BOUND_FORMAT = '%Y-%m-%d 00:00:00+00'
+# Table holding the ids of the messages, it keeps the message ids unique across the partitions
+MESSAGE_KEY_TABLE = 'pyas2_message_key'
+MESSAGE_KEY_TRIGGER = '''CREATE FUNCTION %(table)s() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        IF TG_OP = 'DELETE' OR NEW.message_id <> OLD.message_id THEN
+            DELETE FROM %(table)s WHERE message_id = OLD.message_id;
+        END IF;
+    END IF;
+    IF TG_OP <> 'DELETE' THEN
+        IF TG_OP = 'INSERT' OR NEW.message_id <> OLD.message_id THEN
+            INSERT INTO %(table)s (message_id) VALUES (NEW.message_id);
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql'''
+
+
+class DryRunCursor(object):
+    """ Cursor that runs the queries of the catalog and the tables, and records the statements that would
+    change the database instead of running them """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        if sql.startswith('SELECT'):
+            return self.cursor.execute(sql, params)
+        self.statements.append(sql)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+def get_connection():
+    """ Return the connection of the pyas2 database """
+    return connections[router.db_for_write(models.Message)]
+
+
+def supported(connection):
+    """ Declarative partitioning with primary keys on the partitioned table needs PostgreSQL 11 """
+    return connection.vendor == 'postgresql' and connection.pg_version >= 110000
+
+
+def add_months(month, count):
+    """ Return the first day of the month count months after the month """
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def month_of(moment):
+    if timezone.is_aware(moment):
+        moment = timezone.make_naive(moment, timezone.utc)
+    return datetime(moment.year, moment.month, 1)
+
+
+def partition_name(table, month):
+    return '%s_y%04dm%02d' % (table, month.year, month.month)
+
+
+def is_partitioned(cursor, table):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [table])
+    return cursor.fetchone() is not None
+
+
+def partition_month(table, name):
+    """ Return the month of a partition named by partition_name, None for other partitions """
+    try:
+        return datetime.strptime(name[len(table):], '_y%Ym%m')
+    except ValueError:
+        return None
+
+
+def partitions(cursor, table):
+    """ Return the (name, month) of the monthly partitions of the table, oldest first """
+    cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                   "WHERE i.inhparent = to_regclass(%s)", [table])
+    result = [(name, partition_month(table, name)) for name, in cursor.fetchall()]
+    return sorted((partition for partition in result if partition[1]), key=lambda partition: partition[1])
+
+
+def create_partition(cursor, table, month):
+    """ Create the partition of the table holding the month, if it does not exist yet """
+    name = partition_name(table, month)
+    cursor.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM ('%s') TO ('%s')" % (
+        name, table, month.strftime(BOUND_FORMAT), add_months(month, 1).strftime(BOUND_FORMAT)))
+    return name
+
+
+def create_partitions(months):
+    """ Create the partitions of the partitioned tables from the current month for the months to come,
+    returns the names of the partitions """
+    connection = get_connection()
+    if not supported(connection):
+        return []
+    current = month_of(datetime.utcnow())
+    names = []
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        for model in PARTITIONED_MODELS:
+            table = model._meta.db_table
+            if not is_partitioned(cursor, table):
+                continue
+            for count in range(months + 1):
+                names.append(create_partition(cursor, table, add_months(current, count)))
+    return names
+
+
+def drop_partitions(before):
+    """ Drop the partitions that only hold rows older than before, along with the payloads and MDNs of
+    their messages, returns the names of the dropped partitions """
+    connection = get_connection()
+    if not supported(connection):
+        return []
+    before = month_of(before)
+    names = []
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        message_table = models.Message._meta.db_table
+        if is_partitioned(cursor, message_table):
+            for name, month in partitions(cursor, message_table):
+                if add_months(month, 1) > before:
+                    break
+                cursor.execute('DELETE FROM %s WHERE id IN (SELECT payload_id FROM %s)' % (
+                    models.Payload._meta.db_table, name))
+                cursor.execute('DELETE FROM %s WHERE message_id IN (SELECT mdn_id FROM %s)' % (
+                    models.MDN._meta.db_table, name))
+                cursor.execute('DELETE FROM %s WHERE message_id IN (SELECT message_id FROM %s)' % (
+                    models.SearchTerm._meta.db_table, name))
+                # Dropping a table does not run the delete triggers, free the message ids of the partition
+                cursor.execute('DELETE FROM %s WHERE message_id IN (SELECT message_id FROM %s)' % (
+                    MESSAGE_KEY_TABLE, name))
+                cursor.execute('DROP TABLE %s' % name)
+                names.append(name)
+        log_table = models.Log._meta.db_table
+        if is_partitioned(cursor, log_table):
+            for name, month in partitions(cursor, log_table):
+                if add_months(month, 1) > before:
+                    break
+                cursor.execute('DROP TABLE %s' % name)
+                names.append(name)
+    return names
+
+
+def convert(months, dry_run=False):
+    """ Convert the message and log tables to tables partitioned by month on their timestamp.
+    The primary keys include the timestamp, as PostgreSQL requires it, so unique columns of the tables
+    get a plain index and the foreign keys to messages are dropped. The message ids stay unique through
+    the message key table. With dry_run the statements are returned and not run. """
+    connection = get_connection()
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if dry_run:
+            cursor = DryRunCursor(cursor)
+        for model in PARTITIONED_MODELS:
+            table = model._meta.db_table
+            if is_partitioned(cursor, table):
+                pyas2init.logger.info(_(u'Table %s is already partitioned') % table)
+                continue
+            _convert_table(cursor, model, months)
+        return cursor.statements if dry_run else []
+
+
+def _convert_table(cursor, model, months):
+    table = model._meta.db_table
+    old_table = '%s_unpartitioned' % table
+    pk = model._meta.pk.column
+
+    # Keep the definitions of the indexes and foreign keys to create them again on the partitioned table
+    cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT IN "
+                   "(SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s))", [table, table])
+    indexes = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                   "WHERE conrelid = to_regclass(%s) AND contype IN ('f', 'u')", [table])
+    constraints = cursor.fetchall()
+    # Foreign keys of other tables can not reference a partitioned table without its timestamp
+    cursor.execute("SELECT conrelid::regclass, conname FROM pg_constraint "
+                   "WHERE confrelid = to_regclass(%s) AND contype = 'f'", [table])
+    for referencing_table, name in cursor.fetchall():
+        cursor.execute('ALTER TABLE %s DROP CONSTRAINT %s' % (referencing_table, name))
+
+    cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [table, pk])
+    sequence = cursor.fetchone()[0]
+    cursor.execute('SELECT min(timestamp) FROM %s' % table)
+    first = cursor.fetchone()[0]
+    cursor.execute('ALTER TABLE %s RENAME TO %s' % (table, old_table))
+    cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS, PRIMARY KEY (%s, timestamp)) '
+                   'PARTITION BY RANGE (timestamp)' % (table, old_table, pk))
+    if sequence:
+        cursor.execute('ALTER SEQUENCE %s OWNED BY %s.%s' % (sequence, table, pk))
+
+    # Partitions for the existing rows and the months to come
+    current = month_of(datetime.utcnow())
+    month = month_of(first) if first else current
+    while month <= add_months(current, months):
+        create_partition(cursor, table, month)
+        month = add_months(month, 1)
+    cursor.execute('INSERT INTO %s SELECT * FROM %s' % (table, old_table))
+    cursor.execute('DROP TABLE %s' % old_table)
+
+    for indexdef in indexes:
+        cursor.execute(indexdef.replace('CREATE UNIQUE INDEX', 'CREATE INDEX'))
+    references = tuple(' REFERENCES %s(' % partitioned._meta.db_table for partitioned in PARTITIONED_MODELS)
+    for name, definition in constraints:
+        if definition.startswith('FOREIGN KEY'):
+            if any(reference in definition for reference in references):
+                # Dropped with the other foreign keys to the partitioned tables
+                continue
+            cursor.execute('ALTER TABLE %s ADD CONSTRAINT %s %s' % (table, name, definition))
+        else:
+            # UNIQUE (payload_id) becomes a plain index
+            cursor.execute('CREATE INDEX %s ON %s %s' % (name, table, definition[len('UNIQUE '):]))
+    if model is models.Message:
+        _create_message_key(cursor, table)
+    pyas2init.logger.info(_(u'Table %s has been converted to a partitioned table') % table)
+
+
+def _create_message_key(cursor, table):
+    """ The primary key of the partitioned message table is unique per message id and timestamp only, a
+    trigger keeps the message ids in a table of their own whose primary key refuses a message id twice """
+    cursor.execute('CREATE TABLE %s (message_id varchar(100) PRIMARY KEY)' % MESSAGE_KEY_TABLE)
+    cursor.execute('INSERT INTO %s (message_id) SELECT message_id FROM %s' % (MESSAGE_KEY_TABLE, table))
+    cursor.execute(MESSAGE_KEY_TRIGGER % {'table': MESSAGE_KEY_TABLE})
+    # Row triggers of partitioned tables are AFTER triggers on PostgreSQL 11, they apply to all partitions
+    cursor.execute('CREATE TRIGGER %s AFTER INSERT OR UPDATE OR DELETE ON %s FOR EACH ROW EXECUTE PROCEDURE %s()' % (
+        MESSAGE_KEY_TABLE, table, MESSAGE_KEY_TABLE))
@@ -18,6 +18,7 @@ convertini2logger = {
     'CRITICAL': logging.CRITICAL,
     'STARTINFO': 25
 }
+SQLITE_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
 
 
 def Pyas2settingsModname():
@@ -45,7 +46,8 @@ def Pyas2settingsModname():
     if pyas2_settings_file:
         if not os.path.isfile(pyas2_settings_file):
             raise Exception('Custom pyas2 settings file not found: "%s"' % pyas2_settings_file)
-        sys.stderr.write('Custom pyas2settings: %s\n' % pyas2_settings_file)
+        if not quiet_environment():
+            sys.stderr.write('Custom pyas2settings: %s\n' % pyas2_settings_file)
         pyas2_settings_path = os.path.dirname(pyas2_settings_file)
         try:
             init_file = os.path.join(pyas2_settings_path, '__init__.py')
@@ -63,7 +65,8 @@ def Pyas2settingsModname():
             os.path.join(pyas2_settings_path, '%s.py' % modname))
     if not pyas2_settings_path in sys.path:
         sys.path.append(pyas2_settings_path)
-    sys.stderr.write('PYAS2_SETTINGS_FILE: %s\n' % os.environ.get('PYAS2_SETTINGS_FILE'))
+    if not quiet_environment():
+        sys.stderr.write('PYAS2_SETTINGS_FILE: %s\n' % os.environ.get('PYAS2_SETTINGS_FILE'))
     return modname
 
 
@@ -87,7 +90,9 @@ def pyas2setup(pyas2server):
 
 
 def initialize():
-    """ Function initializes the global variables for pyAS2 """
+    """ Function initializes the global variables for pyAS2, later calls keep them.
+        Only the settings are read and the logger is set up: the stores are created when first written to
+        and the log file is opened with the first record. """
 
     from django.conf import settings
     from django.utils.translation import ugettext as _
@@ -116,7 +121,14 @@ def initialize():
             gsettings['protocol'] += 's'
         gsettings['environment_text'] = pyas2_settings.get('ENVIRONMENTTEXT', 'Default')
         gsettings['environment_text_color'] = pyas2_settings.get('ENVIRONMENTTEXTCOLOR', 'Black')
-        gsettings['daemon_port'] = pyas2_settings.get('DAEMONPORT', 16388)
+        gsettings['daemon_lease'] = pyas2_settings.get('DAEMONLEASE', 300)
+        gsettings['daemon_refresh'] = pyas2_settings.get('DAEMONREFRESH', 60)
+        gsettings['daemon_settle_time'] = pyas2_settings.get('DAEMONSETTLETIME', 1.0)
+        gsettings['daemon_max_wait'] = pyas2_settings.get('DAEMONMAXWAIT', 2.0)
+        gsettings['daemon_batch_size'] = pyas2_settings.get('DAEMONBATCHSIZE', 50)
+        gsettings['job_server'] = pyas2_settings.get('JOBSERVER', False)
+        gsettings['job_workers'] = pyas2_settings.get('JOBWORKERS', 2)
+        gsettings['job_poll_interval'] = pyas2_settings.get('JOBPOLLINTERVAL', 1.0)
         gsettings['python_path'] = pyas2_settings.get('PYTHONPATH', sys.executable)
         if os.environ.get('PYAS2_ROOT'):
             gsettings['root_dir'] = os.environ.get('PYAS2_ROOT')
@@ -140,45 +152,107 @@ def initialize():
         gsettings['payload_receive_store'] = as2utils.join(
                 gsettings['root_dir'], 'messages', '__store', 'payload', 'received')
         gsettings['payload_send_store'] = as2utils.join(gsettings['root_dir'], 'messages', '__store', 'payload', 'sent')
+        gsettings['upload_staging_dir'] = as2utils.join(
+                gsettings['root_dir'], 'messages', '__store', 'payload', 'uploading')
         gsettings['mdn_receive_store'] = as2utils.join(gsettings['root_dir'], 'messages', '__store', 'mdn', 'received')
         gsettings['mdn_send_store'] = as2utils.join(gsettings['root_dir'], 'messages', '__store', 'mdn', 'sent')
         gsettings['raw_receive_store'] = as2utils.join(gsettings['root_dir'], 'messages', '__store', 'raw', 'received')
         gsettings['raw_send_store'] = as2utils.join(gsettings['root_dir'], 'messages', '__store', 'raw', 'sent')
         gsettings['log_dir'] = as2utils.join(gsettings['root_dir'], 'logging')
-        for sett in ['payload_receive_store', 'payload_send_store', 'mdn_receive_store', 'mdn_send_store', 'log_dir']:
-            as2utils.dirshouldbethere(gsettings[sett])
+        # fsync policy of the stores, either one policy for all stores or a dict of policies by store name
+        store_fsync = pyas2_settings.get('STOREFSYNC', 'batch')
+        if isinstance(store_fsync, dict):
+            store_fsync = dict(store_fsync)
+        else:
+            store_fsync = {'default': store_fsync}
+        store_fsync.setdefault('default', 'batch')
+        for store, policy in store_fsync.items():
+            if policy not in as2utils.FSYNC_POLICIES:
+                raise Exception(_('Invalid STOREFSYNC policy "%s" for store "%s", use one of %s !' % (
+                    policy, store, ', '.join(as2utils.FSYNC_POLICIES))))
+        gsettings['store_fsync'] = store_fsync
         gsettings['log_level'] = pyas2_settings.get('LOGLEVEL', 'INFO')
         gsettings['log_console'] = pyas2_settings.get('LOGCONSOLE', True)
         gsettings['log_console_level'] = pyas2_settings.get('LOGCONSOLELEVEL', 'STARTINFO')
+        gsettings['quiet'] = pyas2_settings.get('QUIET', False) or quiet_environment()
         gsettings['max_retries'] = pyas2_settings.get('MAXRETRIES', 30)
         gsettings['mdn_url'] = pyas2_settings.get('MDNURL',
 	    '%(protocol)s://%(as2_host)s:%(as2_port)s/%(as2_uri)s' % gsettings)
         gsettings['async_mdn_wait'] = pyas2_settings.get('ASYNCMDNWAIT', 30)
+        gsettings['http_connect_timeout'] = pyas2_settings.get('HTTPCONNECTTIMEOUT', 10)
+        gsettings['http_read_timeout'] = pyas2_settings.get('HTTPREADTIMEOUT', 300)
         gsettings['max_arch_days'] = pyas2_settings.get('MAXARCHDAYS', 30)
+        gsettings['profile_cache_timeout'] = pyas2_settings.get('PROFILECACHETIMEOUT', 60)
+        gsettings['post_cmd_workers'] = pyas2_settings.get('POSTCMDWORKERS', 4)
+        gsettings['post_cmd_timeout'] = pyas2_settings.get('POSTCMDTIMEOUT', 600)
+        gsettings['raw_archive_background'] = pyas2_settings.get('RAWARCHIVEBACKGROUND', True)
+        gsettings['search_headers'] = pyas2_settings.get('SEARCHHEADERS', ['Subject'])
+        # Tuning of the connections to SQLite databases
+        gsettings['sqlite_wal'] = pyas2_settings.get('SQLITEWAL', True)
+        gsettings['sqlite_synchronous'] = pyas2_settings.get('SQLITESYNCHRONOUS', 'NORMAL')
+        if gsettings['sqlite_synchronous'] not in SQLITE_SYNCHRONOUS:
+            raise Exception(_('Invalid SQLITESYNCHRONOUS setting "%s", use one of %s !' % (
+                gsettings['sqlite_synchronous'], ', '.join(SQLITE_SYNCHRONOUS))))
+        gsettings['sqlite_busy_timeout'] = pyas2_settings.get('SQLITEBUSYTIMEOUT', 20)
+        gsettings['sqlite_cache_size'] = pyas2_settings.get('SQLITECACHESIZE', 20000)
         gsettings['minDate'] = 0 - gsettings['max_arch_days']
 
         # Init logging
         initserverlogging('pyas2%s_%s' % (gsettings['server'], gsettings['environment']))
 
-        # Display infos
-        logger.info('###########################################')
-        logger.info('PYAS2 %s Initialised successfully.' % gsettings['server'])
-        logger.info('PYAS2_SETTINGS_FILE: %s' % os.environ.get('PYAS2_SETTINGS_FILE'))
-        logger.info('ENVIRONMENT: %s' % gsettings['environment'])
-        logger.info('PYAS2_ROOT: %s' % gsettings['root_dir'])
-        logger.info('MEDIA_ROOT: %s' % settings.MEDIA_ROOT)
-        logger.info('PYAS2_MEDIA_URI: %s' % gsettings['media_uri'])
-        logger.info('default database  : %s' % gsettings['db_default'])
-        logger.info('pyas2 database    : %s' % gsettings['db_pyas2'])
         if hasattr(settings, 'DATABASE_ROUTERS'):
-            logger.info('DATABASE_ROUTERS: %s' % settings.DATABASE_ROUTERS)
             if not settings.DATABASES.get('pyas2') and 'pyas2.dbrouter.Pyas2dbRouter' in settings.DATABASE_ROUTERS:
                 err = _("Error: 'pyas2' database not set in DATABASES settings !")
                 logger.error(err)
                 raise Exception('%s\n' % err)
-        if gsettings['server'] == 'webserver':
-            logger.info('STATIC_ROOT: %s' % settings.STATIC_ROOT)
-        logger.info('###########################################')
+
+
+def startinfo():
+    """ Log the settings of the server, the long running servers do this when they start.
+        The short lived commands do not, and in quiet mode the settings are only logged at debug level. """
+    from django.conf import settings
+    level = logging.DEBUG if gsettings['quiet'] else logging.INFO
+    logger.log(level, '###########################################')
+    logger.log(level, 'PYAS2 %s Initialised successfully.' % gsettings['server'])
+    logger.log(level, 'PYAS2_SETTINGS_FILE: %s' % os.environ.get('PYAS2_SETTINGS_FILE'))
+    logger.log(level, 'ENVIRONMENT: %s' % gsettings['environment'])
+    logger.log(level, 'PYAS2_ROOT: %s' % gsettings['root_dir'])
+    logger.log(level, 'MEDIA_ROOT: %s' % settings.MEDIA_ROOT)
+    logger.log(level, 'PYAS2_MEDIA_URI: %s' % gsettings['media_uri'])
+    logger.log(level, 'default database  : %s' % gsettings['db_default'])
+    logger.log(level, 'pyas2 database    : %s' % gsettings['db_pyas2'])
+    if hasattr(settings, 'DATABASE_ROUTERS'):
+        logger.log(level, 'DATABASE_ROUTERS: %s' % settings.DATABASE_ROUTERS)
+    if gsettings['server'] == 'webserver':
+        logger.log(level, 'STATIC_ROOT: %s' % settings.STATIC_ROOT)
+    logger.log(level, '###########################################')
+
+
+def quiet_environment():
+    """ Quiet mode can be set for a single run with the PYAS2_QUIET environment variable, as for cron jobs """
+    return os.environ.get('PYAS2_QUIET', '').lower() not in ('', '0', 'false', 'no')
+
+
+def tune_sqlite(connection):
+    """ Configure a new connection to an SQLite database, with the WAL journal readers do not wait for a writer
+    and writers wait up to the busy timeout for each other instead of failing with "database is locked"."""
+    cursor = connection.cursor()
+    try:
+        if gsettings['sqlite_wal']:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        if gsettings['sqlite_synchronous']:
+            cursor.execute('PRAGMA synchronous=%s' % gsettings['sqlite_synchronous'])
+        cursor.execute('PRAGMA busy_timeout=%d' % (gsettings['sqlite_busy_timeout'] * 1000))
+        if gsettings['sqlite_cache_size']:
+            # A negative cache size is in KiB instead of pages
+            cursor.execute('PRAGMA cache_size=-%d' % gsettings['sqlite_cache_size'])
+    finally:
+        cursor.close()
+
+
+def store_fsync(store):
+    """ Return the fsync policy for the store, stores are named like their gsettings key or 'inbox' """
+    return gsettings['store_fsync'].get(store, gsettings['store_fsync']['default'])
 
 
 def initserverlogging(logname):
@@ -186,14 +260,16 @@ def initserverlogging(logname):
     global logger
     logger = logging.getLogger(logname)
     logger.setLevel(convertini2logger[gsettings['log_level']])
+    as2utils.dirshouldbethere(gsettings['log_dir'])
+    # The file is opened by the first record, runs that log nothing do not touch it
     handler = logging.handlers.TimedRotatingFileHandler(
             os.path.join(gsettings['log_dir'], logname + '.log'),
-            when='midnight', backupCount=10)
+            when='midnight', backupCount=10, delay=True)
     fileformat = logging.Formatter("%(asctime)s %(levelname)-9s: %(message)s", '%Y%m%d %H:%M:%S')
     handler.setFormatter(fileformat)
     logger.addHandler(handler)
-    # initialise console/screen logging
-    if gsettings['log_console']:
+    # initialise console/screen logging, quiet runs only log to the file
+    if gsettings['log_console'] and not gsettings['quiet']:
         console = logging.StreamHandler()
         console.setLevel(convertini2logger[gsettings['log_console_level']])
         consoleformat = logging.Formatter("%(asctime)s %(levelname)-9s: %(message)s", '%Y%m%d %H:%M:%S')
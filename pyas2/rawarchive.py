@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import threading
+import Queue
+from django.utils.translation import ugettext as _
+
+from . import as2utils
+from . import pyas2init
+
+# Messages waiting to be stored before the senders are held back, the queue holds open temporary files
+QUEUE_SIZE = 64
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+class RawArchive(object):
+    """ Writes the outbound messages, as they are sent to the partner, to the raw send store.
+        The content is written to a temporary file in the store by the sender, the background thread syncs it
+        and gives it its name, so that the send does not wait for the disk and the queue holds no contents.
+        The path is recorded on the message once the file is in place, unless the message has been built
+        differently since. Without the background thread the messages are written in the calling thread."""
+
+    def __init__(self, background, queue_size=QUEUE_SIZE):
+        self.background = background
+        self.queue = Queue.Queue(queue_size)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, message, content):
+        """ Queue the content of the message for writing, start the background thread on first use """
+        writer = as2utils.StoreWriter(pyas2init.gsettings['raw_send_store'], message.message_id, True,
+                                      fsync=pyas2init.store_fsync('raw_send_store'))
+        try:
+            writer.write(content)
+            writer.file.flush()
+        except Exception:
+            writer.abort()
+            raise
+        if not self.background:
+            self.write(message, message.build_hash, message.mic, writer)
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._work)
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((message, message.build_hash, message.mic, writer))
+
+    def wait(self):
+        """ Block until all queued messages have been written """
+        if self.thread:
+            self.queue.join()
+
+    def write(self, message, build_hash, mic, writer):
+        """ Store the written content and record its path on the message, as long as the message is as it
+            was built """
+        from . import models
+        raw_file = writer.close()
+        # A message built again in the meantime keeps the file of the later build
+        if models.Message.objects.filter(pk=message.pk, build_hash=build_hash, mic=mic, raw_file=None).update(
+                raw_file=raw_file):
+            # Set on the instance as well so that a later save of the message keeps the path
+            if message.build_hash == build_hash and message.mic == mic:
+                message.raw_file = raw_file
+        pyas2init.logger.debug('%s %s' % (_('Raw as2 message sent stored:'), raw_file))
+
+    def _work(self):
+        while True:
+            message, build_hash, mic, writer = self.queue.get()
+            try:
+                self.write(message, build_hash, mic, writer)
+                as2utils.syncstoredfiles()
+            except Exception:
+                writer.abort()
+                pyas2init.logger.error(_(u'Error while storing the raw message %(message)s:\n%(txt)s') %
+                                       {'message': message.message_id, 'txt': as2utils.txtexc()})
+            finally:
+                self.queue.task_done()
+
+
+def submit(message, content):
+    """ Archive the message on the process wide raw archive """
+    global _archive
+    with _archive_lock:
+        if _archive is None:
+            _archive = RawArchive(pyas2init.gsettings['raw_archive_background'])
+    _archive.submit(message, content)
+
+
+def wait():
+    """ Wait for the messages submitted by this process, short lived processes call this before exiting """
+    if _archive is not None:
+        _archive.wait()
+
+
+atexit.register(wait)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+import operator
+from django.db import connections, router
+from django.db.models import CharField, Lookup, Q, TextField
+from django.db.models.lookups import IContains, IStartsWith
+
+from . import models
+from . import pyas2init
+
+MATCH_CHOICES = (
+    ('contains', 'Contains'),
+    ('prefix', 'Starts with'),
+)
+# Searchable values of a message, the configured headers are added to these
+FIELDS = ('message_id', 'filename')
+# Longest part of a value that is indexed
+MAX_TERM_LENGTH = 100
+# Distinct trigrams indexed of a value, a longer value is indexed up to the position where this count is reached
+MAX_TERMS = 48
+# Messages indexed at once by index_pending
+PENDING_BATCH = 100
+# Saves of these message fields change the searchable values
+INDEXED_FIELDS = frozenset(['headers', 'payload', 'subject'])
+# Length of the terms in the search index
+GRAM = 3
+# Trigrams of a search text looked up in the index, the columns confirm the rest of the text
+MAX_GRAMS = 4
+# Message columns of the searchable fields, confirm the matches found by the index
+COLUMNS = {'message_id': 'message_id', 'filename': 'payload__name', 'header:subject': 'subject',
+           'header:as2-from': 'as2_from', 'header:as2-to': 'as2_to'}
+
+
+class TrigramContains(Lookup):
+    """ Case insensitive contains that PostgreSQL runs as ILIKE on the column itself, which the trigram indexes on
+    the plain columns cover. icontains compares UPPER(column::text) on PostgreSQL, an expression they do not cover.
+    The other databases run icontains. """
+    lookup_name = 'trgm_contains'
+    fallback = IContains
+    pattern = '%%%s%%'
+
+    def as_sql(self, compiler, connection):
+        return self.fallback(self.lhs, self.rhs).as_sql(compiler, connection)
+
+    def as_postgresql(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        return '%s ILIKE %%s' % lhs, params + [self.pattern % connection.ops.prep_for_like_query(self.rhs)]
+
+
+class TrigramStartsWith(TrigramContains):
+    lookup_name = 'trgm_startswith'
+    fallback = IStartsWith
+    pattern = '%s%%'
+
+
+for field_class in (CharField, TextField):
+    field_class.register_lookup(TrigramContains)
+    field_class.register_lookup(TrigramStartsWith)
+
+
+def uses_trigram():
+    """ PostgreSQL searches the message columns with trigram indexes, other databases use the SearchTerm table """
+    return connections[router.db_for_read(models.Message)].vendor == 'postgresql'
+
+
+def header_fields():
+    return ['header:%s' % header.lower() for header in pyas2init.gsettings['search_headers']]
+
+
+def message_values(message):
+    """ Return the searchable (field, value) pairs of the message """
+    values = [('message_id', message.msg_id())]
+    if message.payload_id:
+        values.append(('filename', message.payload.name))
+    headers = dict((key.lower(), value) for key, value in message._headers().items())
+    for header in pyas2init.gsettings['search_headers']:
+        if headers.get(header.lower()):
+            values.append(('header:%s' % header.lower(), headers[header.lower()]))
+    return values
+
+
+def terms(value):
+    """ Return the (term, prefix) pairs of a value: the distinct trigrams starting at its positions, shorter at the
+    end of the value, up to MAX_TERMS of them. Prefix marks the trigram at the start of the value. """
+    value = _text(value)[:MAX_TERM_LENGTH].lower()
+    found = {}
+    for start in range(len(value)):
+        term = value[start:start + GRAM]
+        if term not in found:
+            if len(found) == MAX_TERMS:
+                break
+            found[term] = start == 0
+    return set(found.items())
+
+
+def index_message(message):
+    """ Bring the terms of the message in the search index in line with its values. Only the terms of values
+    that changed are deleted or added, values left as they were write nothing."""
+    if uses_trigram():
+        return
+    wanted = set()
+    for field, value in message_values(message):
+        wanted.update((field, term, prefix) for term, prefix in terms(value))
+    stale = []
+    for pk, field, term, prefix in models.SearchTerm.objects.filter(message=message).values_list(
+            'pk', 'field', 'term', 'prefix'):
+        if (field, term, prefix) in wanted:
+            wanted.discard((field, term, prefix))
+        else:
+            stale.append(pk)
+    if stale:
+        models.SearchTerm.objects.filter(pk__in=stale).delete()
+    models.SearchTerm.objects.bulk_create(
+        models.SearchTerm(message=message, field=field, term=term, prefix=prefix) for field, term, prefix in wanted)
+
+
+def index_pending(limit=PENDING_BATCH):
+    """ Index the messages saved since they were last indexed, returns the number of messages indexed.
+    The mark is cleared before the terms are written, so a save in the meantime marks the message again. """
+    if uses_trigram():
+        return 0
+    count = 0
+    for message in models.Message.objects.filter(search_pending=True).select_related('payload')[:limit]:
+        if not models.Message.objects.filter(pk=message.pk, search_pending=True).update(search_pending=False):
+            # indexed by another process
+            continue
+        try:
+            index_message(message)
+        except Exception:
+            models.Message.objects.filter(pk=message.pk).update(search_pending=True)
+            raise
+        count += 1
+    return count
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def query(text, match='contains', fields=None):
+    """ Return the filter for the messages with a searchable value that contains or starts with the text.
+    Fields limits the search to some of the FIELDS, 'partner', 'organization' and the configured headers."""
+    text = _text(text).strip().lower()[:MAX_TERM_LENGTH]
+    fields = fields or list(FIELDS) + ['partner', 'organization'] + header_fields()
+    conditions = []
+
+    # Partners and organizations are few, their names are matched in their own tables
+    lookup = 'istartswith' if match == 'prefix' else 'icontains'
+    for field, model in [('partner', models.Partner), ('organization', models.Organization)]:
+        if field in fields:
+            profiles = model.objects.filter(Q(**{'as2_name__' + lookup: text}) | Q(**{'name__' + lookup: text}))
+            conditions.append(Q(**{field + '__in': profiles.values('as2_name')}))
+
+    if uses_trigram():
+        for field in fields:
+            if field not in ('partner', 'organization'):
+                conditions.append(_confirm(field, match, text))
+        return reduce(operator.or_, conditions, Q(pk__in=[]))
+
+    fields = [f for f in fields if f not in ('partner', 'organization')]
+    if text and fields:
+        # The trigrams of the text narrow the messages down by the index, the columns confirm the match
+        grams = [(text[start:start + GRAM], match == 'prefix' and start == 0)
+                 for start in range(0, max(len(text) - GRAM, 0) + 1, GRAM)]
+        grams = grams[:MAX_GRAMS]
+        if len(text) > GRAM and text[-GRAM:] != grams[-1][0]:
+            grams.append((text[-GRAM:], False))
+        found = Q()
+        for gram, prefix in grams:
+            found &= Q(pk__in=_terms(gram, fields, prefix).values('message_id'))
+        confirm = reduce(operator.or_, [_confirm(field, match, text) for field in fields])
+        conditions.append(found & confirm)
+    return reduce(operator.or_, conditions, Q(pk__in=[]))
+
+
+def _terms(gram, fields, prefix):
+    rows = models.SearchTerm.objects.filter(field__in=fields)
+    if len(gram) < GRAM:
+        # Text shorter than a trigram is found at the start of the trigrams
+        rows = rows.filter(term__gte=gram, term__lt=gram + u'\uffff')
+    else:
+        rows = rows.filter(term=gram)
+    if prefix:
+        rows = rows.filter(prefix=True)
+    return rows
+
+
+def _confirm(field, match, text):
+    lookup = 'trgm_startswith' if match == 'prefix' else 'trgm_contains'
+    if column(field) == 'headers':
+        # The stored headers hold all of them, a header value can only be matched anywhere in them
+        lookup = 'trgm_contains'
+    return Q(**{'%s__%s' % (column(field), lookup): text})
+
+
+def column(field):
+    """ Return the column of the message that holds the value of the searchable field """
+    if field.startswith('header:') and field not in COLUMNS:
+        # Other headers are only in the stored headers
+        return 'headers'
+    return COLUMNS[field]
@@ -140,5 +140,8 @@ PYAS2 = {
     # 'MDNURL': 'http://127.0.0.1:8080/pyas2/as2receive',
     'ASYNCMDNWAIT': 30,
     'MAXARCHDAYS': 30,
+    'POSTCMDWORKERS': 0,
+    'RAWARCHIVEBACKGROUND': False,
+    'JOBSERVER': True,
 }
 MEDIA_ROOT = os.path.join(PYAS2['DATADIR'], 'media')
@@ -1,13 +1,34 @@
 import os
+import sys
+import json
+import hashlib
+import socket
+import sqlite3
+import subprocess
+import BaseHTTPServer
+from importlib import import_module
+from django import db
+from django.apps import apps
+from django.core import management
+from django.contrib.auth.models import User
 from django.core.files import File
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from django.utils import timezone
 from email import utils as emailutils
 from email.parser import HeaderParser
 from email import message_from_string
 from itertools import izip
+from StringIO import StringIO
 import shutil
+import threading
+import time
+import urlparse
+import requests
+from unittest import skipUnless
+from datetime import datetime, timedelta
 
-from pyas2 import models, pyas2init, as2lib
+from pyas2 import models, pyas2init, as2lib, as2utils, cmdrunner, jobs, logevents, partitions, rawarchive, search
+from pyas2.management.commands import runas2daemon
 
 
 FIXTURES_DIR = os.path.join((os.path.dirname(
@@ -603,7 +624,7 @@ class AS2SendReceiveTest(TestCase):
     def printLogs(message):
         logs = models.Log.objects.filter(message=message)
         for log in logs:
-            print(log.status, log.text)
+            print(log.status, log.render())
 
     @staticmethod
     def compareFiles(filename1, filename2):
@@ -684,3 +705,1303 @@ class AS2SterlingIntegratorTest(TestCase):
 
         with open(os.path.join(TEST_DIR, 'si_signed.mdn')) as mdn:
             as2lib.save_mdn(message, mdn.read())
+
+
+class StoreFileTest(TestCase):
+    """Test cases for storing files to the file system."""
+
+    def test_no_overwrite(self):
+        """ Test that storing a file with an existing name keeps both files """
+        target_dir = os.path.join(TEST_DIR, 'store')
+        first = as2utils.storefile(target_dir, 'samename.edi', 'first', False)
+        second = as2utils.storefile(target_dir, 'samename.edi', 'second', False, fsync='batch')
+        third = as2utils.storefile(target_dir, 'samename.edi', 'third', False, fsync='never')
+        as2utils.syncstoredfiles()
+
+        self.assertEqual(first, os.path.join(target_dir, 'samename.edi'))
+        self.assertEqual(len(set([first, second, third])), 3)
+        self.assertEqual(as2utils.readdata(second), 'second')
+        self.assertEqual(as2utils.readdata(third), 'third')
+
+        # No temporary files are left behind
+        self.assertEqual(sorted(os.listdir(target_dir)),
+                         sorted(os.path.basename(f) for f in [first, second, third]))
+
+    def test_store_path(self):
+        """ Test that a deleted source is linked into the store and a kept source is copied """
+        target_dir = os.path.join(TEST_DIR, 'storepath')
+        source = os.path.join(TEST_DIR, 'storepath.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), source)
+        inode = os.stat(source).st_ino
+
+        kept = as2utils.storepath(source, target_dir, 'storepath.edi', False)
+        self.assertTrue(os.path.isfile(source))
+        self.assertNotEqual(os.stat(kept).st_ino, inode)
+        self.assertEqual(as2utils.readdata(kept), as2utils.readdata(source))
+
+        moved = as2utils.storepath(source, target_dir, 'storepath.edi', False, delete=True, fsync='batch')
+        as2utils.syncstoredfiles()
+        self.assertFalse(os.path.exists(source))
+        self.assertNotEqual(moved, kept)
+        self.assertEqual(os.stat(moved).st_ino, inode)
+        self.assertEqual(sorted(os.listdir(target_dir)), sorted(os.path.basename(f) for f in [kept, moved]))
+
+    def test_sync_per_thread(self):
+        """ Test that each thread syncs only the files it stored itself """
+        target_dir = os.path.join(TEST_DIR, 'syncthreads')
+        stored = []
+        other = threading.Thread(target=lambda: stored.append(
+            as2utils.storefile(target_dir, 'other.edi', 'other', False, fsync='batch')))
+        other.start()
+        other.join()
+        own = as2utils.storefile(target_dir, 'own.edi', 'own', False, fsync='batch')
+        as2utils.syncstoredfiles()
+        pending = set().union(*as2utils._fsync_pending.values())
+        self.assertNotIn(own, pending)
+        self.assertIn(stored[0], pending)
+        as2utils.syncstoredfiles(all_threads=True)
+        self.assertFalse(as2utils._fsync_pending)
+
+    def test_store_writer(self):
+        """ Test that a file written in chunks is stored with the digest of its content """
+        target_dir = os.path.join(TEST_DIR, 'storewriter')
+        writer = as2utils.StoreWriter(target_dir, 'chunks.edi', False, fsync='never')
+        for chunk in ['first ', 'second ', 'third']:
+            writer.write(chunk)
+        stored = writer.close()
+        self.assertEqual(as2utils.readdata(stored), 'first second third')
+        self.assertEqual(writer.hexdigest(), hashlib.sha256('first second third').hexdigest())
+
+        dropped = as2utils.StoreWriter(target_dir, 'dropped.edi', False, fsync='never')
+        dropped.write('partial')
+        dropped.abort()
+        self.assertEqual(os.listdir(target_dir), ['chunks.edi'])
+
+    def test_invalid_fsync(self):
+        """ Test that an unknown fsync policy is refused """
+        with self.assertRaises(as2utils.AS2Error):
+            as2utils.storefile(os.path.join(TEST_DIR, 'store'), 'invalid.edi', 'content', False, fsync='sometimes')
+
+
+class ProfileCacheTest(TestCase):
+    """Test cases for the organization and partner profile cache."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.server_crt = models.PublicCertificate()
+        cls.server_crt.certificate.save('as2server.crt',
+                                        File(open(os.path.join(FIXTURES_DIR, 'as2server.crt'), 'r')))
+        cls.server_crt.save()
+        cls.partner = models.Partner.objects.create(name='Cached Partner',
+                                                    as2_name='as2cached',
+                                                    target_url=pyas2init.gsettings['mdn_url'],
+                                                    signature_key=cls.server_crt)
+
+    def test_cached_lookup(self):
+        """ Test that a cached profile and its certificates are returned without queries """
+        models.get_partner('as2cached')
+        with self.assertNumQueries(0):
+            partner = models.get_partner('as2cached')
+            self.assertEqual(partner.signature_key, self.server_crt)
+            self.assertIsNone(partner.encryption_key)
+
+    def test_invalidation(self):
+        """ Test that saving or deleting a profile invalidates the cache """
+        self.assertIsNone(models.get_organization('as2cachedorg'))
+        models.Organization.objects.create(name='Cached Organization', as2_name='as2cachedorg')
+        self.assertIsNotNone(models.get_organization('as2cachedorg'))
+
+        self.partner.subject = 'Changed subject'
+        self.partner.save()
+        self.assertEqual(models.get_partner('as2cached').subject, 'Changed subject')
+
+        models.Partner.objects.get(as2_name='as2cached').delete()
+        self.assertIsNone(models.get_partner('as2cached'))
+
+    def test_rename(self):
+        """ Test that renaming a profile invalidates its previous name """
+        models.Organization.objects.create(name='Renamed Organization', as2_name='as2oldname')
+        self.assertIsNotNone(models.get_organization('as2oldname'))
+        models.Organization.objects.filter(as2_name='as2oldname').update(name='Changed outside the model')
+        organization = models.Organization.objects.get(as2_name='as2oldname')
+        organization.as2_name = 'as2newname'
+        organization.save()
+        self.assertEqual(models.get_organization('as2oldname').name, 'Changed outside the model')
+
+    def test_bounded(self):
+        """ Test that unknown names are not cached and the cache keeps the most recently used profiles """
+        for i in range(10):
+            models.get_partner('as2unknown%s' % i)
+        self.assertNotIn(('Partner', 'as2unknown0'), models._profile_cache)
+
+        size = models.PROFILE_CACHE_SIZE
+        models.PROFILE_CACHE_SIZE = 1
+        try:
+            models.Organization.objects.create(name='Other Organization', as2_name='as2otherorg')
+            models.get_partner('as2cached')
+            models.get_organization('as2otherorg')
+            self.assertEqual(list(models._profile_cache), [('Organization', 'as2otherorg')])
+        finally:
+            models.PROFILE_CACHE_SIZE = size
+
+
+class MessageStatusTest(TestCase):
+    """Test cases for message status transitions."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.organization = models.Organization.objects.create(name='Status Organization', as2_name='as2statusorg')
+        cls.partner = models.Partner.objects.create(name='Status Partner',
+                                                    as2_name='as2statuspartner',
+                                                    target_url=pyas2init.gsettings['mdn_url'],
+                                                    cmd_send='true $messageid')
+        cls.payload = models.Payload.objects.create(name='testmessage.edi',
+                                                    file=os.path.join(TEST_DIR, 'testmessage.edi'),
+                                                    content_type='application/edi-consent')
+
+    def test_post_send_once(self):
+        """ Test that the post send command runs only when the status changes to success """
+        message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                partner=self.partner,
+                                                organization=self.organization,
+                                                direction='OUT',
+                                                status='IP',
+                                                payload=self.payload)
+        message.status = 'S'
+        # One update, two log entries for the post send command and the insert of a new traffic rollup
+        # in a savepoint after its update found none, no select
+        with self.assertNumQueries(7):
+            message.save(update_fields=['status'])
+        with self.assertNumQueries(1):
+            message.save(update_fields=['status'])
+        self.assertEqual(message.logs.filter(event=logevents.POST_SEND_COMMAND).count(), 1)
+        self.assertEqual(message.logs.filter(status='S', event=logevents.COMMAND_FINISHED).count(), 1)
+
+    def test_post_command_result(self):
+        """ Test that failed, timed out and missing commands are logged as errors """
+        message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                partner=self.partner,
+                                                organization=self.organization,
+                                                direction='OUT',
+                                                status='S',
+                                                payload=self.payload)
+        runner = cmdrunner.CommandRunner(workers=0, timeout=1)
+        runner.submit(message.pk, 'false')
+        runner.submit(message.pk, 'sleep 5')
+        runner.submit(message.pk, 'pyas2-nonexistent-command')
+        runner.wait()
+        self.assertEqual(message.logs.filter(status='E', event=logevents.COMMAND_FAILED).count(), 1)
+        self.assertEqual(message.logs.filter(status='E', event=logevents.COMMAND_KILLED).count(), 1)
+        self.assertEqual(message.logs.filter(status='E', event=logevents.COMMAND_START_FAILED).count(), 1)
+        log = message.logs.get(event=logevents.COMMAND_FAILED)
+        self.assertRegexpMatches(log.render(), r'^Command "false" failed with exit code 1 after \d+\.\d seconds$')
+
+    def test_post_command_workers(self):
+        """ Test that commands queue up while the workers are busy, are killed on timeout and are waited for """
+        message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                partner=self.partner,
+                                                organization=self.organization,
+                                                direction='OUT',
+                                                status='S',
+                                                payload=self.payload)
+        runner = SharedConnectionRunner(workers=2, timeout=1)
+        self.addCleanup(setattr, runner.connection, 'allow_thread_sharing', False)
+        start = time.time()
+        for __ in range(4):
+            runner.submit(message.pk, 'sleep 0.3')
+        runner.submit(message.pk, 'sleep 5')
+        self.assertEqual(len(runner.threads), 2)
+        runner.wait()
+        # Four commands on two workers take two rounds, the last one is killed after the timeout
+        self.assertGreaterEqual(time.time() - start, 0.6)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(runner.queue.empty())
+        self.assertEqual(message.logs.filter(status='S', event=logevents.COMMAND_FINISHED).count(), 4)
+        self.assertEqual(message.logs.filter(status='E', event=logevents.COMMAND_KILLED).count(), 1)
+
+
+class SharedConnectionRunner(cmdrunner.CommandRunner):
+    """ Command runner whose workers use the database connection of the test, the in-memory test database can
+    not be opened by other threads """
+
+    def __init__(self, *args, **kwargs):
+        super(SharedConnectionRunner, self).__init__(*args, **kwargs)
+        self.connection = db.connections[db.DEFAULT_DB_ALIAS]
+        self.connection.allow_thread_sharing = True
+
+    def _work(self):
+        db.connections[db.DEFAULT_DB_ALIAS] = self.connection
+        super(SharedConnectionRunner, self)._work()
+
+
+class PartnerTrafficTest(TestCase):
+    """Test cases for the partner traffic rollups and the dashboard."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Traffic Organization', as2_name='as2trafficorg')
+        models.Partner.objects.create(name='Traffic Partner',
+                                      as2_name='as2trafficpartner',
+                                      target_url='http://localhost:1/pyas2/as2receive')
+        cls.payload = models.Payload.objects.create(name='testmessage.edi',
+                                                    file=os.path.join(TEST_DIR, 'testmessage.edi'),
+                                                    content_type='application/edi-consent')
+
+    def create_message(self, status, payload=None):
+        return models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                             partner_id='as2trafficpartner',
+                                             organization_id='as2trafficorg',
+                                             direction='OUT',
+                                             status=status,
+                                             payload=payload)
+
+    def test_rollup(self):
+        """ Test that messages are counted once when they reach a final status """
+        message = self.create_message('IP', payload=self.payload)
+        self.assertFalse(models.PartnerTraffic.objects.exists())
+        for status in ['R', 'S', 'S']:
+            message.status = status
+            message.save(update_fields=['status'])
+        self.create_message('E')
+        # A message with warnings, like a failed MIC check, has been sent as well
+        self.create_message('W')
+        summary = models.PartnerTraffic.summary(timezone.now() - timedelta(days=1))
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['partner'], 'as2trafficpartner')
+        self.assertEqual(summary[0]['sent'], 2)
+        self.assertEqual(summary[0]['send_warnings'], 1)
+        self.assertEqual(summary[0]['send_errors'], 1)
+        self.assertEqual(summary[0]['bytes_sent'], os.path.getsize(self.payload.file))
+
+        # Rebuilding from the messages gives the same totals
+        management.call_command('rebuildas2traffic')
+        self.assertEqual(models.PartnerTraffic.summary(timezone.now() - timedelta(days=1)), summary)
+
+    def test_rebuild_after_cleanup(self):
+        """ Test that the rebuild keeps the totals of the hours whose messages have been deleted """
+        now = timezone.now()
+        purged = models.PartnerTraffic.objects.create(partner='as2trafficpartner', direction='OUT', status='S',
+                                                      hour=models.PartnerTraffic.hour_of(now - timedelta(days=40)),
+                                                      messages=5, bytes=500)
+        # The hour of the oldest message left may have lost its earlier messages
+        oldest = self.create_message('S')
+        oldest_hour = models.PartnerTraffic.hour_of(now - timedelta(days=2))
+        models.Message.objects.filter(pk=oldest.pk).update(timestamp=oldest_hour + timedelta(minutes=30))
+        models.PartnerTraffic.objects.filter(hour=models.PartnerTraffic.hour_of(now)).update(hour=oldest_hour,
+                                                                                          messages=3)
+        self.create_message('E')
+        models.PartnerTraffic.objects.filter(status='E').update(messages=7)
+
+        management.call_command('rebuildas2traffic')
+        self.assertEqual(models.PartnerTraffic.objects.get(pk=purged.pk).messages, 5)
+        self.assertEqual(models.PartnerTraffic.objects.get(hour=oldest_hour).messages, 3)
+        self.assertEqual(models.PartnerTraffic.objects.get(status='E').messages, 1)
+
+        # Without messages nothing is rebuilt
+        models.Message.objects.all().delete()
+        management.call_command('rebuildas2traffic')
+        self.assertEqual(models.PartnerTraffic.objects.count(), 3)
+
+    @override_settings(ROOT_URLCONF='pyas2.webserver.urls')
+    def test_dashboard(self):
+        """ Test that the home view shows the traffic of the partners """
+        self.create_message('S')
+        user = User.objects.create_user('trafficuser', password='trafficpass')
+        client = Client()
+        client.force_login(user)
+        response = client.get('/pyas2/home?days=7')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['traffic'][0]['sent'], 1)
+        self.assertContains(response, 'as2trafficpartner')
+        self.assertEqual(response.context['traffic_days'], 7)
+
+        # Periods that are not offered fall back to a day
+        for days in ['10000000', '-1', 'week']:
+            response = client.get('/pyas2/home?days=%s' % days)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.context['traffic_days'], 1)
+
+
+class QueryCountTest(TestCase):
+    """Test cases for the number of queries of the list and detail views."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Query Organization', as2_name='as2queryorg')
+        certificate = models.PublicCertificate.objects.create(certificate='query_public.pem')
+        models.Partner.objects.create(name='Query Partner',
+                                      as2_name='as2querypartner',
+                                      target_url='http://localhost:1/pyas2/as2receive',
+                                      encryption_key=certificate,
+                                      signature_key=certificate)
+        cls.user = User.objects.create_superuser('queryuser', 'query@example.com', 'querypass')
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.user)
+
+    def create_messages(self, count):
+        for i in range(count):
+            payload = models.Payload.objects.create(name='query%s.edi' % i,
+                                                    file=os.path.join(TEST_DIR, 'testmessage.edi'),
+                                                    content_type='application/edi-consent')
+            mdn = models.MDN.objects.create(message_id=emailutils.make_msgid().strip('<>'), status='R', file='x.mdn')
+            message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                    partner_id='as2querypartner',
+                                                    organization_id='as2queryorg',
+                                                    direction='OUT',
+                                                    status='S',
+                                                    payload=payload,
+                                                    mdn=mdn)
+            models.Log.add(message, 'S', logevents.SENT)
+            models.Log.add(message, 'S', logevents.TRANSFERRED)
+        return message
+
+    def assertQueries(self, count, url):
+        with self.assertNumQueries(count):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(ROOT_URLCONF='pyas2.webserver.urls')
+    def test_constant_queries(self):
+        """ Test that the views run the same number of queries for more rows """
+        # Session and user, then the count and the page of the rows with their related rows, the admin
+        # counts twice and loads the choices of its filters
+        urls = [(4, '/pyas2/message/'), (4, '/pyas2/message/?partner=as2querypartner'), (4, '/pyas2/mdn/'),
+                (6, '/pyas2adm/pyas2/message/'), (5, '/pyas2adm/pyas2/mdn/'), (7, '/pyas2adm/pyas2/partner/')]
+        for rows in (1, 5):
+            message = self.create_messages(rows)
+            for count, url in urls:
+                self.assertQueries(count, url)
+            # The message with its profiles, payload and MDN, then its logs
+            self.assertQueries(4, '/pyas2/message/%s/' % message.pk)
+
+
+class SearchTest(TestCase):
+    """Test cases for searching messages."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Search Organization', as2_name='as2searchorg')
+        models.Partner.objects.create(name='Acme Wholesale',
+                                      as2_name='as2searchpartner',
+                                      target_url='http://localhost:1/pyas2/as2receive')
+        payload = models.Payload.objects.create(name='Invoice_2017.edi',
+                                                file=os.path.join(TEST_DIR, 'testmessage.edi'),
+                                                content_type='application/edi-consent')
+        cls.message = models.Message(message_id='20170401.4711@search.example.com',
+                                     partner_id='as2searchpartner',
+                                     organization_id='as2searchorg',
+                                     direction='OUT',
+                                     status='S',
+                                     payload=payload)
+        cls.message.set_headers([('Subject', 'Weekly Orders'), ('AS2-To', 'as2searchpartner')])
+        cls.message.save()
+        search.index_pending()
+
+    def find(self, text, **kwargs):
+        return list(models.Message.objects.filter(search.query(text, **kwargs)).values_list('pk', flat=True))
+
+    def test_search(self):
+        """ Test substring and prefix matches on the indexed values """
+        pk = self.message.pk
+        self.assertEqual(self.find('4711@SEARCH'), [pk])
+        self.assertEqual(self.find('invoice_'), [pk])
+        self.assertEqual(self.find('orders'), [pk])
+        self.assertEqual(self.find('wholesale'), [pk])
+        self.assertEqual(self.find('orders', match='prefix'), [])
+        self.assertEqual(self.find('weekly', match='prefix'), [pk])
+        self.assertEqual(self.find('2017', fields=['filename']), [pk])
+        self.assertEqual(self.find('weekly', fields=['filename']), [])
+        self.assertEqual(self.find('nothing like this'), [])
+
+    def test_reindex(self):
+        """ Test that the terms follow changes of the headers and are not duplicated """
+        self.message.set_headers([('Subject', 'Monthly Report')])
+        self.message.save(update_fields=['headers', 'subject'])
+        # The save only marks the message, the terms are written afterwards
+        self.assertEqual(self.find('report'), [])
+        self.assertEqual(search.index_pending(), 1)
+        self.assertFalse(models.Message.objects.get(pk=self.message.pk).search_pending)
+        self.assertEqual(self.find('weekly'), [])
+        self.assertEqual(self.find('report'), [self.message.pk])
+        self.assertEqual(models.SearchTerm.objects.filter(message=self.message, field='header:subject',
+                                                          term='mon', prefix=True).count(), 1)
+
+        # A save that leaves the values as they were only reads the terms
+        with self.assertNumQueries(1):
+            search.index_message(self.message)
+
+    def test_distinct_terms(self):
+        """ Test that a trigram is stored once per value and the number of terms of a value is capped """
+        self.assertEqual(search.terms('abcabcab'), set([('abc', True), ('bca', False), ('cab', False),
+                                                        ('ab', False), ('b', False)]))
+        value = ''.join(chr(ord('a') + i % 26) + chr(ord('a') + i // 26) for i in range(50))
+        self.assertEqual(len(search.terms(value)), search.MAX_TERMS)
+        message = models.Message.objects.create(message_id='0' * 100, direction='OUT', status='S')
+        management.call_command('rebuildas2search', pending=True)
+        self.assertEqual(models.SearchTerm.objects.filter(message=message).count(), 3)
+        self.assertEqual(self.find('00000'), [message.pk])
+
+    def test_trigram_matches(self):
+        """ Test that texts of any length are found and trigrams found apart from each other do not match """
+        pk = self.message.pk
+        self.assertEqual(self.find('m'), [pk])
+        self.assertEqual(self.find('om'), [pk])
+        self.assertEqual(self.find('20170401.4711@search.example'), [pk])
+        self.assertEqual(self.find('inv', match='prefix'), [pk])
+        self.assertEqual(self.find('voi', match='prefix'), [])
+        # Both trigrams are in the message id, but not next to each other
+        self.assertEqual(self.find('201search'), [])
+
+    def test_postgresql_lookups(self):
+        """ Test that the columns are compared on PostgreSQL as the trigram indexes of 0028 are built on them """
+        indexed = ['"%s"."%s"' % column for column in
+                   import_module('pyas2.migrations.0028_searchterm').TRIGRAM_COLUMNS]
+        for field in search.COLUMNS.keys() + ['header:x-custom']:
+            for match, pattern in [('contains', u'%In\\%V%'), ('prefix', u'In\\%V%')]:
+                queryset = models.Message.objects.filter(search._confirm(field, match, 'In%V'))
+                lookup = queryset.query.where.children[0]
+                sql, params = lookup.as_postgresql(queryset.query.get_compiler(using='default'), db.connection)
+                column, operator = sql.split(' ', 1)
+                self.assertIn(column, indexed)
+                self.assertEqual(operator, 'ILIKE %s')
+                if field != 'header:x-custom':
+                    self.assertEqual(params, [pattern])
+        # The other databases match as before
+        self.assertEqual(self.find('INVOICE_2017', fields=['filename']), [self.message.pk])
+
+    @override_settings(ROOT_URLCONF='pyas2.webserver.urls')
+    def test_filename_filter(self):
+        """ Test that the payload name filter of the message list matches exactly, or as a prefix on request """
+        client = Client()
+        client.force_login(User.objects.create_superuser('searcher', 'searcher@example.com', 'password'))
+        for query, count in [('filename=Invoice_2017.edi', 1), ('filename=Invoice', 0),
+                             ('filename_prefix=Invoice', 1)]:
+            response = client.get('/pyas2/message/?%s' % query)
+            self.assertEqual(len(response.context['object_list']), count, query)
+
+
+class LogEventsTest(TestCase):
+    """ Test the message logs stored as events """
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Log Organization', as2_name='as2logorg')
+        models.Partner.objects.create(name='Log Partner',
+                                      as2_name='as2logpartner',
+                                      target_url='http://localhost:1/pyas2/as2receive')
+        cls.message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                    partner_id='as2logpartner',
+                                                    organization_id='as2logorg',
+                                                    direction='OUT',
+                                                    status='S')
+
+    def test_render(self):
+        """ Test that the text of a log is rendered from its event and parameters """
+        log = models.Log.add(self.message, 'E', logevents.SEND_FAILED, error=IOError('Connection refused'))
+        log = models.Log.objects.get(pk=log.pk)
+        self.assertIsNone(log.text)
+        self.assertEqual(json.loads(log.params), {'error': 'Connection refused'})
+        self.assertEqual(log.render(), 'Failed to send message, error is Connection refused')
+        self.assertEqual(models.Log.objects.create(message=self.message, status='S', text='Free text').render(),
+                         'Free text')
+
+    def test_compact(self):
+        """ Test that the texts of existing logs are converted to their events """
+        texts = ['Processing incoming AS2 message: %s' % self.message.message_id,
+                 'Message is for Organization <as2logorg> from Partner <as2logpartner>',
+                 'Command "false" failed with exit code 1 after 0.1 seconds',
+                 'AS2 message successfully sent to partner',
+                 'Some error from a partner']
+        for text in texts:
+            models.Log.objects.create(message=self.message, status='S', text=text)
+        self.assertEqual(logevents.compact(models.Log), 4)
+        logs = models.Log.objects.filter(message=self.message).order_by('pk')
+        self.assertEqual([log.event for log in logs], [logevents.INBOUND_RECEIVED, logevents.INBOUND_PROFILES,
+                                                        logevents.COMMAND_FAILED, logevents.SENT, None])
+        self.assertEqual([log.render() for log in logs][1:], texts[1:])
+        self.assertEqual(json.loads(logs[2].params), {'command': 'false', 'code': 1, 'duration': 0.1})
+
+
+class StartupTest(TestCase):
+    """Test cases for the initialization of the short lived commands."""
+
+    def test_initialize_once(self):
+        """ Test that initializing again keeps the settings and the logging """
+        handlers = list(pyas2init.logger.handlers)
+        root_dir = pyas2init.gsettings['root_dir']
+        pyas2init.initialize()
+        self.assertEqual(pyas2init.logger.handlers, handlers)
+        self.assertEqual(pyas2init.gsettings['root_dir'], root_dir)
+
+    def test_deferred_imports(self):
+        """ Test that the commands load the crypto and http libraries only when they use them """
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='pyas2.tests.settings', PYAS2_QUIET='1')
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, django; django.setup(); '
+                                   'from pyas2.management.commands import sendasyncmdn, retryfailedas2comms; '
+                                   'print([m for m in ("M2Crypto", "pyasn1", "requests") if m in sys.modules])'],
+            cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), env=env)
+        self.assertEqual(output.strip(), '[]')
+
+
+class JobTest(TestCase):
+    """Test cases for the jobs submitted to the job server."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Job Organization', as2_name='as2joborg')
+        models.Partner.objects.create(name='Job Partner', as2_name='as2jobpartner',
+                                      target_url=pyas2init.gsettings['mdn_url'])
+
+    def test_run_jobs(self):
+        """ Test that submitted jobs wait in the queue and the job server runs them """
+        job = jobs.submit('sendasyncmdn')
+        failing = jobs.submit('sendas2message', 'as2joborg', 'as2jobpartner', '/nonexistent/file.edi')
+        self.assertEqual(job.status, 'Q')
+        self.assertRaises(ValueError, jobs.submit, 'cleanas2server')
+
+        self.assertEqual(jobs.JobServer(0, 1).run_pending(), 2)
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'S')
+        self.assertIsNotNone(job.duration())
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, 'E')
+        self.assertTrue(failing.error)
+        self.assertEqual(jobs.JobServer(0, 1).run_pending(), 0)
+
+    def test_recover(self):
+        """ Test that jobs left running by a stopped process are marked as failed """
+        stopped = subprocess.Popen([sys.executable, '-c', 'pass'])
+        stopped.wait()
+        lost = models.Job.objects.create(command='sendasyncmdn', status='R',
+                                         node='%s:%s' % (socket.gethostname(), stopped.pid))
+        running = models.Job.objects.create(command='sendasyncmdn', status='R', node=jobs.node_name())
+        self.assertEqual(jobs.JobServer(0, 1).recover(), 1)
+        self.assertEqual(models.Job.objects.get(pk=lost.pk).status, 'E')
+        self.assertEqual(models.Job.objects.get(pk=running.pk).status, 'R')
+
+    def test_daemon_dispatch(self):
+        """ Test that the send daemon submits a job for the files it claims and the job ends the claim """
+        outbox = as2utils.join(pyas2init.gsettings['root_dir'], 'messages', 'as2jobpartner', 'outbox', 'as2joborg')
+        sent = as2utils.join(outbox, 'testmessage.edi')
+        failed = as2utils.join(outbox, 'failedmessage.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), sent)
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), failed)
+        models.Outbox.objects.create(organization='as2joborg', partner='as2jobpartner', mtime=1.0)
+        runas2daemon.dispatch([('as2joborg', 'as2jobpartner', sent), ('as2joborg', 'as2jobpartner', failed)],
+                              'testnode')
+        self.assertEqual(models.Job.objects.get(args__contains='testmessage').arguments(),
+                         ['--delete', 'as2joborg', 'as2jobpartner', sent])
+
+        # The claims are held while the jobs are queued
+        self.assertEqual(models.Job.objects.filter(lease_node='testnode').count(), 2)
+        self.assertFalse(models.OutboxFile.objects.filter(lease_expires=None).exists())
+
+        # A sent file is handed over, the lease on a file that could not be sent expires
+        os.remove(failed)
+        jobs.JobServer(0, 1).run_pending()
+        self.assertIsNone(models.OutboxFile.objects.get(filename='testmessage.edi').lease_expires)
+        self.assertLessEqual(models.OutboxFile.objects.get(filename='failedmessage.edi').lease_expires,
+                             timezone.now())
+        self.assertIsNone(models.Outbox.objects.get().mtime)
+
+    def test_daemon_resend(self):
+        """ Test that the file of an interrupted job is sent again by the running daemon """
+        outbox = as2utils.join(pyas2init.gsettings['root_dir'], 'messages', 'as2jobpartner', 'outbox', 'as2joborg')
+        filename = as2utils.join(outbox, 'resent.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), filename)
+        tasks = set()
+        watcher = runas2daemon.OutboxWatcher(threading.Condition(), tasks)
+        watcher.refresh()
+        runas2daemon.dispatch(list(tasks), 'testnode')
+        tasks.clear()
+
+        # The job server stopped while it was sending the file
+        stopped = subprocess.Popen([sys.executable, '-c', 'pass'])
+        stopped.wait()
+        models.Job.objects.update(status='R', node='%s:%s' % (socket.gethostname(), stopped.pid))
+        self.assertEqual(jobs.JobServer(0, 1).recover(), 1)
+        self.assertIsNone(models.Outbox.objects.get(partner='as2jobpartner').mtime)
+
+        watcher.refresh()
+        self.assertEqual(tasks, set([('as2joborg', 'as2jobpartner', filename)]))
+        runas2daemon.dispatch(list(tasks), 'testnode')
+        self.assertEqual(jobs.JobServer(0, 1).run_pending(), 1)
+        self.assertFalse(os.path.exists(filename))
+        self.assertTrue(models.Message.objects.filter(organization='as2joborg').exists())
+        self.assertIsNone(models.OutboxFile.objects.get(filename='resent.edi').lease_expires)
+
+    @override_settings(ROOT_URLCONF='pyas2.webserver.urls')
+    def test_send_upload(self):
+        """ Test that an uploaded file is streamed into the send store and sent from there """
+        client = Client()
+        client.force_login(User.objects.create_superuser('jobsender', 'jobsender@example.com', 'password'))
+        staging_dir = pyas2init.gsettings['upload_staging_dir']
+        with open(os.path.join(TEST_DIR, 'testmessage.edi'), 'rb') as upload, \
+                open(os.path.join(TEST_DIR, 'testmessage.edi'), 'rb') as extra:
+            client.post('/pyas2/sendmessage/', {'organization': 'as2joborg', 'partner': 'as2jobpartner',
+                                                'file': upload, 'extra': extra})
+        job = models.Job.objects.get()
+        path = job.arguments()[-1]
+        self.assertEqual(job.arguments()[:3], ['--stored', 'as2joborg', 'as2jobpartner'])
+        self.assertTrue(path.startswith(pyas2init.gsettings['payload_send_store']))
+        self.assertEqual(as2utils.readdata(path), as2utils.readdata(os.path.join(TEST_DIR, 'testmessage.edi')))
+        self.assertEqual(os.listdir(staging_dir), [])
+
+        jobs.JobServer(0, 1).run_pending()
+        self.assertEqual(models.Message.objects.get(organization='as2joborg').payload.file, path)
+
+        # The files of an invalid form or a request without the csrf token are not kept
+        stored = os.listdir(os.path.dirname(path))
+        with open(os.path.join(TEST_DIR, 'testmessage.edi'), 'rb') as upload:
+            client.post('/pyas2/sendmessage/', {'organization': 'as2joborg', 'partner': 'unknown', 'file': upload})
+        csrf_client = Client(enforce_csrf_checks=True)
+        csrf_client.force_login(User.objects.get(username='jobsender'))
+        with open(os.path.join(TEST_DIR, 'testmessage.edi'), 'rb') as upload:
+            response = csrf_client.post('/pyas2/sendmessage/', {'organization': 'as2joborg',
+                                                                'partner': 'as2jobpartner', 'file': upload})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(models.Job.objects.count(), 1)
+        self.assertEqual(os.listdir(os.path.dirname(path)), stored)
+        self.assertEqual(os.listdir(staging_dir), [])
+
+    @override_settings(ROOT_URLCONF='pyas2.webserver.urls')
+    def test_job_list(self):
+        """ Test that the jobs started from the web UI are listed with their status """
+        client = Client()
+        client.force_login(User.objects.create_superuser('jobadmin', 'jobadmin@example.com', 'password'))
+        client.get('/pyas2/sendasyncmdn/')
+        response = client.get('/pyas2/jobs/')
+        self.assertContains(response, 'sendasyncmdn')
+        self.assertContains(response, 'Queued')
+
+
+class IndexUsageTest(TestCase):
+    """Test cases for the indexes of the status, direction and timestamp queries, checked in the SQLite query
+    plans so that the choice of the indexes can be reproduced."""
+
+    def plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with db.connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(row[-1] for row in cursor.fetchall())
+
+    def index(self, model, columns):
+        with db.connection.cursor() as cursor:
+            for name, info in db.connection.introspection.get_constraints(cursor, model._meta.db_table).items():
+                if info['index'] and info['columns'] == columns:
+                    return name
+
+    def test_query_plans(self):
+        """ Test that the queries of the commands and the message list search the new indexes """
+        now = timezone.now()
+        message_status = self.index(models.Message, ['status', 'direction', 'timestamp'])
+        queries = [
+            # retryfailedas2comms
+            (models.Message.objects.filter(status='R', direction='OUT'), message_status),
+            # sendasyncmdn
+            (models.MDN.objects.filter(status='P'), self.index(models.MDN, ['status', 'timestamp'])),
+            (models.Message.objects.filter(status='P', direction='OUT', timestamp__lt=now), message_status),
+            # message list, first pages of all messages, of a partner and of a status in a month
+            (models.Message.objects.order_by('-timestamp')[:25], self.index(models.Message, ['timestamp'])),
+            (models.Message.objects.filter(partner='as2partner').order_by('-timestamp')[:25],
+             self.index(models.Message, ['partner_id', 'timestamp'])),
+            (models.Message.objects.filter(organization='as2org').order_by('-timestamp')[:25],
+             self.index(models.Message, ['organization_id', 'timestamp'])),
+            (models.Message.objects.filter(status='E', timestamp__gte=now - timedelta(days=30)), message_status),
+        ]
+        for queryset, index in queries:
+            self.assertIsNotNone(index)
+            self.assertRegexpMatches(self.plan(queryset), r'USING (COVERING )?INDEX %s\b' % index)
+        # The partner index returns the page in order, without sorting the messages of the partner
+        self.assertNotIn('TEMP B-TREE', self.plan(queries[4][0]))
+
+
+class SQLiteTuningTest(TestCase):
+    """Test cases for the configuration of SQLite connections."""
+
+    def test_tune_sqlite(self):
+        """ Test that the WAL journal and the pragmas of the settings are applied """
+        path = os.path.join(TEST_DIR, 'tuning.sqlite3')
+        self.addCleanup(os.remove, path)
+        connection = sqlite3.connect(path)
+        self.addCleanup(connection.close)
+        pyas2init.tune_sqlite(connection)
+        self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEqual(connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+        self.assertEqual(connection.execute('PRAGMA busy_timeout').fetchone()[0], 20000)
+        self.assertEqual(connection.execute('PRAGMA cache_size').fetchone()[0], -20000)
+
+    def test_connection_created(self):
+        """ Test that the connections opened by django are tuned """
+        with db.connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 20000)
+
+
+class PartitionsTest(TestCase):
+    """Test cases for the monthly partitions of the message and log tables."""
+
+    def test_months(self):
+        """ Test the month arithmetic and the names of the partitions """
+        self.assertEqual(partitions.add_months(datetime(2016, 11, 1), 2), datetime(2017, 1, 1))
+        self.assertEqual(partitions.add_months(datetime(2017, 1, 1), -1), datetime(2016, 12, 1))
+        name = partitions.partition_name('pyas2_log', datetime(2017, 3, 1))
+        self.assertEqual(name, 'pyas2_log_y2017m03')
+        self.assertEqual(partitions.partition_month('pyas2_log', name), datetime(2017, 3, 1))
+        self.assertIsNone(partitions.partition_month('pyas2_log', 'pyas2_log_default'))
+
+    def test_unsupported_database(self):
+        """ Test that partitioning is refused and retention skips it on SQLite """
+        with self.assertRaises(management.CommandError):
+            management.call_command('partitionas2tables', convert=True)
+        self.assertEqual(partitions.drop_partitions(timezone.now()), [])
+
+    def test_dry_run(self):
+        """ Test the statements converting the message table, on the catalog rows of a PostgreSQL database """
+        results = [
+            [('CREATE INDEX pyas2_message_d7e6d55b ON public.pyas2_message USING btree ("timestamp")',)],
+            [('pyas2_message_payload_id_key', 'UNIQUE (payload_id)'),
+             ('pyas2_message_mdn_id_fk', 'FOREIGN KEY (mdn_id) REFERENCES pyas2_mdn(message_id)')],
+            [('pyas2_log', 'pyas2_log_message_id_fk'), ('pyas2_searchterm', 'pyas2_searchterm_message_id_fk')],
+            [(None,)],
+            [(datetime(2016, 11, 5),)],
+        ]
+        cursor = partitions.DryRunCursor(CatalogCursor(results))
+        partitions._convert_table(cursor, models.Message, 1)
+        statements = cursor.statements
+        self.assertEqual(statements[:4], [
+            'ALTER TABLE pyas2_log DROP CONSTRAINT pyas2_log_message_id_fk',
+            'ALTER TABLE pyas2_searchterm DROP CONSTRAINT pyas2_searchterm_message_id_fk',
+            'ALTER TABLE pyas2_message RENAME TO pyas2_message_unpartitioned',
+            'CREATE TABLE pyas2_message (LIKE pyas2_message_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS, '
+            'PRIMARY KEY (message_id, timestamp)) PARTITION BY RANGE (timestamp)'])
+        self.assertEqual(statements[4], "CREATE TABLE IF NOT EXISTS pyas2_message_y2016m11 PARTITION OF "
+                                        "pyas2_message FOR VALUES FROM ('2016-11-01 00:00:00+00') "
+                                        "TO ('2016-12-01 00:00:00+00')")
+        next_month = partitions.add_months(partitions.month_of(datetime.utcnow()), 1)
+        self.assertIn(partitions.partition_name('pyas2_message', next_month), statements[-10])
+        self.assertEqual(statements[-9:-5], [
+            'INSERT INTO pyas2_message SELECT * FROM pyas2_message_unpartitioned',
+            'DROP TABLE pyas2_message_unpartitioned',
+            'CREATE INDEX pyas2_message_d7e6d55b ON public.pyas2_message USING btree ("timestamp")',
+            'CREATE INDEX pyas2_message_payload_id_key ON pyas2_message (payload_id)'])
+        self.assertEqual(statements[-5], 'ALTER TABLE pyas2_message ADD CONSTRAINT pyas2_message_mdn_id_fk '
+                                         'FOREIGN KEY (mdn_id) REFERENCES pyas2_mdn(message_id)')
+        # The message ids stay unique through the message key table
+        self.assertEqual(statements[-4:-2], [
+            'CREATE TABLE pyas2_message_key (message_id varchar(100) PRIMARY KEY)',
+            'INSERT INTO pyas2_message_key (message_id) SELECT message_id FROM pyas2_message'])
+        self.assertTrue(statements[-2].startswith('CREATE FUNCTION pyas2_message_key()'))
+        self.assertEqual(statements[-1], 'CREATE TRIGGER pyas2_message_key AFTER INSERT OR UPDATE OR DELETE ON '
+                                         'pyas2_message FOR EACH ROW EXECUTE PROCEDURE pyas2_message_key()')
+
+    def test_dry_run_command(self):
+        """ Test that the dry run of the command needs PostgreSQL as well """
+        with self.assertRaises(management.CommandError):
+            management.call_command('partitionas2tables', convert=True, dry_run=True)
+
+
+class CatalogCursor(object):
+    """ Cursor returning the given results of the queries in turn """
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.result = None
+
+    def execute(self, sql, params=None):
+        self.result = self.results.pop(0)
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+@skipUnless(partitions.supported(partitions.get_connection()), 'Partitioning needs PostgreSQL 11 or later')
+class PostgreSQLPartitionsTest(TestCase):
+    """Test cases for the partitioned tables, run when the tests use a PostgreSQL 11 database."""
+
+    def test_convert(self):
+        """ Test the conversion, the unique message ids and the dropped months """
+        management.call_command('partitionas2tables', convert=True, months=1)
+        last_month = partitions.add_months(partitions.month_of(datetime.utcnow()), -1)
+        with db.connection.cursor() as cursor:
+            self.assertTrue(partitions.is_partitioned(cursor, models.Message._meta.db_table))
+            self.assertTrue(partitions.is_partitioned(cursor, models.Log._meta.db_table))
+            partitions.create_partition(cursor, models.Message._meta.db_table, last_month)
+            partitions.create_partition(cursor, models.Log._meta.db_table, last_month)
+
+        message = models.Message.objects.create(message_id='partitioned', direction='IN', status='S')
+        models.Message.objects.filter(pk=message.pk).update(timestamp=timezone.make_aware(last_month, timezone.utc))
+        with self.assertRaises(db.IntegrityError), db.transaction.atomic():
+            models.Message.objects.create(message_id='partitioned', direction='IN', status='S')
+
+        # The ids of the messages of a dropped month can be used again
+        self.assertIn(partitions.partition_name(models.Message._meta.db_table, last_month),
+                      partitions.drop_partitions(datetime.utcnow()))
+        self.assertFalse(models.Message.objects.filter(pk='partitioned').exists())
+        models.Message.objects.create(message_id='partitioned', direction='IN', status='S')
+
+
+class MessageHeadersTest(TestCase):
+    """Test cases for the structured message headers."""
+
+    def test_header_columns(self):
+        """ Test that headers are stored as json and the indexed columns are set """
+        message = models.Message(message_id=emailutils.make_msgid().strip('<>'), direction='OUT', status='IP')
+        message.set_headers([('AS2-From', '"as2 client"'), ('AS2-To', 'as2server'), ('Subject', 'Test headers')])
+        message.save()
+
+        message = models.Message.objects.get(as2_from='as2 client', as2_to='as2server', subject='Test headers')
+        self.assertEqual(message._headers()['AS2-To'], 'as2server')
+        self.assertIs(message._headers(), message._headers())
+
+    def test_legacy_headers(self):
+        """ Test that headers stored as raw text can still be read """
+        message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                direction='IN',
+                                                status='IP',
+                                                headers='as2-from: as2client\nas2-to: as2server\n')
+        self.assertEqual(message.as2_from, 'as2client')
+        self.assertEqual(message._headers(), {'as2-from': 'as2client', 'as2-to': 'as2server'})
+
+    def test_migrate_headers(self):
+        """ Test that the migration to json unescapes the as2 names like the model and decodes invalid bytes """
+        migration = import_module('pyas2.migrations.0021_structured_headers')
+        message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                direction='IN', status='IP')
+        models.Message.objects.filter(pk=message.pk).update(
+            headers=u'as2-from: "as2 \\"client\\""\nas2-to: as2server\nsubject: caf\xe9\n',
+            as2_from=None, as2_to=None, subject=None)
+        migration.text_to_json(apps, None)
+
+        message = models.Message.objects.get(pk=message.pk)
+        self.assertEqual((message.as2_from, message.as2_to, message.subject),
+                         ('as2 "client"', 'as2server', u'caf\xe9'))
+        self.assertEqual(json.loads(message.headers)[0], ['as2-from', '"as2 \\"client\\""'])
+        self.assertEqual(migration.to_text('caf\xe9'), u'caf\ufffd')
+
+
+class ExpectContinueHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Partner endpoint that accepts posts to /accept and rejects posts to /reject after the headers, posts to
+    /processing get a 102 Processing first and posts to /close are dropped without an answer."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.paths.append(self.path)
+        path = urlparse.urlsplit(self.path).path
+        if path in ('/reject', '/close'):
+            self.close_connection = 1
+            if path == '/reject':
+                self.send_response(413)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            return
+        if path == '/processing':
+            self.wfile.write('HTTP/1.1 102 Processing\r\n\r\n')
+        if self.headers.get('expect') == '100-continue':
+            self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+        self.server.received.append(self.rfile.read(int(self.headers['content-length'])))
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('OK')
+
+    def log_message(self, *args):
+        pass
+
+
+def start_partner_server(test):
+    """Start a partner endpoint for the duration of the test, returns the server and its url."""
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ExpectContinueHandler)
+    server.received = []
+    server.paths = []
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    test.addCleanup(server.server_close)
+    test.addCleanup(server.shutdown)
+    return server, 'http://127.0.0.1:%s' % server.server_port
+
+
+class PostMessageTest(TestCase):
+    """Test cases for posting messages to partners."""
+
+    def setUp(self):
+        self.server, self.url = start_partner_server(self)
+
+    def test_expect_continue(self):
+        """ Test that the body is sent after 100 Continue and not sent when the headers are rejected """
+        with open(os.path.join(TEST_DIR, 'testmessage.edi'), 'rb') as body:
+            response = as2lib.post_message(self.url + '/accept', {'AS2-To': 'as2server'}, body,
+                                           timeout=(5, 5), expect_continue=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'OK')
+        self.assertEqual(self.server.received, [as2utils.readdata(os.path.join(TEST_DIR, 'testmessage.edi'))])
+
+        response = as2lib.post_message(self.url + '/reject', {'AS2-To': 'as2server'}, 'x' * 100000,
+                                       timeout=(5, 5), expect_continue=True)
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(len(self.server.received), 1)
+
+    def test_interim_responses(self):
+        """ Test that interim responses other than 100 Continue are skipped and that a connection closed before
+        the answer is reported """
+        response = as2lib.post_message(self.url + '/processing', {'AS2-To': 'as2server'}, 'x' * 100,
+                                       timeout=(5, 5), expect_continue=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.received, ['x' * 100])
+
+        with self.assertRaisesRegexp(requests.exceptions.ConnectionError, 'Connection closed'):
+            as2lib.post_message(self.url + '/close', {'AS2-To': 'as2server'}, 'x' * 100,
+                                timeout=(5, 5), expect_continue=True)
+        self.assertEqual(len(self.server.received), 1)
+
+    def test_proxy(self):
+        """ Test that posts with and without the expectation go through the proxy of the environment """
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        for name in ('no_proxy', 'NO_PROXY', 'all_proxy', 'ALL_PROXY'):
+            os.environ.pop(name, None)
+        os.environ['http_proxy'] = self.url
+        for expect_continue in (True, False):
+            response = as2lib.post_message('http://as2partner.invalid/accept?b=1', {'AS2-To': 'as2server'}, 'x',
+                                           timeout=(5, 5), expect_continue=expect_continue)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.paths, ['http://as2partner.invalid/accept?b=1'] * 2)
+
+    def test_streamed_post(self):
+        """ Test that a file body is posted with its length """
+        with open(os.path.join(TEST_DIR, 'testmessage.edi'), 'rb') as body:
+            response = as2lib.post_message(self.url + '/accept', {'AS2-To': 'as2server'}, body, timeout=(5, 5))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.server.received, [as2utils.readdata(os.path.join(TEST_DIR, 'testmessage.edi'))])
+
+
+class RetryTest(TestCase):
+    """Test cases for retrying failed sends."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Retry Organization', as2_name='as2retryorg')
+        models.Partner.objects.create(name='Retry Partner',
+                                      as2_name='as2retrypartner',
+                                      compress=True,
+                                      target_url='http://localhost:1/pyas2/as2receive')
+
+    def setUp(self):
+        self.server, url = start_partner_server(self)
+        models.Partner.objects.filter(as2_name='as2retrypartner').update(target_url=url + '/accept')
+        payload = models.Payload.objects.create(name='testmessage.edi',
+                                                file=os.path.join(TEST_DIR, 'testmessage.edi'),
+                                                content_type='application/edi-consent')
+        self.message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                     partner_id='as2retrypartner',
+                                                     organization_id='as2retryorg',
+                                                     direction='OUT',
+                                                     status='IP',
+                                                     payload=payload)
+        self.content = as2lib.build_message(self.message)
+        self.addCleanup(os.remove, self.message.raw_file)
+        models.Message.objects.filter(pk=self.message.pk).update(status='R')
+
+    def build_count(self):
+        return models.Log.objects.filter(message=self.message, event=logevents.BUILDING).count()
+
+    def test_resend_built_message(self):
+        """ Test that a retry posts the stored message without building it again """
+        self.assertEqual(as2utils.readdata(self.message.raw_file), self.content)
+        self.assertEqual(models.Message.objects.get(pk=self.message.pk).raw_file, self.message.raw_file)
+        management.call_command('retryfailedas2comms')
+        self.assertEqual(self.server.received, [self.content])
+        self.assertEqual(self.build_count(), 1)
+        self.assertEqual(models.Message.objects.get(pk=self.message.pk).status, 'S')
+
+    def test_stale_archive(self):
+        """ Test that the archive of an earlier build is not recorded on a message built again since """
+        models.Message.objects.filter(pk=self.message.pk).update(raw_file=None)
+        earlier = models.Message.objects.get(pk=self.message.pk)
+        earlier.build_hash = 'earlier build'
+        rawarchive.RawArchive(False).submit(earlier, 'earlier content')
+        self.assertIsNone(models.Message.objects.get(pk=self.message.pk).raw_file)
+
+        rawarchive.RawArchive(False).submit(models.Message.objects.get(pk=self.message.pk), self.content)
+        self.assertEqual(as2utils.readdata(models.Message.objects.get(pk=self.message.pk).raw_file), self.content)
+        self.addCleanup(os.remove, models.Message.objects.get(pk=self.message.pk).raw_file)
+
+    def test_changed_profile(self):
+        """ Test that the message is built again after the partner profile changed """
+        partner = models.Partner.objects.get(as2_name='as2retrypartner')
+        partner.compress = False
+        partner.save()
+        management.call_command('retryfailedas2comms')
+        self.assertEqual(self.build_count(), 2)
+        self.assertNotEqual(self.server.received, [self.content])
+        self.addCleanup(os.remove, models.Message.objects.get(pk=self.message.pk).raw_file)
+
+
+class SendFilesTest(TestCase):
+    """Test cases for sending a batch of files."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Batch Organization', as2_name='as2batchorg')
+        models.Partner.objects.create(name='Batch Partner',
+                                      as2_name='as2batchpartner',
+                                      compress=False,
+                                      target_url='http://localhost:1/pyas2/as2receive')
+
+    def setUp(self):
+        self.batch_dir = os.path.join(TEST_DIR, 'batch')
+        os.mkdir(self.batch_dir)
+        self.addCleanup(shutil.rmtree, self.batch_dir)
+        for name in ['first.edi', 'second.edi']:
+            shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), os.path.join(self.batch_dir, name))
+
+    def test_send_directory(self):
+        """ Test that all files of a directory are sent and summarized """
+        out = StringIO()
+        management.call_command('sendas2message', 'as2batchorg', 'as2batchpartner', self.batch_dir,
+                                delete=True, stdout=out)
+        self.assertEqual(models.Message.objects.filter(partner='as2batchpartner').count(), 2)
+        self.assertEqual(os.listdir(self.batch_dir), [])
+        self.assertIn('Processed 2 files', out.getvalue())
+
+    def test_send_glob(self):
+        """ Test that a glob pattern is only expanded with --glob and a file name with brackets is sent as it is """
+        bracketed = os.path.join(self.batch_dir, 'order[1].edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), os.path.join(self.batch_dir, 'order1.edi'))
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), bracketed)
+        management.call_command('sendas2message', 'as2batchorg', 'as2batchpartner', bracketed, delete=True)
+        self.assertEqual(models.Message.objects.get(partner='as2batchpartner').payload.name, 'order[1].edi')
+        self.assertEqual(sorted(os.listdir(self.batch_dir)), ['first.edi', 'order1.edi', 'second.edi'])
+
+        out = StringIO()
+        management.call_command('sendas2message', 'as2batchorg', 'as2batchpartner',
+                                os.path.join(self.batch_dir, '*st.edi'), glob=True, delete=True, stdout=out)
+        self.assertIn('Processed 1 files', out.getvalue())
+        self.assertEqual(sorted(os.listdir(self.batch_dir)), ['order1.edi', 'second.edi'])
+
+    def test_send_manifest(self):
+        """ Test that missing files in a manifest are reported and fail the command """
+        manifest = os.path.join(self.batch_dir, 'manifest.txt')
+        with open(manifest, 'w') as manifest_file:
+            manifest_file.write('# files to send\nfirst.edi\nmissing.edi\n')
+        out = StringIO()
+        with self.assertRaises(management.CommandError):
+            management.call_command('sendas2message', 'as2batchorg', 'as2batchpartner', manifest,
+                                    manifest=True, stdout=out)
+        self.assertEqual(models.Message.objects.filter(partner='as2batchpartner').count(), 1)
+        self.assertIn('1 failed', out.getvalue())
+        self.assertIn('missing.edi', out.getvalue())
+
+
+class FanOutTest(TestCase):
+    """Test cases for sending one file to many partners."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Fan-out Organization', as2_name='as2fanoutorg')
+        for as2_name in ['as2fanout1', 'as2fanout2', 'as2fanout3']:
+            models.Partner.objects.create(name=as2_name,
+                                          as2_name=as2_name,
+                                          compress=as2_name != 'as2fanout3',
+                                          target_url='http://localhost:1/pyas2/as2receive')
+
+    def test_fan_out(self):
+        """ Test that each partner gets its own message for the same stored file """
+        source = os.path.join(TEST_DIR, 'fanout.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), source)
+        out = StringIO()
+        management.call_command('sendas2fanout', 'as2fanoutorg', source, 'as2fanout1', 'as2fanout2', 'as2fanout3',
+                                delete=True, workers=1, stdout=out)
+        self.assertFalse(os.path.exists(source))
+        messages = models.Message.objects.filter(organization='as2fanoutorg')
+        self.assertEqual(sorted(m.partner_id for m in messages), ['as2fanout1', 'as2fanout2', 'as2fanout3'])
+        self.assertEqual(len(set(m.payload.file for m in messages)), 1)
+        self.assertIn('Processed 3 partners', out.getvalue())
+
+    def test_shared_steps(self):
+        """ Test that partners with the same settings share the compressed payload """
+        cache = as2lib.BuildCache()
+        contents = []
+        for as2_name in ['as2fanout1', 'as2fanout2', 'as2fanout3']:
+            payload = models.Payload.objects.create(name='testmessage.edi',
+                                                    file=os.path.join(TEST_DIR, 'testmessage.edi'),
+                                                    content_type='application/edi-consent')
+            message = models.Message.objects.create(message_id=emailutils.make_msgid().strip('<>'),
+                                                    partner_id=as2_name,
+                                                    organization_id='as2fanoutorg',
+                                                    direction='OUT',
+                                                    status='IP',
+                                                    payload=payload)
+            contents.append(as2lib.build_message(message, cache=cache))
+        self.assertEqual(contents[0], contents[1])
+        self.assertNotEqual(contents[0], contents[2])
+        # One payload step and one compression step
+        self.assertEqual(len(cache.steps), 2)
+
+
+class SendDaemonTest(TestCase):
+    """Test cases for the outbox watching of the send daemon."""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Organization.objects.create(name='Daemon Organization', as2_name='as2daemonorg')
+        cls.partner = models.Partner.objects.create(name='Daemon Partner',
+                                                    as2_name='as2daemonpartner',
+                                                    target_url=pyas2init.gsettings['mdn_url'])
+
+    def setUp(self):
+        self.path = as2utils.join(pyas2init.gsettings['root_dir'], 'messages', 'as2daemonpartner', 'outbox',
+                                  'as2daemonorg')
+        self.dir_watch = {'path': self.path, 'organization': 'as2daemonorg', 'partner': 'as2daemonpartner'}
+
+    def test_seen_files(self):
+        """ Test that files handed over are remembered and unchanged outboxes are not listed again """
+        filename = as2utils.join(self.path, 'testmessage.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), filename)
+        tasks = set()
+        runas2daemon.scan_outbox(self.dir_watch, tasks)
+        self.assertEqual(tasks, set([('as2daemonorg', 'as2daemonpartner', filename)]))
+
+        # Record the file as handed over, the next listing marks the outbox as done
+        stat = os.stat(filename)
+        models.OutboxFile.objects.create(organization='as2daemonorg', partner='as2daemonpartner',
+                                         filename='testmessage.edi', size=stat.st_size, mtime=stat.st_mtime)
+        runas2daemon.scan_outbox(self.dir_watch, set())
+        self.assertFalse(runas2daemon.claim(tasks.pop(), 'node1'))
+        tasks = set()
+        runas2daemon.scan_outbox(self.dir_watch, tasks)
+        self.assertFalse(tasks)
+
+        # Files that left the outbox are forgotten
+        os.remove(filename)
+        runas2daemon.scan_outbox(self.dir_watch, tasks)
+        self.assertFalse(models.OutboxFile.objects.exists())
+
+    def test_claim(self):
+        """ Test that a file is claimed by one daemon only and taken over when the lease expired """
+        filename = as2utils.join(self.path, 'claimed.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), filename)
+        self.addCleanup(os.remove, filename)
+        task = ('as2daemonorg', 'as2daemonpartner', filename)
+        self.assertTrue(runas2daemon.claim(task, 'node1'))
+        self.assertFalse(runas2daemon.claim(task, 'node2'))
+
+        # The lease of a crashed daemon is taken over
+        models.OutboxFile.objects.update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(runas2daemon.claim(task, 'node2'))
+        self.assertEqual(models.OutboxFile.objects.get().node, 'node2')
+
+        # A file handed over is only claimed again when it changed
+        jobs.end_lease(*task + ('node1', True))
+        self.assertFalse(runas2daemon.claim(task, 'node1'))
+        jobs.end_lease(*task + ('node2', True))
+        self.assertFalse(runas2daemon.claim(task, 'node1'))
+        with open(filename, 'a') as changed:
+            changed.write('more data')
+        self.assertTrue(runas2daemon.claim(task, 'node1'))
+
+    def test_renew_claims(self):
+        """ Test that unexpired claims are renewed by the daemon and by the job sending the file """
+        filename = as2utils.join(self.path, 'renewed.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), filename)
+        self.addCleanup(os.remove, filename)
+        task = ('as2daemonorg', 'as2daemonpartner', filename)
+        self.assertTrue(runas2daemon.claim(task, 'node1'))
+        soon = timezone.now() + timedelta(seconds=10)
+        models.OutboxFile.objects.update(lease_expires=soon)
+        self.assertEqual(runas2daemon.renew_claims('node1'), 1)
+        self.assertGreater(models.OutboxFile.objects.get().lease_expires, soon)
+
+        models.OutboxFile.objects.update(lease_expires=soon)
+        self.assertEqual(jobs.renew_lease(*task + ('node1',)), 1)
+        self.assertGreater(models.OutboxFile.objects.get().lease_expires, soon)
+        self.assertEqual(jobs.renew_lease(*task + ('node2',)), 0)
+
+        # An expired claim is left for another daemon to take over
+        models.OutboxFile.objects.update(lease_expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(runas2daemon.renew_claims('node1'), 0)
+        self.assertEqual(jobs.renew_lease(*task + ('node1',)), 0)
+
+    def test_expired_claims(self):
+        """ Test that a running daemon takes over the files whose claim expires """
+        filename = as2utils.join(self.path, 'expired.edi')
+        shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), filename)
+        self.addCleanup(os.remove, filename)
+        tasks = set()
+        watcher = runas2daemon.OutboxWatcher(threading.Condition(), tasks)
+        watcher.refresh()
+        task = tasks.pop()
+        self.assertTrue(runas2daemon.claim(task, 'node1'))
+        runas2daemon.scan_outbox(watcher.dir_watch_data[self.path], set())
+        self.assertIsNotNone(models.Outbox.objects.get().mtime)
+
+        # The claim is held, the outbox is not listed again
+        watcher.refresh()
+        self.assertFalse(tasks)
+
+        # The daemon holding the claim crashed
+        models.OutboxFile.objects.update(lease_expires=timezone.now() - timedelta(seconds=1))
+        watcher.refresh()
+        self.assertEqual(tasks, set([task]))
+        self.assertTrue(runas2daemon.claim(task, 'node2'))
+        self.assertEqual(models.OutboxFile.objects.get().node, 'node2')
+
+    def test_refresh_watches(self):
+        """ Test that watches follow the partners in the database """
+        watcher = runas2daemon.OutboxWatcher(None, set())
+        watcher.refresh()
+        self.assertIn(self.path, watcher.dir_watch_data)
+        self.partner.delete()
+        watcher.refresh()
+        self.assertNotIn(self.path, watcher.dir_watch_data)
+
+    def test_event_routing(self):
+        """ Test that events go to the watch of their own directory only """
+        models.Organization.objects.create(name='Daemon Organization 2', as2_name='as2daemonorg2')
+        tasks = set()
+        watcher = runas2daemon.OutboxWatcher(threading.Condition(), tasks)
+        watcher.refresh()
+        path = self.path + '2'
+        filename = as2utils.join(path, 'testmessage.edi')
+        handler = runas2daemon.LinuxEventHandler(logger=pyas2init.logger, watches=watcher.watches,
+                                                 cond=watcher.cond, tasks=tasks)
+        handler.process_default(runas2daemon.pyinotify.Event({'wd': watcher.dir_watch_data[path]['wd'],
+                                                              'mask': runas2daemon.pyinotify.IN_CLOSE_WRITE,
+                                                              'dir': False,
+                                                              'path': path,
+                                                              'name': 'testmessage.edi',
+                                                              'pathname': filename}))
+        self.assertEqual(tasks, set([('as2daemonorg2', 'as2daemonpartner', filename)]))
+
+    def test_batch_scheduler(self):
+        """ Test that files are released once their size is stable, in batches or after the maximum wait """
+        tasks = []
+        for name in ['first.edi', 'second.edi', 'third.edi']:
+            filename = as2utils.join(self.path, name)
+            shutil.copyfile(os.path.join(TEST_DIR, 'testmessage.edi'), filename)
+            self.addCleanup(os.remove, filename)
+            tasks.append(('as2daemonorg', 'as2daemonpartner', filename))
+        scheduler = runas2daemon.BatchScheduler(settle_time=1, max_wait=5, batch_size=2)
+        self.assertIsNone(scheduler.timeout(0))
+        for task in tasks:
+            scheduler.add(task, 0)
+        self.assertEqual(scheduler.timeout(0), 1)
+
+        # A file that is still being written is held back
+        with open(tasks[2][2], 'a') as growing:
+            growing.write('more data')
+        self.assertEqual(scheduler.poll(0.5), [])
+        batches = scheduler.poll(1)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(sorted(batches[0]), sorted(tasks[:2]))
+        self.assertEqual(scheduler.poll(2), [])
+        self.assertEqual(scheduler.timeout(2), 5)
+        self.assertEqual(scheduler.poll(7), [[tasks[2]]])
+        self.assertIsNone(scheduler.timeout(7))
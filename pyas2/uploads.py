@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+import os
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from . import as2utils
+from . import pyas2init
+
+
+class StagedUploadedFile(UploadedFile):
+    """ Uploaded file that has been written to the upload staging directory, next to the payload send store.
+        path is the file on disk and sha256 the digest of its content. """
+
+    def __init__(self, path, name, content_type, size, charset, sha256):
+        super(StagedUploadedFile, self).__init__(open(path, 'rb'), name, content_type, size, charset)
+        self.path = path
+        self.sha256 = sha256
+        self.stored = False
+
+    def store(self):
+        """ Move the file into the payload send store, on the same file system it is linked and not copied """
+        self.close()
+        self.path = as2utils.storepath(self.path, pyas2init.gsettings['payload_send_store'], self.name, True,
+                                       delete=True, fsync=pyas2init.store_fsync('payload_send_store'))
+        self.stored = True
+        return self.path
+
+    def discard(self):
+        """ Remove the file when it is not sent after all """
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class StagingUploadHandler(FileUploadHandler):
+    """ Streams the uploaded files into the upload staging directory, the view moves a file into the payload send
+        store once the request has passed its checks. The file is written to disk once and sendas2message sends
+        it without copying it again. """
+
+    writer = None
+
+    def new_file(self, *args, **kwargs):
+        super(StagingUploadHandler, self).new_file(*args, **kwargs)
+        filename = os.path.basename(self.file_name)
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        # Synced when it is moved into the store, a file that is not sent does not need to be durable
+        self.writer = as2utils.StoreWriter(pyas2init.gsettings['upload_staging_dir'], filename, False, fsync='never')
+
+    def receive_data_chunk(self, raw_data, start):
+        self.writer.write(raw_data)
+
+    def file_complete(self, file_size):
+        path = self.writer.close()
+        upload = StagedUploadedFile(path, self.writer.filename, self.content_type, file_size,
+                                    self.charset, self.writer.hexdigest())
+        self.writer = None
+        return upload
+
+    def upload_interrupted(self):
+        if self.writer:
+            self.writer.abort()
+            self.writer = None
+
+
+def discard_unsent(request):
+    """ Remove the staged files of the request that have not been moved into the store, like those of a request
+        that failed the csrf check or the form validation. Files that were never parsed are not read. """
+    files = request.__dict__.get('_files')
+    if files:
+        for name, uploads in files.lists():
+            for upload in uploads:
+                if isinstance(upload, StagedUploadedFile) and not upload.stored:
+                    upload.discard()
@@ -21,6 +21,7 @@ urlpatterns = [
     url(r'^resendmessage/(?P<pk>.+)/$', login_required(views.resend_message, login_url='login'), name='resendmessage'),
     url(r'^sendasyncmdn/$', login_required(views.send_async_mdn, login_url='login'), name='sendasyncmdn'),
     url(r'^retryfailedcomms/$', login_required(views.retry_failed_comms, login_url='login'), name='retryfailedcomms'),
+    url(r'^jobs/$', login_required(views.JobList.as_view(), login_url='login'), name='jobs'),
     url(r'^cancelretries/(?P<pk>.+)/$', login_required(views.cancel_retries, login_url='login'), name='cancelretries'),
     url(r'^certificates/$', login_required(views.download_cert, login_url='login'), name='download_cert'),
     # only superuser
@@ -1,23 +1,24 @@
 # -*- coding: utf-8 -*-
 
 import email
-from email.parser import HeaderParser
-from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
 from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, HttpResponseRedirect, HttpResponseServerError, Http404
 from django.shortcuts import render, redirect
 from django.views.generic import ListView, DetailView
 from django.views.generic.edit import View
 from django.core.urlresolvers import reverse
+from django.db.models import Prefetch
+from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.utils.translation import ugettext as _
 from django.contrib import messages
-from django.core import management
 from django.core.mail import mail_managers
 from django import template
-from multiprocessing import Process
 import tempfile
+from datetime import timedelta
 import traceback
 
-from . import models, forms, as2lib, as2utils, pyas2init, viewlib
+from . import models, forms, as2lib, as2utils, jobs, logevents, pyas2init, search, uploads, viewlib
 
 
 def server_error(request, template_name='500.html'):
@@ -44,9 +45,18 @@ def client_error(request, template_name='400.html'):
     return HttpResponseServerError(temp.render(template.Context({'exc_info': exc_info})))
 
 
+# Periods offered for the traffic on the home page
+TRAFFIC_DAYS = ('1', '7', '30')
+
+
 def home(request, *kw, **kwargs):
-    """ Default view, Displays the AS2 System Settings"""
-    return render(request, 'pyas2/about.html', {'pyas2info': pyas2init.gsettings})
+    """ Default view, Displays the traffic by partner from the hourly rollups and the AS2 System Settings"""
+    days = request.GET.get('days')
+    days = int(days) if days in TRAFFIC_DAYS else 1
+    traffic = models.PartnerTraffic.summary(timezone.now() - timedelta(days=days))
+    return render(request, 'pyas2/about.html', {'pyas2info': pyas2init.gsettings,
+                                                'traffic': traffic,
+                                                'traffic_days': days})
 
 
 class MessageList(ListView):
@@ -58,6 +68,7 @@ class MessageList(ListView):
     def get_queryset(self):
         if self.request.GET:
             qstring = dict()
+            conditions = []
             for param in self.request.GET.items():
                 if param[1]:
                     if param[0] == 'dateuntil':
@@ -68,19 +79,32 @@ class MessageList(ListView):
                         qstring[param[0] + '__as2_name'] = param[1]
                     elif param[0] == 'filename':
                         qstring['payload__name'] = param[1]
+                    elif param[0] == 'filename_prefix':
+                        conditions.append(search.query(param[1], match='prefix', fields=['filename']))
+                    elif param[0] == 'search':
+                        conditions.append(search.query(param[1], match=self.request.GET.get('match', 'contains')))
                     elif param[0] in ['direction', 'status', 'message_id']:
                         qstring[param[0]] = param[1]
-            return models.Message.objects.filter(**qstring).order_by('-timestamp')
-        return models.Message.objects.all().order_by('-timestamp')
+            return self.related(models.Message.objects.filter(*conditions, **qstring)).order_by('-timestamp')
+        return self.related(models.Message.objects.all()).order_by('-timestamp')
+
+    @staticmethod
+    def related(queryset):
+        """ Load the profiles, payload and MDN shown for each row with the messages """
+        return queryset.select_related('organization', 'partner', 'payload', 'mdn')
 
 
 class MessageDetail(DetailView):
     """ Generic detail view to display the message details"""
     model = models.Message
 
+    def get_queryset(self):
+        return models.Message.objects.select_related('organization', 'partner', 'payload', 'mdn').prefetch_related(
+            Prefetch('logs', queryset=models.Log.objects.order_by('timestamp'), to_attr='ordered_logs'))
+
     def get_context_data(self, **kwargs):
         context = super(MessageDetail, self).get_context_data(**kwargs)
-        context['logs'] = models.Log.objects.filter(message=kwargs['object']).order_by('timestamp')
+        context['logs'] = kwargs['object'].ordered_logs
         return context
 
 
@@ -116,6 +140,15 @@ class PayloadView(View):
                 response['Content-Disposition'] = disposition_type + '; filename=' + payload.name
                 response.write(as2utils.readdata(payload.file))
                 return response
+            elif request.GET['action'] == 'raw':
+                # Returns the message with its headers as it was sent to the partner
+                response = HttpResponse(content_type='message/rfc822')
+                response['Content-Disposition'] = 'attachment; filename=' + pk + '.as2'
+                for header in message._headers().items():
+                    response.write('%s: %s\n' % header)
+                response.write('\n')
+                response.write(as2utils.readdata(message.raw_file))
+                return response
             elif request.GET['action'] == 'this':
                 # Displays the payload contents, Formatting is applied based on the content type of the message.
                 file_obj = dict()
@@ -130,7 +163,7 @@ class PayloadView(View):
                     file_obj['content'] = viewlib.indent_xml(file_obj['content'])
                 file_obj['direction'] = message.get_direction_display()
                 file_obj['type'] = 'AS2 MESSAGE'
-                file_obj['headers'] = dict(HeaderParser().parsestr(message.headers or '').items())
+                file_obj['headers'] = message._headers()
                 return render(request, self.template_name, {'file_obj': file_obj})
         except Exception:
             return render(request, self.template_name, {'error_content': _(u'No such file.')})
@@ -157,8 +190,24 @@ class MDNList(ListView):
                             query_string['omessage__'+param[0]] = param[1]
                         elif param[0] in ['organization', 'partner']:
                             query_string['omessage__'+param[0]+'__as2_name'] = param[1]
-                return models.MDN.objects.filter(**query_string).order_by('-timestamp')
-        return models.MDN.objects.all().order_by('-timestamp')
+                return self.related(models.MDN.objects.filter(**query_string)).order_by('-timestamp')
+        return self.related(models.MDN.objects.all()).order_by('-timestamp')
+
+    @staticmethod
+    def related(queryset):
+        """ Load the original message and its profiles shown for each row with the MDNs """
+        return queryset.select_related('omessage', 'omessage__organization', 'omessage__partner')
+
+
+class JobList(ListView):
+    model = models.Job
+    paginate_by = 25
+
+    def get_queryset(self):
+        status = self.request.GET.get('status')
+        if status:
+            return models.Job.objects.filter(status=status).order_by('-created')
+        return models.Job.objects.order_by('-created')
 
 
 class MDNSearch(View):
@@ -196,12 +245,13 @@ class MDNView(View):
                 file_obj['content'] = as2utils.readdata(mdn.file, charset='utf-8', errors='ignore')
                 file_obj['direction'] = mdn.get_status_display()
                 file_obj['type'] = 'AS2 MDN'
-                file_obj['headers'] = dict(HeaderParser().parsestr(mdn.headers or '').items())
+                file_obj['headers'] = mdn._headers()
                 return render(request, self.template_name, {'file_obj': file_obj})
         except Exception:
             return render(request, self.template_name, {'error_content': _(u'No such file.')})
 
 
+@method_decorator(csrf_exempt, name='dispatch')
 class SendMessage(View):
     """Generic view for sending messages to partners. Form allows for selecting organization, partner and file to
     be transmitted."""
@@ -215,41 +265,46 @@ class SendMessage(View):
         return render(request, self.template_name, {'form': form})
 
     def post(self, request, *args, **kwargs):
+        # The upload is streamed into the staging directory, the handler has to be in place before the
+        # csrf check reads the posted form
+        request.upload_handlers = [uploads.StagingUploadHandler(request)]
+        try:
+            return self.send(request)
+        finally:
+            # Also when the csrf check rejected the request
+            uploads.discard_unsent(request)
+
+    @method_decorator(csrf_protect)
+    def send(self, request):
         # On post transmit the uploaded file
         form = self.form_class(request.POST, request.FILES)
-        if form.is_valid():
-            f = request.FILES.get('file')
-            # Save uploaded file to a temporary location
-            temp = tempfile.NamedTemporaryFile(suffix='_%s' % f.name, delete=False)
-            if f.multiple_chunks:
-                for chunk in f.chunks():
-                    temp.write(chunk)
-            else:
-                temp.write(f.read())
-            temp.close()
-            lijst = [
-                'sendas2message',
-                '--delete',
-                form.cleaned_data['organization'],
-                form.cleaned_data['partner'],
-                temp.name
-            ]
-            pyas2init.logger.info(_('Send message started with parameters: "%(parameters)s"'),
-                                  {'parameters': str(lijst)})
-
-            # Call django management command "sendas2message" to transfer the file to partner
-            messages.add_message(request, messages.INFO,
-                                 _('Sending file %(file)s to partner %(partner)s ...' % {
-                                     'file': f.name,
-                                     'partner': form.cleaned_data['partner']
-                                 }))
-            try:
-                p = Process(target=management.call_command, args=lijst)
-                p.start()
-            except Exception as msg:
-                notification = _('Errors while trying to run send message: "%s".') % msg
-                messages.add_message(request, messages.INFO, notification)
-                pyas2init.logger.error(notification)
+        if not form.is_valid():
+            return render(request, self.template_name, {'form': form})
+        f = request.FILES.get('file')
+        lijst = [
+            'sendas2message',
+            '--stored',
+            form.cleaned_data['organization'],
+            form.cleaned_data['partner'],
+            f.store()
+        ]
+        pyas2init.logger.info(_('Send message started with parameters: "%(parameters)s", SHA-256 of the file '
+                                'is %(sha256)s'), {'parameters': str(lijst), 'sha256': f.sha256})
+        as2utils.syncstoredfiles()
+
+        # Call django management command "sendas2message" to transfer the file to partner
+        messages.add_message(request, messages.INFO,
+                             _('Sending file %(file)s to partner %(partner)s ...' % {
+                                 'file': f.name,
+                                 'partner': form.cleaned_data['partner']
+                             }))
+        try:
+            jobs.submit(*lijst)
+        except Exception as msg:
+            f.discard()
+            notification = _('Errors while trying to run send message: "%s".') % msg
+            messages.add_message(request, messages.INFO, notification)
+            pyas2init.logger.error(notification)
         return render(request, self.template_name, {'form': form})
 
 
@@ -273,8 +328,7 @@ def resend_message(request, pk, *args, **kwargs):
     ]
     pyas2init.logger.info(_(u'Re-send message started with parameters: "%(parameters)s"'), {'parameters': str(lijst)})
     try:
-        p = Process(target=management.call_command, args=lijst)
-        p.start()
+        jobs.submit(*lijst)
     except Exception as msg:
         notification = _(u'Errors while trying to re-send message: "%s".') % msg
         messages.add_message(request, messages.INFO, notification)
@@ -291,8 +345,7 @@ def send_async_mdn(request, *args, **kwargs):
     lijst = ['sendasyncmdn']
     pyas2init.logger.info(_(u'Send async MDNs started with parameters: "%(parameters)s"'), {'parameters': str(lijst)})
     try:
-        p = Process(target=management.call_command, args=lijst)
-        p.start()
+        jobs.submit(*lijst)
     except Exception as msg:
         notification = _(u'Errors while trying to run send async MDNs: "%s".') % msg
         messages.add_message(request, messages.INFO, notification)
@@ -308,8 +361,7 @@ def retry_failed_comms(request, *args, **kwargs):
     pyas2init.logger.info(_(u'Retry Failed communications started with parameters: "%(parameters)s"'),
                           {'parameters': str(lijst)})
     try:
-        p = Process(target=management.call_command, args=lijst)
-        p.start()
+        jobs.submit(*lijst)
     except Exception as msg:
         notification = _(u'Errors while trying to retrying failed communications: "%s".') % msg
         messages.add_message(request, messages.INFO, notification)
@@ -322,7 +374,7 @@ def cancel_retries(request, pk, *args, **kwargs):
     """ Cancel retries for a failed outbound message from the list messages view"""
     message = models.Message.objects.get(message_id=pk)
     message.status = 'E'
-    models.Log.objects.create(message=message, status='S', text=_(u'User cancelled further retires for this message'))
+    models.Log.add(message, 'S', logevents.RETRIES_CANCELLED)
     message.save()
     messages.add_message(request, messages.INFO, _(u'Cancelled retries for message %s' % pk))
     return redirect('pyas2:messages')
@@ -392,12 +444,12 @@ def as2receive(request, *args, **kwargs):
                               'FROM <%(HTTP_AS2_FROM)s> TO <%(HTTP_AS2_TO)s>' % request.META)
 
         # Extract all the relevant headers from the http request
-        headers = ''
+        header_items = []
         content_headers = {}
         for key, value in request.META.items():
             if key.startswith('HTTP') and value:
                 key = key.replace('HTTP_', '').replace('_', '-').lower()
-                headers += '%s: %s\n' % (key, value)
+                header_items.append((key, value))
             elif key.startswith('CONTENT') and value:
                 key = key.replace('_', '-').lower()
                 content_headers[key] = value
@@ -408,7 +460,8 @@ def as2receive(request, *args, **kwargs):
         # 'content-encoding' and 'content-disposition' come from HTTP_CONTENT_*
         for key in ['content-length', 'content-type']:
             if content_headers.get(key):
-                headers += '%s: %s\n' % (key, content_headers.get(key))
+                header_items.append((key, content_headers.get(key)))
+        headers = ''.join('%s: %s\n' % (key, value) for key, value in header_items)
 
         pyas2init.logger.debug('REQUEST HEADERS:\n%s' % headers)
 
@@ -425,7 +478,8 @@ def as2receive(request, *args, **kwargs):
                                                                   as2utils.unescape_as2name(as2_to),
                                                                   as2utils.unescape_as2name(as2_from))),
                                           raw_payload,
-                                          True)
+                                          True,
+                                          fsync=pyas2init.store_fsync('raw_receive_store'))
         pyas2init.logger.info('%s %s' % (_('Raw as2 message received stored:'), raw_filename))
 
         try:
@@ -438,10 +492,10 @@ def as2receive(request, *args, **kwargs):
             message = None
 
             # Organisation
-            org = models.Organization.objects.filter(as2_name=message_org).first()
+            org = models.get_organization(message_org)
 
             # Partner
-            partner = models.Partner.objects.filter(as2_name=message_partner).first()
+            partner = models.get_partner(message_partner)
 
             # Check if this is an MDN message
             mdn_message = None
@@ -478,9 +532,7 @@ def as2receive(request, *args, **kwargs):
                     if not partner or not org or not message:
                         raise Http404(error404)
 
-                    models.Log.objects.create(message=message,
-                                              status='S',
-                                              text=_('Processing incoming asynchronous mdn'))
+                    models.Log.add(message, 'S', logevents.ASYNC_MDN_PROCESSING)
                     as2lib.save_mdn(message, raw_payload)
 
                 except Http404 as e:
@@ -490,9 +542,7 @@ def as2receive(request, *args, **kwargs):
 
                 except as2utils.As2Exception as e:
                     pyas2init.logger.error(e)
-                    models.Log.objects.create(message=message,
-                                              status=message.status,
-                                              text=e)
+                    models.Log.add(message, message.status, logevents.ERROR, error=e)
 
                 except Exception as e:
                     error = '%s %s' % (_('Failed to proceed AS2 ASYNC MDN:'), e)
@@ -500,13 +550,13 @@ def as2receive(request, *args, **kwargs):
                     if message:
                         message.status = 'E'
                         message.save()
-                        models.Log.objects.create(message=message,
-                                                  status=message.status,
-                                                  text=error)
+                        models.Log.add(message, message.status, logevents.ASYNC_MDN_FAILED, error=e)
                         # Send mail here
                         as2utils.senderrorreport(message, error)
 
                 finally:
+                    # Make the stored files durable before acknowledging the MDN
+                    as2utils.syncstoredfiles()
                     # Send response to HTTP request
                     return HttpResponse(_('AS2 ASYNC MDN has been received'))
 
@@ -528,7 +578,7 @@ def as2receive(request, *args, **kwargs):
                                                 message_id='%s_%s' % (message_id, payload.get('date')),
                                                 direction='IN',
                                                 status='IP',
-                                                headers=headers,
+                                                headers=models.dump_headers(header_items),
                                                 organization=org,
                                                 partner=partner)
                         raise as2utils.As2DuplicateDocument(_('Duplicate message received !'))
@@ -539,7 +589,7 @@ def as2receive(request, *args, **kwargs):
                                                         message_id=message_id,
                                                         direction='IN',
                                                         status='IP',
-                                                        headers=headers,
+                                                        headers=models.dump_headers(header_items),
                                                         organization=org,
                                                         partner=partner)
 
@@ -563,15 +613,15 @@ def as2receive(request, *args, **kwargs):
 
                     # Save the message content to the store and inbox
                     content = payload.get_payload(decode=True)
-                    full_filename = as2utils.storefile(output_dir, filename, content, False)
+                    full_filename = as2utils.storefile(output_dir, filename, content, False,
+                                                       fsync=pyas2init.store_fsync('inbox'))
                     store_filename = as2utils.storefile(pyas2init.gsettings['payload_receive_store'],
                                                         message.message_id,
                                                         content,
-                                                        True)
+                                                        True,
+                                                        fsync=pyas2init.store_fsync('payload_receive_store'))
 
-                    models.Log.objects.create(message=message,
-                                              status='S',
-                                              text=_('Message saved successfully to %s' % full_filename))
+                    models.Log.add(message, 'S', logevents.SAVED, filename=full_filename)
 
                     message.payload = models.Payload.objects.create(name=filename,
                                                                     file=store_filename,
@@ -619,6 +669,7 @@ def as2receive(request, *args, **kwargs):
                     adv_status = 'unexpected-processing-error'
                     status_message = _('An unexpected error occurred while processing AS2 message <%s>' % message_id)
                 finally:
+                    mdn_body, mdn_message = None, None
                     if message:
                         # Build the mdn for the message based on processing status
                         mdn_body, mdn_message = as2lib.build_mdn(message,
@@ -627,12 +678,15 @@ def as2receive(request, *args, **kwargs):
                                                                  status_message=status_message,
                                                                  full_filename=full_filename)
 
-                        # Create the mdn response body and return the MDN to the http request
-                        if mdn_body:
-                            mdn_response = HttpResponse(mdn_body, content_type=mdn_message.get_content_type())
-                            for key, value in mdn_message.items():
-                                mdn_response[key] = value
-                            return mdn_response
+                    # Make the stored files durable before acknowledging the message
+                    as2utils.syncstoredfiles()
+
+                    # Create the mdn response body and return the MDN to the http request
+                    if mdn_body:
+                        mdn_response = HttpResponse(mdn_body, content_type=mdn_message.get_content_type())
+                        for key, value in mdn_message.items():
+                            mdn_response[key] = value
+                        return mdn_response
                     return HttpResponse(_('AS2 message has been received'))
 
         # Catch all exception in case of any kind of error in the system.